@@ -19,6 +19,7 @@ import re
 import cgi
 import difflib
 import logging
+import threading
 import urlparse
 
 # AppEngine imports
@@ -50,10 +51,23 @@ def SplitPatch(data):
     A list of 2-tuple (filename, text) where text is the svn diff output
       pertaining to filename.
   """
-  patches = []
+  return list(IterSplitPatch(data.splitlines(True)))
+
+
+def IterSplitPatch(lines):
+  """Like SplitPatch(), but takes the lines of a patch and yields the pieces.
+
+  Only the lines of the current file are kept in memory.
+
+  Args:
+    lines: An iterable of lines, including their line endings.
+
+  Yields:
+    2-tuples (filename, text), see SplitPatch().
+  """
   filename = None
   diff = []
-  for line in data.splitlines(True):
+  for line in lines:
     new_filename = None
     if line.startswith('Index:'):
       unused, new_filename = line.split(':', 1)
@@ -69,15 +83,67 @@ def SplitPatch(data):
         new_filename = temp_filename
     if new_filename:
       if filename and diff:
-        patches.append((filename, ''.join(diff)))
+        yield filename, ''.join(diff)
       filename = new_filename
       diff = [line]
       continue
     if diff is not None:
       diff.append(line)
   if filename and diff:
-    patches.append((filename, ''.join(diff)))
-  return patches
+    yield filename, ''.join(diff)
+
+
+# Size of the chunks read by IterUnifiedChunks().
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def IterUnifiedChunks(stream, chunk_size=READ_CHUNK_SIZE):
+  """Reads a file in chunks with all line breaks converted to LF.
+
+  Like UnifyLinebreaks(), but only one chunk is held in memory.
+
+  Args:
+    stream: A file-like object.
+    chunk_size: The number of bytes to read at a time.
+
+  Yields:
+    Non-empty strings which, joined, equal UnifyLinebreaks(stream.read()).
+  """
+  pending_cr = False
+  while True:
+    chunk = stream.read(chunk_size)
+    if not chunk:
+      break
+    if pending_cr:
+      chunk = '\r' + chunk
+    # A CR at the end of the chunk may be followed by a LF in the next one.
+    pending_cr = chunk.endswith('\r')
+    if pending_cr:
+      chunk = chunk[:-1]
+    chunk = UnifyLinebreaks(chunk)
+    if chunk:
+      yield chunk
+  if pending_cr:
+    yield '\n'
+
+
+def IterLines(chunks):
+  """Yields the lines of text given as chunks with LF line breaks.
+
+  Args:
+    chunks: An iterable of strings, e.g. from IterUnifiedChunks().
+
+  Yields:
+    The lines, including their line endings, like str.splitlines(True).
+  """
+  partial = ''
+  for chunk in chunks:
+    lines = (partial + chunk).split('\n')
+    partial = lines.pop()
+    for line in lines:
+      yield line + '\n'
+  if partial:
+    yield partial
 
 
 def ParsePatchSet(patchset):
@@ -109,12 +175,127 @@ def FetchBase(base, patch):
   Raises:
     FetchError: For any kind of problem fetching the content.
   """
+  url, rev = _GetBaseUrl(base, patch)
+  if url is None:
+    # rev=0 means it's a new file.
+    return models.Content(text=db.Text(u''), parent=patch)
+  text = None
+  if rev is not None:
+    text = models.BaseFile.get_texts([url]).get(url)
+  if text is None:
+    text = _FetchBaseText(url)
+    if rev is not None:
+      models.BaseFile.store(url, text)
+  return models.Content(text=text, parent=patch)
+
+
+# Limits for FetchBases(), the pooled urlfetch connections are shared.
+MAX_FETCH_THREADS = 8
+MAX_FETCHES_PER_HOST = 4
+
+
+def FetchBases(base, patches, max_threads=MAX_FETCH_THREADS,
+               max_per_host=MAX_FETCHES_PER_HOST):
+  """Fetch the base files of several patches concurrently.
+
+  Files at a fixed revision are looked up in the shared BaseFile cache
+  first.  Only the downloads run in threads; the cache and the Content
+  instances are updated afterwards.
+
+  Args:
+    base: the base property of the Issue to which the patches belong.
+    patches: a list of models.Patch instances.
+    max_threads: the maximum number of concurrent fetches.
+    max_per_host: the maximum number of concurrent fetches from one host.
+
+  Returns:
+    A list of (patch, content, error) tuples in the order of patches.
+    content is a new, unsaved models.Content instance, or None if there was
+    a FetchError, which is then given as error.
+  """
+  results = [None] * len(patches)
+  pending = []  # (index, url) pairs to fetch
+  cacheable = {}  # Maps index to the URL of files at a fixed revision
+  for i, patch in enumerate(patches):
+    try:
+      url, rev = _GetBaseUrl(base, patch)
+    except FetchError, err:
+      results[i] = (patch, None, err)
+      continue
+    if url is None:
+      results[i] = (patch, models.Content(text=db.Text(u''), parent=patch),
+                    None)
+    else:
+      pending.append((i, url))
+      if rev is not None:
+        cacheable[i] = url
+
+  cached = models.BaseFile.get_texts(set(cacheable.itervalues()))
+  for i, url in pending:
+    if url in cached:
+      results[i] = (patches[i], models.Content(text=cached[url],
+                                               parent=patches[i]), None)
+  pending = [(i, url) for i, url in pending if url not in cached]
+
+  texts = {}  # Maps index to (text, error)
+  lock = threading.Lock()
+  host_semaphores = {}
+
+  def worker():
+    while True:
+      lock.acquire()
+      try:
+        if not pending:
+          return
+        i, url = pending.pop(0)
+        host = urlparse.urlparse(url)[1]
+        if host not in host_semaphores:
+          host_semaphores[host] = threading.Semaphore(max_per_host)
+        semaphore = host_semaphores[host]
+      finally:
+        lock.release()
+      semaphore.acquire()
+      try:
+        try:
+          texts[i] = (_FetchBaseText(url), None)
+        except FetchError, err:
+          texts[i] = (None, err)
+      finally:
+        semaphore.release()
+
+  threads = [threading.Thread(target=worker)
+             for _ in xrange(min(max_threads, len(pending)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for i, (text, err) in texts.iteritems():
+    patch = patches[i]
+    if err is not None:
+      results[i] = (patch, None, err)
+    else:
+      if i in cacheable:
+        models.BaseFile.store(cacheable[i], text)
+      results[i] = (patch, models.Content(text=text, parent=patch), None)
+  return results
+
+
+def _GetBaseUrl(base, patch):
+  """Helper for FetchBase() and FetchBases().
+
+  Returns:
+    A 2-tuple (url, rev).  url is None if it's a new file, rev is None if
+    the head revision is fetched.
+
+  Raises:
+    FetchError: If the base can't be fetched from.
+  """
   filename, lines = patch.filename, patch.lines
   rev = patching.ParseRevision(lines)
   if rev is not None:
     if rev == 0:
-      # rev=0 means it's a new file.
-      return models.Content(text=db.Text(u''), parent=patch)
+      return None, rev
 
   # AppEngine can only fetch URLs that db.Link() thinks are OK,
   # so try converting to a db.Link() here.
@@ -125,10 +306,21 @@ def FetchBase(base, patch):
     logging.warn(msg)
     raise FetchError(msg)
 
-  url = _MakeUrl(base, filename, rev)
+  return _MakeUrl(base, filename, rev), rev
+
+
+def _FetchBaseText(url):
+  """Helper for FetchBase() and FetchBases() to download a base file.
+
+  This doesn't touch the datastore, so it's safe to call from threads.
+
+  Returns:
+    A db.Text instance.
+  """
   logging.info('Fetching %s', url)
   try:
-    result = urlfetch.fetch(url)
+    # Files fetched without a revision are revalidated with the server.
+    result = urlfetch.fetch(url, conditional=True)
   except Exception, err:
     msg = 'Error fetching %s: %s: %s' % (url, err.__class__.__name__, err)
     logging.warn('FetchBase: %s', msg)
@@ -137,8 +329,7 @@ def FetchBase(base, patch):
     msg = 'Error fetching %s: HTTP status %s' % (url, result.status_code)
     logging.warn('FetchBase: %s', msg)
     raise FetchError(msg)
-  return models.Content(text=ToText(UnifyLinebreaks(result.content)),
-                        parent=patch)
+  return ToText(UnifyLinebreaks(result.content))
 
 
 def _MakeUrl(base, filename, rev):
@@ -191,7 +382,8 @@ MAX_COLUMN_WIDTH = 2000
 
 def RenderDiffTableRows(request, old_lines, chunks, patch,
                         colwidth=DEFAULT_COLUMN_WIDTH, debug=False,
-                        context=DEFAULT_CONTEXT):
+                        context=DEFAULT_CONTEXT, comments=None,
+                        read_only=False):
   """Render the HTML table rows for a side-by-side diff for a patch.
 
   Args:
@@ -202,6 +394,10 @@ def RenderDiffTableRows(request, old_lines, chunks, patch,
     colwidth: Optional column width (default 80).
     debug: Optional debugging flag (default False).
     context: Maximum number of rows surrounding a change (default CONTEXT).
+    comments: Optional (old, new) tuple of the patch's comments as
+      returned by GroupComments().  By default they're queried.
+    read_only: If True, there are no links to expand skipped lines or to
+      reply to comments (default False).
 
   Yields:
     Strings, each of which represents the text rendering one complete
@@ -209,8 +405,8 @@ def RenderDiffTableRows(request, old_lines, chunks, patch,
     Each yielded string may consist of several <tr> elements.
   """
   rows = _RenderDiffTableRows(request, old_lines, chunks, patch,
-                              colwidth, debug)
-  return _CleanupTableRowsGenerator(rows, context)
+                              colwidth, debug, comments, read_only)
+  return _CleanupTableRowsGenerator(rows, context, not read_only)
 
 
 def RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
@@ -238,12 +434,13 @@ def RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
   return _CleanupTableRowsGenerator(rows, context)
 
 
-def _CleanupTableRowsGenerator(rows, context):
+def _CleanupTableRowsGenerator(rows, context, expandable=True):
   """Cleanup rows returned by _TableRowGenerator for output.
 
   Args:
     rows: List of tuples (tag, text)
     context: Maximum number of visible context lines.
+    expandable: Whether skipped lines get links to expand them.
 
   Yields:
     Rows marked as 'equal' are possibly contracted using _ShortenBuffer().
@@ -255,7 +452,7 @@ def _CleanupTableRowsGenerator(rows, context):
       buffer.append(text)
       continue
     else:
-      for t in _ShortenBuffer(buffer, context):
+      for t in _ShortenBuffer(buffer, context, expandable):
         yield t
       buffer = []
     yield text
@@ -263,17 +460,18 @@ def _CleanupTableRowsGenerator(rows, context):
       yield None
       break
   if buffer:
-    for t in _ShortenBuffer(buffer, context):
+    for t in _ShortenBuffer(buffer, context, expandable):
       yield t
 
 
-def _ShortenBuffer(buffer, context):
+def _ShortenBuffer(buffer, context, expandable=True):
   """Render a possibly contracted series of HTML table rows.
 
   Args:
     buffer: a list of strings representing HTML table rows.
     context: Maximum number of visible context lines. If None all lines are
       returned.
+    expandable: Whether the contraction has links to expand it.
 
   Yields:
     If the buffer has fewer than 3 times context items, yield all
@@ -293,19 +491,20 @@ def _ShortenBuffer(buffer, context):
       yield t
     skip = len(buffer) - 2*context
     expand_link = []
-    if skip > 3*context:
+    if expandable:
+      if skip > 3*context:
+        expand_link.append(('<a href="javascript:M_expandSkipped(%(before)d, '
+                            '%(after)d, \'t\', %(skip)d)">'
+                            'Expand %(context)d before'
+                            '</a> | '))
       expand_link.append(('<a href="javascript:M_expandSkipped(%(before)d, '
-                          '%(after)d, \'t\', %(skip)d)">'
-                          'Expand %(context)d before'
-                          '</a> | '))
-    expand_link.append(('<a href="javascript:M_expandSkipped(%(before)d, '
-                        '%(after)d, \'a\', %(skip)d)">Expand all</a>'))
-    if skip > 3*context:
-      expand_link.append((' | '
-                          '<a href="javascript:M_expandSkipped(%(before)d, '
-                          '%(after)d, \'b\', %(skip)d)">'
-                          'Expand %(context)d after'
-                          '</a>'))
+                          '%(after)d, \'a\', %(skip)d)">Expand all</a>'))
+      if skip > 3*context:
+        expand_link.append((' | '
+                            '<a href="javascript:M_expandSkipped(%(before)d, '
+                            '%(after)d, \'b\', %(skip)d)">'
+                            'Expand %(context)d after'
+                            '</a>'))
     expand_link = ''.join(expand_link) % {'before': last_id+1,
                                           'after': last_id+skip,
                                           'skip': last_id,
@@ -375,16 +574,31 @@ def _GetComments(request):
     A 2-tuple of (old, new) where old/new are dictionaries that holds comments
       for that file, mapping from line number to a Comment entity.
   """
-  old_dict = {}
-  new_dict = {}
   # XXX GQL doesn't support OR yet...  Otherwise we'd be using
   # .gql('WHERE patch = :1 AND (draft = FALSE OR author = :2) ORDER BY data',
   #      patch, request.user)
-  for comment in models.Comment.gql('WHERE patch = :1 ORDER BY date',
-                                    request.patch):
-    if comment.draft and comment.author != request.user:
+  comments = models.Comment.gql('WHERE patch = :1 ORDER BY date',
+                                request.patch)
+  return GroupComments(comments, request.patch, request.user)
+
+
+def GroupComments(comments, patch, user):
+  """Sorts the comments of a patch by side and line number.
+
+  Args:
+    comments: The Comment entities of the patch, ordered by date.
+    patch: The models.Patch instance they belong to.
+    user: The current user.  Drafts of other users are left out.
+
+  Returns:
+    A 2-tuple of (old, new) like _GetComments().
+  """
+  old_dict = {}
+  new_dict = {}
+  for comment in comments:
+    if comment.draft and comment.author != user:
       continue  # Only show your own drafts
-    comment.complete(request.patch)
+    comment.complete(patch)
     if comment.left:
       dct = old_dict
     else:
@@ -393,8 +607,29 @@ def _GetComments(request):
   return old_dict, new_dict
 
 
+def _PrimeNicknames(request, *comment_dicts):
+  """Looks up the nicknames of all comment authors in one batch.
+
+  Args:
+    request: Django Request object, holding the nicknames for the
+      inline_comment.html renders.
+    comment_dicts: Dictionaries like those returned by _GetComments().
+  """
+  if request is None:
+    return
+  # library imports models, which imports this module.
+  import library
+  emails = set()
+  for dct in comment_dicts:
+    for comments in dct.itervalues():
+      emails.update(c.author.email() for c in comments
+                    if c.author is not None)
+  library.prime_nicknames(request, emails)
+
+
 def _RenderDiffTableRows(request, old_lines, chunks, patch,
-                         colwidth=DEFAULT_COLUMN_WIDTH, debug=False):
+                         colwidth=DEFAULT_COLUMN_WIDTH, debug=False,
+                         comments=None, read_only=False):
   """Internal version of RenderDiffTableRows().
 
   Args:
@@ -405,19 +640,21 @@ def _RenderDiffTableRows(request, old_lines, chunks, patch,
   """
   old_dict = {}
   new_dict = {}
-  if patch:
+  if comments is not None:
+    old_dict, new_dict = comments
+  elif patch:
     old_dict, new_dict = _GetComments(request)
   old_max, new_max = _ComputeLineCounts(old_lines, chunks)
   return _TableRowGenerator(patch, old_dict, old_max, 'old',
                             patch, new_dict, new_max, 'new',
                             patching.PatchChunks(old_lines, chunks),
-                            colwidth, debug, request)
+                            colwidth, debug, request, read_only)
 
 
 def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
                        new_patch, new_dict, new_max, new_snapshot,
                        triple_iterator, colwidth=DEFAULT_COLUMN_WIDTH,
-                       debug=False, request=None):
+                       debug=False, request=None, read_only=False):
   """Helper function to render side-by-side table rows.
 
   Args:
@@ -432,11 +669,14 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
     triple_iterator: Iterator that yields (tag, old, new) triples.
     colwidth: Optional column width (default 80).
     debug: Optional debugging flag (default False).
+    request: Django Request object.
+    read_only: If True, comments have no reply links (default False).
 
   Yields:
     Tuples (tag, row) where tag is an indication of the row type and
     row is an HTML fragment representing one or more <td> elements.
   """
+  _PrimeNicknames(request, old_dict, new_dict)
   diff_params = intra_region_diff.GetDiffParams(dbg=debug)
   ndigits = 1 + max(len(str(old_max)), len(str(new_max)))
   indent = 1 + ndigits
@@ -525,7 +765,8 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
                                             old_dict, new_dict,
                                             old_patch, new_patch,
                                             old_snapshot, new_snapshot,
-                                            colwidth, debug, request):
+                                            colwidth, debug, request,
+                                            read_only):
           yield tg, frag
         frag_list = []
 
@@ -559,7 +800,8 @@ def _TableRowGenerator(old_patch, old_dict, old_max, old_snapshot,
                                           old_dict, new_dict,
                                           old_patch, new_patch,
                                           old_snapshot, new_snapshot,
-                                          colwidth, debug, request):
+                                          colwidth, debug, request,
+                                          read_only):
         yield tg, frag
       old_buff = []
       new_buff = []
@@ -597,7 +839,7 @@ def _RenderDiffInternal(old_buff, new_buff, ndigits, tag, frag_list,
                         do_ir_diff, old_dict, new_dict,
                         old_patch, new_patch,
                         old_snapshot, new_snapshot,
-                        colwidth, debug, request):
+                        colwidth, debug, request, read_only=False):
   """Helper for _TableRowGenerator()."""
   obegin = (intra_region_diff.BEGIN_TAG %
             intra_region_diff.COLOR_SCHEME['old']['match'])
@@ -605,7 +847,11 @@ def _RenderDiffInternal(old_buff, new_buff, ndigits, tag, frag_list,
             intra_region_diff.COLOR_SCHEME['new']['match'])
   oend = intra_region_diff.END_TAG
   nend = oend
-  user = users.get_current_user()
+  if read_only:
+    # inline_comment.html only shows reply links to users.
+    user = None
+  else:
+    user = users.get_current_user()
 
   for i in xrange(len(old_buff)):
     tg = tag
@@ -736,6 +982,7 @@ def RenderUnifiedTableRows(request, parsed_lines):
     A list of html table rows.
   """
   old_dict, new_dict = _GetComments(request)
+  _PrimeNicknames(request, old_dict, new_dict)
 
   rows = []
   for old_line_no, new_line_no, line_text in parsed_lines:
@@ -16,6 +16,7 @@
 
 import cgi
 import logging
+import md5
 
 from google.appengine.api import memcache
 from google.appengine.api import users
@@ -30,6 +31,11 @@ register = django.template.Library()
 
 user_cache = {}
 
+# Rendered issue rows are kept this long, like the user links they contain.
+ISSUE_ROW_CACHE_TIMEOUT = 300
+# Nicknames are kept in memcache this long, see get_nicknames().
+NICKNAME_CACHE_TIMEOUT = 300
+
 
 def get_links_for_users(user_emails):
   """Return a dictionary of email->link to user page and fill caches."""
@@ -169,12 +175,130 @@ def urlappend_view_settings(parser, token):
   return UrlAppendViewSettingsNode()
 
 
+class CachedIssueRowNode(django.template.Node):
+  """Renders the enclosed part of an issue row through memcache.
+
+  The cache key holds the issue id and its modification time, so a row is
+  rendered again after each Issue.put(), and everything in the row that
+  depends on the viewer: whether the viewer is one of the users shown (as
+  'me'), is logged in, starred the issue, may close it or has drafts.
+  Parts changing over time, like the age of the issue, must stay outside.
+
+  Example:
+    {%cached_issue_row issue%}...{%endcached_issue_row%}
+  """
+
+  def __init__(self, issue, nodelist):
+    """Constructor.
+
+    'issue' is the name of the template variable that holds the issue.
+    """
+    self.issue = django.template.Variable(issue)
+    self.nodelist = nodelist
+
+  def render(self, context):
+    try:
+      issue = self.issue.resolve(context)
+    except django.template.VariableDoesNotExist:
+      return self.nodelist.render(context)
+    viewer = ''
+    user = users.get_current_user()
+    if user is not None:
+      viewer = user.email().lower()
+      if viewer not in issue.participants():
+        viewer = '+'
+    key = '\0'.join(str(bit) for bit in (
+        issue.key().id(), issue.modified, viewer, issue.is_starred,
+        issue.edit_allowed, issue.num_drafts,
+        bool(context.get('closed_issues'))))
+    key = 'issue_row:' + md5.new(key).hexdigest()
+    html = memcache.get(key)
+    if html is None:
+      html = self.nodelist.render(context)
+      memcache.set(key, html, ISSUE_ROW_CACHE_TIMEOUT)
+    return html
+
+
+@register.tag
+def cached_issue_row(parser, token):
+  """Caches the rendered issue row enclosed up to endcached_issue_row."""
+  try:
+    tag_name, issue = token.split_contents()
+  except ValueError:
+    raise django.template.TemplateSyntaxError(
+      "%r requires exactly one argument" % token.contents.split()[0])
+  nodelist = parser.parse(('endcached_issue_row',))
+  parser.delete_first_token()
+  return CachedIssueRowNode(issue, nodelist)
+
+
+def get_nicknames(emails, request=None):
+  """Return a dictionary of email->nickname, looking them up in batches.
+
+  Nicknames are taken from the request's cache if 'request' is a
+  HttpRequest, then from memcache, which is shared by all processes.  The
+  remaining ones are looked up with a single batch get of Accounts and
+  added to both caches.  Memcache keys are lowercase emails, as deleted by
+  Account.put().
+  """
+  if request is not None:
+    if getattr(request, '_nicknames', None) is None:
+      request._nicknames = {}
+    cache = request._nicknames
+  else:
+    cache = {}
+  nicknames = {}
+  remaining = set()
+  for email in emails:
+    if email in cache:
+      nicknames[email] = cache[email]
+    else:
+      remaining.add(email)
+
+  if remaining:
+    memcache_results = memcache.get_multi(
+        set(email.lower() for email in remaining), key_prefix='nickname:')
+    for email in list(remaining):
+      if email.lower() in memcache_results:
+        nicknames[email] = memcache_results[email.lower()]
+        remaining.remove(email)
+
+  if remaining:
+    accounts = models.Account.get_multiple_accounts_by_email(remaining)
+    datastore_results = {}
+    for email in remaining:
+      account = accounts.get(email) or accounts.get(email.lower())
+      if account is not None and account.nickname:
+        datastore_results[email] = account.nickname
+      else:
+        datastore_results[email] = email.replace('@', '_')
+    memcache.set_multi(dict((email.lower(), nickname) for email, nickname
+                            in datastore_results.iteritems()),
+                       NICKNAME_CACHE_TIMEOUT, key_prefix='nickname:')
+    nicknames.update(datastore_results)
+
+  cache.update(nicknames)
+  return nicknames
+
+
+def prime_nicknames(request, emails):
+  """Look up the nicknames of users shown later in one go.
+
+  The nickname tags rendered while handling 'request' then find them in
+  the request's cache.
+  """
+  emails = set(email.email() if isinstance(email, users.User) else email
+               for email in emails if email)
+  if emails:
+    get_nicknames(emails, request)
+
+
 def get_nickname(email, never_me=False, request=None):
   """Return a nickname for an email address.
 
   If 'never_me' is True, 'me' is not returned if 'email' belongs to the
   current logged in user. If 'request' is a HttpRequest, it is used to
-  cache the nickname returned by models.Account.get_nickname_for_email().
+  cache the nickname, see get_nicknames() and prime_nicknames().
   """
   if isinstance(email, users.User):
     email = email.email()
@@ -186,16 +310,7 @@ def get_nickname(email, never_me=False, request=None):
     if user is not None and email == user.email():
       return 'me'
 
-  if request is None:
-    return models.Account.get_nickname_for_email(email)
-  else:
-    if getattr(request, '_nicknames', None) is None:
-      request._nicknames = {}
-    if email in request._nicknames:
-      return request._nicknames[email]
-    result = models.Account.get_nickname_for_email(email)
-    request._nicknames[email] = result
-  return result
+  return get_nicknames([email], request)[email]
 
 
 class NicknameNode(django.template.Node):
@@ -230,6 +345,8 @@ class NicknameNode(django.template.Node):
       return ''
     request = context.get('request')
     if self.is_multi:
+      if request is not None:
+        prime_nicknames(request, email)
       return ', '.join(get_nickname(e, self.never_me, request) for e in email)
     return get_nickname(email, self.never_me, request)
 
@@ -15,15 +15,25 @@
 """App Engine data model (schema) definition for Rietveld."""
 
 # Python imports
+import array
+import datetime
 import logging
+import math
 import md5
 import os
+import random
 import re
+import tempfile
 import time
+import urlparse
 
 # AppEngine imports
+from django.db.models import F
+from django.utils import simplejson
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 
 # Local imports
@@ -60,6 +70,24 @@ def gql(cls, clause, *args, **kwds):
   return query
 
 
+### Key names ###
+
+
+def _hashed_key_name(prefix, text):
+  """Returns prefix followed by the MD5 hex digest of text.
+
+  Key names are limited to 64 characters, whereas emails, filenames and
+  search terms aren't, so they're hashed into a key name of fixed length.
+
+  Args:
+    prefix: a short str identifying the kind and any numeric ids.
+    text: the str or unicode string to hash; unicode is encoded as UTF-8.
+  """
+  if isinstance(text, unicode):
+    text = text.encode('utf-8')
+  return prefix + md5.new(text).hexdigest()
+
+
 ### Issues, PatchSets, Patches, Contents, Comments, Messages ###
 
 
@@ -82,6 +110,24 @@ class Issue(db.Model):
   private = db.BooleanProperty(default=False)
   n_comments = db.IntegerProperty()
 
+  # Note that this doesn't get called when doing multi-entity puts.
+  def put(self):
+    """Save the issue and queue updating the search index.
+
+    Updating the dashboards is queued by a post_save handler in
+    rietveld_helper, which also runs for multi-entity puts.
+    """
+    key = super(Issue, self).put()
+    enqueue_index_issue(self)
+    return key
+
+  def participants(self):
+    """Return the set of lowercased emails of owner, reviewers and CCs."""
+    emails = set([self.owner.email().lower()])
+    emails.update(email.lower() for email in self.reviewers)
+    emails.update(email.lower() for email in self.cc)
+    return emails
+
   _is_starred = None
 
   @property
@@ -97,6 +143,16 @@ class Issue(db.Model):
     """Return true if the given user has permission to edit this issue."""
     return user == self.owner
 
+  def user_can_view(self, user):
+    """Return true if the given user, None if anonymous, can see this issue."""
+    if not self.private:
+      return True
+    if user is None:
+      return False
+    email = db.Email(user.email().lower())
+    return (user == self.owner or email in self.cc or
+            email in self.reviewers)
+
   @property
   def edit_allowed(self):
     """Whether the current user can edit this issue."""
@@ -140,17 +196,14 @@ class Issue(db.Model):
   def num_drafts(self):
     """The number of draft comments on this issue for the current user.
 
-    The value is expensive to compute, so it is cached.
+    The value is read from the user's DraftCounts and cached.
     """
     if self._num_drafts is None:
       account = Account.current_user_account
       if account is None:
         self._num_drafts = 0
       else:
-        query = gql(Comment,
-            'WHERE ANCESTOR IS :1 AND author = :2 AND draft = TRUE',
-            self, account.user)
-        self._num_drafts = query.count()
+        self._num_drafts = DraftCounts.get_for(self, account.user).total
     return self._num_drafts
 
 
@@ -167,11 +220,90 @@ class PatchSet(db.Model):
   created = db.DateTimeProperty(auto_now_add=True)
   modified = db.DateTimeProperty(auto_now=True)
   n_comments = db.IntegerProperty(default=0)
+  # JSON list of [patch id, filename, comment count, delta, number of
+  # lines] ordered by filename, see get_navigation().  None when it must
+  # be rebuilt.
+  navigation = db.TextProperty()
 
   def update_comment_count(self, n):
     """Increment the n_comments property by n."""
     self.n_comments = self.num_comments + n
 
+  def get_navigation(self):
+    """Returns the patches of this patchset for navigating between files.
+
+    The list is stored with the patchset, so the diff views don't have to
+    load the patches and their comments.  It's built when missing, e.g.
+    after new patches were added (see reset_navigation()).
+
+    Returns:
+      A list of PatchNavigation instances, ordered by filename.
+    """
+    entries = None
+    if self.navigation is not None:
+      entries = simplejson.loads(self.navigation)
+      if entries and len(entries[0]) < 5:
+        entries = None  # Stored before the number of lines was kept.
+    if entries is None:
+      counts = {}
+      for comment in gql(Comment, 'WHERE ANCESTOR IS :1 AND draft = FALSE',
+                         self):
+        pkey = Comment.patch.get_value_for_datastore(comment)
+        counts[pkey] = counts.get(pkey, 0) + 1
+      entries = [[patch.key().id(), patch.filename,
+                  counts.get(patch.key(), 0), patch.delta, len(patch.lines)]
+                 for patch in gql(Patch,
+                                  'WHERE patchset = :1 ORDER BY filename',
+                                  self)]
+      navigation = db.Text(simplejson.dumps(entries))
+      db.run_in_transaction(self._store_navigation, navigation)
+      self.navigation = navigation
+    return [PatchNavigation(*entry) for entry in entries]
+
+  def _store_navigation(self, navigation):
+    """Stores a built navigation; must run in a transaction.
+
+    The stored patchset is loaded again, so that comment counts published
+    meanwhile aren't overwritten.  If it was changed since this instance
+    was loaded, the navigation may be stale and is left to be rebuilt.
+    """
+    patchset = PatchSet.get(self.key())
+    if patchset is not None and patchset.modified == self.modified:
+      patchset.navigation = navigation
+      patchset.put()
+
+  def update_navigation(self, comment_counts):
+    """Adds newly published comments to the navigation.
+
+    The caller must put() the patchset.
+
+    Args:
+      comment_counts: A dict mapping patch ids to a number of comments.
+    """
+    if self.navigation is None:
+      return
+    entries = simplejson.loads(self.navigation)
+    for entry in entries:
+      entry[2] += comment_counts.get(entry[0], 0)
+    self.navigation = db.Text(simplejson.dumps(entries))
+
+  @classmethod
+  def reset_navigation(cls, key):
+    """Makes get_navigation() rebuild the navigation of a patchset.
+
+    The patchset is loaded and put in a transaction, so that concurrent
+    updates of its comment counts aren't overwritten.
+
+    Args:
+      key: The key of the patchset.
+    """
+    def txn():
+      patchset = cls.get(key)
+      if patchset is not None:
+        patchset.navigation = None
+        patchset.put()
+    db.run_in_transaction(txn)
+
   @property
   def num_comments(self):
     """The number of non-draft comments for this issue.
@@ -183,6 +315,23 @@ class PatchSet(db.Model):
     return self.n_comments or 0
 
 
+class PatchNavigation(object):
+  """A patch as listed by PatchSet.get_navigation().
+
+  Besides the patch id it has the attributes of a Patch that the file
+  navigation uses, and the number of lines of the patch text.  num_drafts
+  is set by the views for the current user.
+  """
+
+  def __init__(self, id, filename, num_comments, delta, num_lines):
+    self.id = id
+    self.filename = filename
+    self.num_comments = num_comments
+    self.num_drafts = 0
+    self.delta = delta
+    self.num_lines = num_lines
+
+
 class Message(db.Model):
   """A copy of a message sent out in email.
 
@@ -226,6 +375,20 @@ class Content(db.Model):
   is_uploaded = db.BooleanProperty(default=False)
   is_bad = db.BooleanProperty(default=False)
   file_too_large = db.BooleanProperty(default=False)
+  # The offset after each line of text as a packed array('I'), see
+  # get_line().  None until it's first needed.
+  line_offsets = db.BlobProperty()
+
+  _offsets = None
+  # The text line_offsets were computed from in this instance.
+  _offsets_text = None
+
+  def put(self):
+    """Drop line_offsets that don't belong to the text being stored."""
+    if self.line_offsets is not None and self._offsets_text != self.text:
+      self.line_offsets = None
+      self._offsets = None
+    return super(Content, self).put()
 
   @property
   def lines(self):
@@ -234,6 +397,47 @@ class Content(db.Model):
       return []
     return self.text.splitlines(True)
 
+  def update_line_offsets(self):
+    """Compute line_offsets from the text; put() afterwards.
+
+    Returns:
+      True if line_offsets changed.
+    """
+    offsets = array.array('I')
+    end = 0
+    for line in self.lines:
+      end += len(line)
+      offsets.append(end)
+    self._offsets = offsets
+    self._offsets_text = self.text
+    blob = db.Blob(offsets.tostring())
+    if blob == self.line_offsets:
+      return False
+    self.line_offsets = blob
+    return True
+
+  def get_line(self, lineno):
+    """Return a single line of the text, without splitting all of it.
+
+    Args:
+      lineno: 1-based line number.
+
+    Returns:
+      The line including its line ending, or '' if there's no such line.
+    """
+    if self._offsets is None:
+      if self.line_offsets is None:
+        self.update_line_offsets()
+      else:
+        self._offsets = array.array('I', self.line_offsets)
+        self._offsets_text = self.text
+    if not 1 <= lineno <= len(self._offsets):
+      return ''
+    start = 0
+    if lineno > 1:
+      start = self._offsets[lineno - 2]
+    return self.text[start:self._offsets[lineno - 1]]
+
 
 class Patch(db.Model):
   """A single patch, i.e. a set of changes to a single file.
@@ -248,6 +452,7 @@ class Patch(db.Model):
   content = db.ReferenceProperty(Content)
   patched_content = db.ReferenceProperty(Content, collection_name='patch2_set')
   is_binary = db.BooleanProperty(default=False)
+  n_comments = db.IntegerProperty()
   # Ids of patchsets that have a different version of this file.
   delta = db.ListProperty(int)
   delta_calculated = db.BooleanProperty(default=False)
@@ -275,10 +480,12 @@ class Patch(db.Model):
   def property_changes(self):
     """The property changes split into lines.
 
-    The value is cached.
+    The value is cached once the diff exists, see _generate_diff().
     """
     if self._property_changes != None:
       return self._property_changes
+    if self.text is None:
+      return []
     self._property_changes = []
     match = re.search('^Property changes on.*\n'+'_'*67+'$', self.text,
                       re.MULTILINE)
@@ -292,9 +499,11 @@ class Patch(db.Model):
   def num_added(self):
     """The number of line additions in this patch.
 
-    The value is cached.
+    The value is cached once the diff exists.
     """
     if self._num_added is None:
+      if self.text is None:
+        return 0
       self._num_added = self.count_startswith('+') - 1
     return self._num_added
 
@@ -304,9 +513,11 @@ class Patch(db.Model):
   def num_removed(self):
     """The number of line removals in this patch.
 
-    The value is cached.
+    The value is cached once the diff exists.
     """
     if self._num_removed is None:
+      if self.text is None:
+        return 0
       self._num_removed = self.count_startswith('-') - 1
     return self._num_removed
 
@@ -318,25 +529,38 @@ class Patch(db.Model):
 
     A chunk is a block of lines starting with '@@'.
 
-    The value is cached.
+    The value is cached once the diff exists.
     """
     if self._num_chunks is None:
+      if self.text is None:
+        return 0
       self._num_chunks = self.count_startswith('@@')
     return self._num_chunks
 
-  _num_comments = None
+  def update_comment_count(self, n):
+    """Increment the n_comments property by n.
+
+    If n_comments is None it's counted first, like for Issue.
+    """
+    if self.n_comments is None:
+      self.n_comments = self._get_num_comments()
+    self.n_comments += n
 
   @property
   def num_comments(self):
     """The number of non-draft comments for this patch.
 
-    The value is cached.
+    This is self.n_comments.  For patches stored before it was kept it's
+    counted through a query once and stored.
     """
-    if self._num_comments is None:
-      self._num_comments = gql(Comment,
-                               'WHERE patch = :1 AND draft = FALSE',
-                               self).count()
-    return self._num_comments
+    if self.n_comments is None:
+      self.n_comments = db.run_in_transaction(_store_comment_count,
+                                              self.key())
+    return self.n_comments
+
+  def _get_num_comments(self):
+    """Helper to compute the number of comments through a query."""
+    return gql(Comment, 'WHERE patch = :1 AND draft = FALSE', self).count()
 
   _num_drafts = None
 
@@ -344,17 +568,16 @@ class Patch(db.Model):
   def num_drafts(self):
     """The number of draft comments on this patch for the current user.
 
-    The value is expensive to compute, so it is cached.
+    The value is read from the user's DraftCounts and cached.
     """
     if self._num_drafts is None:
       account = Account.current_user_account
       if account is None:
         self._num_drafts = 0
       else:
-        query = gql(Comment,
-                    'WHERE patch = :1 AND draft = TRUE AND author = :2',
-                    self, account.user)
-        self._num_drafts = query.count()
+        drafts = DraftCounts.get_for(self.patchset.issue, account.user)
+        counts = drafts.get_patch_counts(self.patchset.key().id())
+        self._num_drafts = counts.get(self.key().id(), 0)
     return self._num_drafts
 
   def count_startswith(self, prefix):
@@ -395,9 +618,11 @@ class Patch(db.Model):
     return content
 
   def get_patched_content(self):
-    """Get self.patched_content, computing it if necessary.
+    """Get self.patched_content, or compute it if necessary.
 
-    This is the content of the file after applying this patch.
+    This is the content of the file after applying this patch.  It's
+    normally stored by materialize_patched_content() right after the base
+    content arrives; until then it's computed without being stored.
 
     Returns:
       a Content instance.
@@ -411,18 +636,75 @@ class Patch(db.Model):
     except db.Error:
       # This may happen when a Content entity was deleted behind our back.
       self.patched_content = None
+    return Content(text=self.compute_patched_text(), parent=self)
 
+  def compute_patched_text(self):
+    """Applies this patch to its base content.
+
+    Returns:
+      The new text as a db.Text.
+
+    Raises:
+      engine.FetchError: If there was a problem fetching the old content.
+    """
     old_lines = self.get_content().text.splitlines(True)
-    logging.info('Creating patched_content for %s', self.filename)
     chunks = patching.ParsePatchToChunks(self.lines, self.filename)
     new_lines = []
     for tag, old, new in patching.PatchChunks(old_lines, chunks):
       new_lines.extend(new)
-    text = db.Text(''.join(new_lines))
-    patched_content = Content(text=text, parent=self)
-    patched_content.put()
+    return db.Text(''.join(new_lines))
+
+  def materialize_patched_content(self):
+    """Stores self.patched_content unless it's already there.
+
+    Called by a task once the base content is available, see
+    views._materialize_patched_contents().  Calling it again does nothing.
+
+    Returns:
+      True if patched content was stored.
+
+    Raises:
+      engine.FetchError: If there was a problem fetching the old content.
+    """
+    try:
+      if self.patched_content is not None:
+        return False
+    except db.Error:
+      self.patched_content = None
+    if self.is_binary or self.text is None:
+      # Binary files upload their new content, for server side diffs the
+      # patch doesn't exist yet.
+      return False
+    logging.info('Creating patched_content for %s', self.filename)
+    text = self.compute_patched_text()
+    patched_content = db.run_in_transaction(self._store_patched_content, text)
+    if patched_content is None:
+      return False
     self.patched_content = patched_content
-    self.put()
+    return True
+
+  def _store_patched_content(self, text):
+    """Stores text as patched_content; must run in a transaction.
+
+    The patch is loaded again, so that content uploaded meanwhile (see
+    views.upload_content()) is kept.
+
+    Returns:
+      The new Content, or None if the patch has patched_content already.
+    """
+    patch = Patch.get(self.key())
+    if patch is None:
+      return None
+    try:
+      if patch.patched_content is not None:
+        return None
+    except db.Error:
+      pass
+    patched_content = Content(text=text, parent=patch)
+    patched_content.update_line_offsets()
+    patched_content.put()
+    patch.patched_content = patched_content
+    patch.put()
     return patched_content
 
   @property
@@ -431,6 +713,136 @@ class Patch(db.Model):
     return self.content and self.content.file_too_large
 
 
+class DeltaIndex(db.Model):
+  """The digest of one file of one patchset of an issue.
+
+  This is a descendant of an Issue, with the key name from key_name_for().
+  There's one entry per Patch, so Patch.delta can be calculated by
+  comparing digests without loading the text of earlier patches, and
+  concurrent uploads each write their own entries.
+  """
+
+  patchset_id = db.IntegerProperty(required=True)
+  filename = db.StringProperty(required=True)
+  digest = db.StringProperty(required=True)
+
+  @staticmethod
+  def key_name_for(patchset_id, filename):
+    """Returns the key name of the entry of a file in a patchset."""
+    return _hashed_key_name('f%d:' % patchset_id, filename)
+
+  @classmethod
+  def add(cls, issue, patchset_id, file_digests, complete=False):
+    """Adds the (filename, digest) pairs of a patchset's files.
+
+    Files already in the index for that patchset get the new digest.
+
+    Args:
+      issue: The issue the patchset belongs to.
+      patchset_id: The id of the patchset.
+      file_digests: A list of (filename, digest) pairs.
+      complete: True if all files of the patchset are in the index now.
+    """
+    for filename, digest in file_digests:
+      entry = cls.get_or_insert(cls.key_name_for(patchset_id, filename),
+                                parent=issue, patchset_id=patchset_id,
+                                filename=filename, digest=digest)
+      if entry.digest != digest:
+        entry.digest = digest
+        entry.put()
+    if complete:
+      DeltaIndexPatchSet.get_or_insert('p%d' % patchset_id, parent=issue,
+                                       patchset_id=patchset_id)
+
+  @classmethod
+  def get_filenames(cls, issue, patchset_id):
+    """Returns the set of filenames of a patchset in the index."""
+    return set(entry.filename for entry in
+               gql(cls, 'WHERE ANCESTOR IS :1 AND patchset_id = :2',
+                   issue, patchset_id))
+
+  @staticmethod
+  def get_complete(issue, patchset_ids):
+    """Returns the set of the given patchset ids with all files indexed."""
+    markers = DeltaIndexPatchSet.get_by_key_name(
+        ['p%d' % patchset_id for patchset_id in patchset_ids], parent=issue)
+    return set(marker.patchset_id for marker in markers if marker is not None)
+
+  @classmethod
+  def get_digests(cls, issue, filenames):
+    """Returns {filename: {patchset id: digest}} for the given filenames."""
+    digests = {}
+    for entry in gql(cls, 'WHERE ANCESTOR IS :1', issue):
+      if entry.filename in filenames:
+        digests.setdefault(entry.filename, {})[entry.patchset_id] = (
+            entry.digest)
+    return digests
+
+  @classmethod
+  def remove_patchset(cls, issue, patchset_id):
+    """Removes all files of a patchset."""
+    tbd = list(gql(cls, 'WHERE ANCESTOR IS :1 AND patchset_id = :2',
+                   issue, patchset_id))
+    marker = DeltaIndexPatchSet.get_by_key_name('p%d' % patchset_id,
+                                                parent=issue)
+    if marker is not None:
+      tbd.append(marker)
+    db.delete(tbd)
+
+
+class DeltaIndexPatchSet(db.Model):
+  """Marks a patchset all of whose files are in the DeltaIndex.
+
+  This is a descendant of an Issue; the key name is 'p<patchset id>'.
+  A file of such a patchset that isn't in the index isn't in the patchset
+  either, so it needs no query to find out.
+  """
+
+  patchset_id = db.IntegerProperty(required=True)
+
+
+class ContentChecksum(db.Model):
+  """Points from the checksum of uploaded data to a Content holding it.
+
+  Lets upload.py skip files the server already has in any issue, see
+  views.reuse_content().  The key name is 'c' + the MD5 of the data.
+  """
+
+  content = db.ReferenceProperty(Content)
+  is_binary = db.BooleanProperty(default=False)
+
+  @classmethod
+  def register(cls, content, is_binary):
+    """Records a Content entity with uploaded data and a valid checksum."""
+    cls.get_or_insert('c' + content.checksum, content=content,
+                      is_binary=is_binary)
+
+  @classmethod
+  def get_contents(cls, checksums):
+    """Look up uploaded data by checksum.
+
+    Returns:
+      A dict mapping the checksums that were found to (Content, is_binary).
+    """
+    checksums = list(set(checksums))
+    if not checksums:
+      return {}
+    found = cls.get_by_key_name(['c' + checksum for checksum in checksums])
+    contents = {}
+    for checksum, entry in zip(checksums, found):
+      if entry is None:
+        continue
+      try:
+        content = entry.content
+      except db.Error:
+        # The content was deleted together with its issue.
+        content = None
+      if content is None or content.is_bad or content.file_too_large:
+        continue
+      contents[checksum] = (content, entry.is_binary)
+    return contents
+
+
 class Comment(db.Model):
   """A Comment for a specific line of a specific file.
 
@@ -504,6 +916,234 @@ class Bucket(db.Model):
   quoted = db.BooleanProperty()
 
 
+class DraftCounts(db.Model):
+  """The number of draft comments of a user on each patch of an issue.
+
+  This is a descendant of an Issue, with the key name from key_name_for().
+  It's updated when drafts are saved and published, so the diff views
+  don't have to count drafts.  The lists are parallel: the user has
+  counts[i] drafts on patch patch_ids[i] of patchset patchset_ids[i].
+  """
+
+  user = db.UserProperty()
+  patchset_ids = db.ListProperty(int)
+  patch_ids = db.ListProperty(int)
+  counts = db.ListProperty(int)
+
+  @staticmethod
+  def key_name_for(issue, user):
+    """Returns the key name for the drafts of a user on an issue."""
+    return _hashed_key_name('d%d:' % issue.key().id(),
+                            user.email().lower())
+
+  @classmethod
+  def get_for(cls, issue, user):
+    """Returns the draft counts of a user on an issue.
+
+    They're only stored once the user has drafts, viewing an issue doesn't
+    store anything.  Drafts saved before draft counts existed are counted
+    once if the user's DraftIndex lists the issue.
+    """
+    key_name = cls.key_name_for(issue, user)
+    counts = cls.get_by_key_name(key_name, parent=issue)
+    if counts is not None:
+      return counts
+    counts = cls(key_name=key_name, parent=issue, user=user)
+    if issue.key().id() not in DraftIndex.get_for_user(user).issue_ids:
+      return counts
+    query = gql(Comment,
+                'WHERE ANCESTOR IS :1 AND author = :2 AND draft = TRUE',
+                issue, user)
+    for comment in query:
+      patch = comment.patch
+      counts.add(patch.patchset.key().id(), patch.key().id(), 1)
+    if not counts.total:
+      return counts
+    # Concurrent first views count the same drafts, the first one stores.
+    return cls.get_or_insert(key_name, parent=issue, user=user,
+                             patchset_ids=counts.patchset_ids,
+                             patch_ids=counts.patch_ids, counts=counts.counts)
+
+  @classmethod
+  def update(cls, issue, user, patchset_id, patch_id, n):
+    """Adds n drafts of a user on a patch; must run in a transaction."""
+    counts = cls.get_for(issue, user)
+    counts.add(patchset_id, patch_id, n)
+    counts.put()
+
+  def add(self, patchset_id, patch_id, n):
+    """Adds n (which may be negative) drafts on a patch; put() afterwards."""
+    for i in xrange(len(self.patch_ids)):
+      if (self.patchset_ids[i] == patchset_id and
+          self.patch_ids[i] == patch_id):
+        self.counts[i] += n
+        if self.counts[i] <= 0:
+          del self.patchset_ids[i]
+          del self.patch_ids[i]
+          del self.counts[i]
+        return
+    if n > 0:
+      self.patchset_ids.append(patchset_id)
+      self.patch_ids.append(patch_id)
+      self.counts.append(n)
+
+  def remove_patchset(self, patchset_id):
+    """Forgets the drafts on a deleted patchset; put() afterwards.
+
+    Returns:
+      True if there were any.
+    """
+    keep = [i for i in xrange(len(self.patch_ids))
+            if self.patchset_ids[i] != patchset_id]
+    if len(keep) == len(self.patch_ids):
+      return False
+    self.patchset_ids = [self.patchset_ids[i] for i in keep]
+    self.patch_ids = [self.patch_ids[i] for i in keep]
+    self.counts = [self.counts[i] for i in keep]
+    return True
+
+  def clear(self):
+    """Forgets all drafts, e.g. after they were published; put() afterwards."""
+    self.patchset_ids = []
+    self.patch_ids = []
+    self.counts = []
+
+  @property
+  def total(self):
+    """The number of drafts on the issue."""
+    return sum(self.counts)
+
+  def get_patch_counts(self, patchset_id):
+    """Returns a dict mapping the patch ids of a patchset to draft counts."""
+    return dict((self.patch_ids[i], self.counts[i])
+                for i in xrange(len(self.patch_ids))
+                if self.patchset_ids[i] == patchset_id)
+
+
+# Comment counts are reconciled this long after comments were changed.
+RECONCILE_COUNTS_DELAY = 10 * 60
+
+
+def enqueue_reconcile_counts(issue):
+  """Queues reconcile_counts() for an issue, at most once per hour."""
+  try:
+    deferred.defer(reconcile_counts, issue.key().id(),
+                   _name='reconcile-counts-%d-%d' % (issue.key().id(),
+                                                     time.time() // 3600),
+                   _countdown=RECONCILE_COUNTS_DELAY)
+  except taskqueue.TaskAlreadyExistsError:
+    pass
+
+
+def _store_comment_count(key):
+  """Counts the published comments of an entity and stores the number.
+
+  Must run in a transaction, so that comments published meanwhile, which
+  update n_comments in their own transactions, aren't lost.
+
+  Args:
+    key: The key of an Issue, PatchSet or Patch.
+
+  Returns:
+    The number of comments.
+  """
+  entity = db.get(key)
+  if entity is None:
+    return 0
+  if isinstance(entity, Patch):
+    n = gql(Comment, 'WHERE patch = :1 AND draft = FALSE', entity).count()
+  else:
+    n = gql(Comment, 'WHERE ANCESTOR IS :1 AND draft = FALSE',
+            entity).count()
+  if entity.n_comments != n:
+    logging.info('%s %s: %s comments, not %s',
+                 key.kind(), key.id(), n, entity.n_comments)
+    entity.n_comments = n
+    if isinstance(entity, PatchSet):
+      entity.navigation = None
+    entity.put()
+  return n
+
+
+def _store_draft_counts(issue, key, patch_keys):
+  """Counts the drafts of the user of a DraftCounts and stores them.
+
+  Must run in a transaction, like _store_comment_count().
+
+  Args:
+    issue: The issue of the DraftCounts.
+    key: The key of the DraftCounts.
+    patch_keys: The keys of all patches of the issue.
+
+  Returns:
+    True if the user has drafts on the issue.
+  """
+  draft_counts = db.get(key)
+  if draft_counts is None:
+    return False
+  counts = {}  # Maps (patchset id, patch id) to a number of drafts.
+  for comment in gql(Comment,
+                     'WHERE ANCESTOR IS :1 AND author = :2 AND draft = TRUE',
+                     issue, draft_counts.user):
+    pkey = Comment.patch.get_value_for_datastore(comment)
+    if pkey in patch_keys:
+      entry = (pkey.parent().id(), pkey.id())
+      counts[entry] = counts.get(entry, 0) + 1
+  entries = sorted(counts.iteritems())
+  if (sorted(zip(draft_counts.patchset_ids, draft_counts.patch_ids,
+                 draft_counts.counts)) !=
+      [(ps_id, patch_id, n) for (ps_id, patch_id), n in entries]):
+    logging.info('Fixing draft counts of %s on issue %s',
+                 draft_counts.user.email(), issue.key().id())
+    draft_counts.clear()
+    for (ps_id, patch_id), n in entries:
+      draft_counts.add(ps_id, patch_id, n)
+    draft_counts.put()
+  return bool(entries)
+
+
+def reconcile_counts(issue_id):
+  """Task counting the comments and drafts of an issue again.
+
+  The counters (Issue, PatchSet and Patch n_comments, the patchset
+  navigation and DraftCounts) are updated along with the comments.  This
+  corrects them if a request failed halfway.  The comments are read once
+  to find the wrong counters; each of those is counted again and stored
+  in a transaction.
+  """
+  issue = Issue.get_by_id(issue_id)
+  if issue is None:
+    return
+  comments = {}  # Maps patch keys to the number of published comments.
+  for comment in gql(Comment, 'WHERE ANCESTOR IS :1 AND draft = FALSE',
+                     issue):
+    pkey = Comment.patch.get_value_for_datastore(comment)
+    comments[pkey] = comments.get(pkey, 0) + 1
+  wrong = []  # Keys of entities whose n_comments is wrong.
+  total = 0
+  patch_keys = set()
+  for patchset in list(issue.patchset_set):
+    n_patchset = 0
+    for patch in list(patchset.patch_set):
+      patch_keys.add(patch.key())
+      n = comments.get(patch.key(), 0)
+      n_patchset += n
+      if patch.n_comments != n:
+        wrong.append(patch.key())
+    total += n_patchset
+    if patchset.n_comments != n_patchset:
+      wrong.append(patchset.key())
+  if issue.n_comments != total:
+    wrong.append(issue.key())
+  for key in wrong:
+    db.run_in_transaction(_store_comment_count, key)
+  for draft_counts in list(gql(DraftCounts, 'WHERE ANCESTOR IS :1', issue)):
+    has_drafts = db.run_in_transaction(_store_draft_counts, issue,
+                                       draft_counts.key(), patch_keys)
+    db.run_in_transaction(DraftIndex.update, draft_counts.user, issue_id,
+                          has_drafts)
+
+
 ### Repositories and Branches ###
 
 
@@ -579,6 +1219,8 @@ class Account(db.Model):
     self.lower_email = str(self.email).lower()
     self.lower_nickname = self.nickname.lower()
     super(Account, self).put()
+    # The nickname may have changed, see library.get_nicknames().
+    memcache.delete('nickname:' + self.email.lower())
 
   @classmethod
   def get_account_for_user(cls, user):
@@ -637,7 +1279,11 @@ class Account(db.Model):
 
   @classmethod
   def get_multiple_accounts_by_email(cls, emails):
-    """Get multiple accounts.  Returns a dict by email."""
+    """Get multiple accounts.  Returns a dict by email.
+
+    Accounts are also found by the lowercase version of each email, and
+    returned under their own email then.
+    """
     results = {}
     keys = []
     for email in emails:
@@ -645,6 +1291,8 @@ class Account(db.Model):
         results[email] = cls.current_user_account
       else:
         keys.append('<%s>' % email)
+        if email.lower() != email:
+          keys.append('<%s>' % email.lower())
     if keys:
       accounts = cls.get_by_key_name(keys)
       for account in accounts:
@@ -713,11 +1361,10 @@ class Account(db.Model):
   def drafts(self):
     """A list of issue ids that have drafts by this user.
 
-    This is cached in memcache.
+    This is read from the user's DraftIndex and cached.
     """
     if self._drafts is None:
-      if self._initialize_drafts():
-        self._save_drafts()
+      self._drafts = DraftIndex.get_for_user(self.user).issue_ids
     return self._drafts
 
   def update_drafts(self, issue, have_drafts=None):
@@ -726,54 +1373,14 @@ class Account(db.Model):
     Args:
       issue: an Issue instance.
       have_drafts: optional bool forcing the draft status.  By default,
-          issue.num_drafts is inspected (which may query the datastore).
+          issue.num_drafts is inspected (which reads the DraftCounts).
 
-    The Account is written to the datastore if necessary.
+    The DraftIndex is written to the datastore if necessary.
     """
-    dirty = False
-    if self._drafts is None:
-      dirty = self._initialize_drafts()
-    id = issue.key().id()
     if have_drafts is None:
-      have_drafts = bool(issue.num_drafts)  # Beware, this may do a query.
-    if have_drafts:
-      if id not in self._drafts:
-        self._drafts.append(id)
-        dirty = True
-    else:
-      if id in self._drafts:
-        self._drafts.remove(id)
-        dirty = True
-    if dirty:
-      self._save_drafts()
-
-  def _initialize_drafts(self):
-    """Initialize self._drafts from scratch.
-
-    This mostly exists as a schema conversion utility.
-
-    Returns:
-      True if the user should call self._save_drafts(), False if not.
-    """
-    drafts = memcache.get('user_drafts:' + self.email)
-    if drafts is not None:
-      self._drafts = drafts
-      ##logging.info('HIT: %s -> %s', self.email, self._drafts)
-      return False
-    # We're looking for the Issue key id.  The ancestry of comments goes:
-    # Issue -> PatchSet -> Patch -> Comment.
-    issue_ids = set(comment.key().parent().parent().parent().id()
-                    for comment in gql(Comment,
-                                       'WHERE author = :1 AND draft = TRUE',
-                                       self.user))
-    self._drafts = list(issue_ids)
-    ##logging.info('INITIALIZED: %s -> %s', self.email, self._drafts)
-    return True
-
-  def _save_drafts(self):
-    """Save self._drafts to memcache."""
-    ##logging.info('SAVING: %s -> %s', self.email, self._drafts)
-    memcache.set('user_drafts:' + self.email, self._drafts, 3600)
+      have_drafts = bool(issue.num_drafts)
+    self._drafts = db.run_in_transaction(DraftIndex.update, self.user,
+                                         issue.key().id(), have_drafts)
 
   def get_xsrf_token(self, offset=0):
     """Return an XSRF token for the current user."""
@@ -797,3 +1404,832 @@ class Account(db.Model):
     when = int(time.time()) // 3600 + offset
     m.update(str(when))
     return m.hexdigest()
+
+
+### Dashboards ###
+
+
+DASHBOARD_LIMIT = 100  # Issues per list and page
+# Dashboards are updated this long after an issue was saved; all saves
+# within the same period are handled by one task.
+DASHBOARD_UPDATE_DELAY = 10
+RECENTLY_CLOSED_DAYS = 7
+
+
+class DashboardEntry(db.Model):
+  """One issue on one of the lists of a user's dashboard (/mine, /user/<x>).
+
+  The key name is from key_name_for(), so there's one entry per issue, list
+  and user.  Saving an issue queues update_dashboards(), which only touches
+  the entries of that issue, hence updates for different issues can't undo
+  each other.  A
+  list is read a page at a time with one query ordered by Issue.modified.
+  """
+
+  email = db.EmailProperty(required=True)  # Lowercased
+  list_name = db.StringProperty(required=True)  # One of LISTS
+  issue_id = db.IntegerProperty(required=True)
+  modified = db.DateTimeProperty(required=True)  # Issue.modified
+
+  # Open issues owned by, reviewable by and CC'd to the user, closed issues
+  # owned by the user.
+  LISTS = ('mine', 'reviews', 'cc', 'closed')
+
+  @staticmethod
+  def key_name_for(issue_id, list_name, email):
+    """Returns the key name of the entry of an issue on a user's list."""
+    return _hashed_key_name('q%d:%s:' % (issue_id, list_name), email.lower())
+
+  @staticmethod
+  def get_lists_for_issue(issue):
+    """Returns the set of (list name, lowercased email) an issue is on."""
+    owner = issue.owner.email().lower()
+    if issue.closed:
+      return set([('closed', owner)])
+    lists = set([('mine', owner)])
+    lists.update(('reviews', email.lower()) for email in issue.reviewers
+                 if email.lower() != owner)
+    lists.update(('cc', email.lower()) for email in issue.cc
+                 if email.lower() != owner)
+    return lists
+
+  @classmethod
+  def update_for_issue(cls, issue):
+    """Brings the entries of an issue in line with its users and state.
+
+    The entries of users who were removed from the issue are deleted, the
+    others are created or moved to the issue's modification time.
+    """
+    issue_id = issue.key().id()
+    lists = cls.get_lists_for_issue(issue)
+    entries = {}
+    for entry in list(gql(cls, 'WHERE issue_id = :1', issue_id)):
+      if (entry.list_name, entry.email) in lists:
+        entries[entry.list_name, entry.email] = entry
+      else:
+        entry.delete()
+    for list_name, email in lists:
+      entry = entries.get((list_name, email))
+      if entry is None:
+        entry = cls.get_or_insert(cls.key_name_for(issue_id, list_name, email),
+                                  email=email, list_name=list_name,
+                                  issue_id=issue_id, modified=issue.modified)
+      if entry.modified != issue.modified:
+        entry.modified = issue.modified
+        entry.put()
+
+  @classmethod
+  def remove_issue(cls, issue_id):
+    """Removes an issue from the dashboards of all its users."""
+    db.delete(list(gql(cls, 'WHERE issue_id = :1', issue_id)))
+
+  @classmethod
+  def get_issues(cls, user, offsets=None, limit=DASHBOARD_LIMIT):
+    """Loads a page of each of a user's lists with one batch get of issues.
+
+    Args:
+      user: the User whose dashboard is shown.
+      offsets: a dict mapping names in LISTS to the number of issues of that
+        list on the previous pages; missing lists start at 0.
+      limit: the maximum number of issues of each list on this page.
+
+    Returns:
+      A tuple (lists, next_offsets).  lists is a dict mapping each name in
+      LISTS to a list of Issue instances, newest first; closed issues are
+      limited to the ones modified in the last RECENTLY_CLOSED_DAYS days.
+      next_offsets are the offsets of the next page, or None if no list
+      continues on the next page.
+    """
+    if offsets is None:
+      offsets = {}
+    email = user.email().lower()
+    recently = (datetime.datetime.now() -
+                datetime.timedelta(days=RECENTLY_CLOSED_DAYS))
+    more = False
+    lists = {}
+    next_offsets = {}
+    for list_name in cls.LISTS:
+      offset = offsets.get(list_name, 0)
+      if list_name == 'closed':
+        query = gql(cls, 'WHERE email = :1 AND list_name = :2 '
+                    'AND modified > :3 ORDER BY modified DESC',
+                    email, list_name, recently)
+      else:
+        query = gql(cls, 'WHERE email = :1 AND list_name = :2 '
+                    'ORDER BY modified DESC',
+                    email, list_name)
+      ids = [entry.issue_id for entry in query.fetch(limit + 1, offset)]
+      if len(ids) > limit:
+        more = True
+        del ids[limit:]
+      lists[list_name] = ids
+      next_offsets[list_name] = offset + len(ids)
+    issue_ids = set()
+    for ids in lists.itervalues():
+      issue_ids.update(ids)
+    issues = {}
+    if issue_ids:
+      for issue in Issue.get_by_id(list(issue_ids)):
+        if issue is not None:
+          issues[issue.key().id()] = issue
+    result = dict((list_name, [issues[i] for i in ids if i in issues])
+                  for list_name, ids in lists.iteritems())
+    if not more:
+      next_offsets = None
+    return result, next_offsets
+
+
+def enqueue_dashboard_update(issue):
+  """Queues update_dashboards() to run at the end of the current period."""
+  issue_id = issue.key().id()
+  window = int(time.time() // DASHBOARD_UPDATE_DELAY)
+  try:
+    deferred.defer(update_dashboards, issue_id,
+                   _name='dashboard-%d-%d' % (issue_id, window),
+                   _countdown=(window + 1) * DASHBOARD_UPDATE_DELAY -
+                   time.time())
+  except taskqueue.TaskAlreadyExistsError:
+    pass
+
+
+def update_dashboards(issue_id):
+  """Task bringing the dashboard entries of an issue up to date.
+
+  The issue is loaded when the task runs, so one run covers all saves
+  queued before it, and entries of a deleted issue are removed.
+  """
+  issue = Issue.get_by_id(issue_id)
+  if issue is None:
+    DashboardEntry.remove_issue(issue_id)
+  else:
+    DashboardEntry.update_for_issue(issue)
+
+
+def build_dashboards(since=None, batch_size=50):
+  """Task creating the dashboard entries of every issue.
+
+  Issues that weren't saved since dashboard entries exist only show up on
+  dashboards after this ran.  Each run handles batch_size issues created
+  after 'since' and queues the next run.  Start it once with
+  deferred.defer(models.build_dashboards).
+  """
+  if since is None:
+    query = gql(Issue, 'ORDER BY created')
+  else:
+    query = gql(Issue, 'WHERE created > :1 ORDER BY created', since)
+  issues = query.fetch(batch_size)
+  for issue in issues:
+    DashboardEntry.update_for_issue(issue)
+  if len(issues) == batch_size:
+    deferred.defer(build_dashboards, issues[-1].created, batch_size)
+
+
+class DraftIndex(db.Model):
+  """The ids of the issues on which a user has draft comments.
+
+  The key name is from key_name_for_email().  It's updated through
+  Account.update_drafts() whenever drafts are saved, deleted or published,
+  so the dashboards don't have to look at the user's draft comments.
+  """
+
+  email = db.EmailProperty(required=True)
+  issue_ids = db.ListProperty(int)
+
+  @staticmethod
+  def key_name_for_email(email):
+    """Returns the key name of the DraftIndex of an email address."""
+    return _hashed_key_name('x', email.lower())
+
+  @classmethod
+  def get_for_user(cls, user):
+    """Get the DraftIndex for a user, building it from a query if needed."""
+    email = user.email().lower()
+    key_name = cls.key_name_for_email(email)
+    index = cls.get_by_key_name(key_name)
+    if index is not None:
+      return index
+    # This is a transitional strategy for users whose index has never been
+    # used; from now on it's kept current.  The ancestry of comments goes:
+    # Issue -> PatchSet -> Patch -> Comment, walk it once per patch.
+    patch_keys = set(Comment.patch.get_value_for_datastore(comment)
+                     for comment in gql(Comment,
+                                        'WHERE author = :1 AND draft = TRUE',
+                                        user))
+    issue_ids = set(key.parent().parent().id() for key in patch_keys)
+    return cls.get_or_insert(key_name, email=email,
+                             issue_ids=sorted(issue_ids))
+
+  @classmethod
+  def update(cls, user, issue_id, have_drafts):
+    """Add or remove an issue id; must run in a transaction.
+
+    Returns:
+      The list of issue ids.
+    """
+    index = cls.get_for_user(user)
+    if have_drafts and issue_id not in index.issue_ids:
+      index.issue_ids.append(issue_id)
+      index.put()
+    elif not have_drafts and issue_id in index.issue_ids:
+      index.issue_ids.remove(issue_id)
+      index.put()
+    return index.issue_ids
+
+
+### Base file cache ###
+
+BASE_FILE_CACHE_MAX_SIZE = 256 * 1024 * 1024  # Characters of text
+# BaseFile.last_used is only updated this often to save writes.
+BASE_FILE_TOUCH_INTERVAL = datetime.timedelta(days=1)
+
+
+class BaseFile(db.Model):
+  """A base file fetched at a fixed revision, shared by all issues.
+
+  Files at a fixed revision never change, so each one only needs to be
+  fetched once.  The key name is 'b' + the MD5 of the normalized URL.
+  The least recently used files are evicted when the total size exceeds
+  BASE_FILE_CACHE_MAX_SIZE, see evict_base_files().
+  """
+
+  url = db.TextProperty()
+  text = db.TextProperty()
+  size = db.IntegerProperty(default=0)
+  last_used = db.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def normalize_url(url):
+    """Normalize a URL so that equivalent URLs share a cache entry."""
+    scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+    scheme = scheme.lower()
+    netloc = netloc.lower()
+    if ((scheme == 'http' and netloc.endswith(':80')) or
+        (scheme == 'https' and netloc.endswith(':443'))):
+      netloc = netloc.rsplit(':', 1)[0]
+    path = re.sub('/{2,}', '/', path) or '/'
+    query = '&'.join(sorted(part for part in query.split('&') if part))
+    return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+  @classmethod
+  def key_name_for_url(cls, url):
+    return _hashed_key_name('b', cls.normalize_url(url))
+
+  @classmethod
+  def get_texts(cls, urls):
+    """Look up cached base files.
+
+    Returns:
+      A dict mapping the URLs that were found to their text.
+    """
+    urls = list(urls)
+    if not urls:
+      return {}
+    found = cls.get_by_key_name([cls.key_name_for_url(url) for url in urls])
+    stale = datetime.datetime.now() - BASE_FILE_TOUCH_INTERVAL
+    texts = {}
+    touched = []
+    for url, base_file in zip(urls, found):
+      if base_file is None:
+        continue
+      texts[url] = base_file.text
+      if base_file.last_used < stale:
+        base_file.last_used = datetime.datetime.now()
+        touched.append(base_file)
+    if touched:
+      db.put(touched)
+    return texts
+
+  @classmethod
+  def store(cls, url, text):
+    """Add a fetched base file to the cache."""
+    key_name = cls.key_name_for_url(url)
+    size = len(text or '')
+
+    def txn():
+      if cls.get_by_key_name(key_name) is not None:
+        return False
+      cls(key_name=key_name, url=db.Text(url), text=text, size=size).put()
+      return True
+    # Only the request that stored the file adds its size.
+    if not db.run_in_transaction(txn):
+      return
+    total = BaseFileCacheSize.add(size)
+    if total > BASE_FILE_CACHE_MAX_SIZE:
+      # One eviction per minute is enough.
+      try:
+        deferred.defer(evict_base_files,
+                       _name='evict-base-files-%d' % (time.time() // 60))
+      except taskqueue.TaskAlreadyExistsError:
+        pass
+
+
+class BaseFileCacheSize(db.Model):
+  """A shard of the total size of all BaseFile entities.
+
+  The key names are 'size0' up to 'size<SHARDS - 1>'.  Each addition goes
+  to a random shard, so concurrent stores rarely update the same entity.
+  The shard is updated with a single UPDATE statement, so additions to the
+  same shard aren't lost either.
+  """
+
+  total = db.IntegerProperty(default=0)
+
+  SHARDS = 20
+
+  @classmethod
+  def add(cls, delta):
+    """Add to the total.  Returns the new total."""
+    shard = cls.get_or_insert('size%d' % random.randrange(cls.SHARDS))
+    cls.objects.filter(pk=shard.pk).update(total=F('total') + delta)
+    return cls.get_total()
+
+  @classmethod
+  def get_total(cls):
+    """Returns the sum of all shards."""
+    return max(0, sum(shard.total for shard in cls.all()))
+
+
+def evict_base_files():
+  """Task deleting the least recently used BaseFiles.
+
+  Files are deleted until the cache is at 90% of BASE_FILE_CACHE_MAX_SIZE.
+  """
+  excess = BaseFileCacheSize.get_total() - BASE_FILE_CACHE_MAX_SIZE * 9 / 10
+  while excess > 0:
+    batch = BaseFile.all().order('last_used').fetch(50)
+    if not batch:
+      break
+    freed = sum(base_file.size for base_file in batch)
+    db.delete(batch)
+    BaseFileCacheSize.add(-freed)
+    excess -= freed
+    logging.info('Evicted %d base files (%d characters)', len(batch), freed)
+
+
+### Resumable uploads ###
+
+UPLOAD_SESSION_MAX_SIZE = 64 * 1024 * 1024
+UPLOAD_CHUNK_MAX_SIZE = 1024 * 1024
+# Sessions are deleted this long after they were started.
+UPLOAD_SESSION_LIFETIME = datetime.timedelta(days=1)
+
+
+class UploadSession(db.Model):
+  """A file uploaded by upload.py in chunks, see views.upload_session().
+
+  The chunks are UploadChunk children.  An interrupted upload is resumed
+  by starting a session with the same owner, size and checksum again, so
+  this also works after upload.py was restarted.
+  """
+
+  owner = db.UserProperty(required=True)
+  size = db.IntegerProperty(required=True)
+  checksum = db.StringProperty(required=True)
+  # Number of bytes received without gaps from the start.
+  received = db.IntegerProperty(default=0)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+  @classmethod
+  def get_or_start(cls, owner, size, checksum):
+    """Returns the session for a file, started now unless it exists."""
+    since = datetime.datetime.now() - UPLOAD_SESSION_LIFETIME
+    session = cls.gql('WHERE owner = :1 AND size = :2 AND checksum = :3 '
+                      'AND created > :4', owner, size, checksum, since).get()
+    if session is None:
+      session = cls(owner=owner, size=size, checksum=checksum)
+      session.put()
+      # One cleanup per hour is enough.
+      try:
+        deferred.defer(delete_stale_upload_sessions,
+                       _name='delete-upload-sessions-%d' %
+                       (time.time() // 3600))
+      except taskqueue.TaskAlreadyExistsError:
+        pass
+    return session
+
+  def add_chunk(self, offset, data):
+    """Stores the chunk starting at offset; must run in a transaction.
+
+    Chunks must not leave gaps, but may be sent again.
+
+    Returns:
+      The number of bytes received so far.
+
+    Raises:
+      ValueError: The chunk doesn't fit.
+    """
+    session = UploadSession.get_by_id(self.key().id())
+    if offset > session.received:
+      raise ValueError('Expected a chunk at offset %d' % session.received)
+    if offset + len(data) > session.size:
+      raise ValueError('Chunk exceeds the size of %d bytes' % session.size)
+    key_name = UploadChunk.key_name_for(session, offset)
+    chunk = UploadChunk.get_by_key_name(key_name)
+    if chunk is None:
+      chunk = UploadChunk(key_name=key_name, parent=session, session=session,
+                          offset=offset)
+    chunk.data = db.Blob(data)
+    chunk.put()
+    session.received = max(session.received, offset + len(data))
+    session.put()
+    self.received = session.received
+    return session.received
+
+  def open(self):
+    """Returns a file with the uploaded data, or None if it's incomplete.
+
+    The data is checked against the size and checksum of the session.
+    """
+    if self.received < self.size:
+      return None
+    out = tempfile.SpooledTemporaryFile(max_size=UPLOAD_CHUNK_MAX_SIZE)
+    digest = md5.new()
+    pos = 0
+    for chunk in UploadChunk.gql('WHERE session = :1 ORDER BY offset', self):
+      if chunk.offset > pos:
+        break
+      # Chunks sent again with a different size overlap.
+      data = chunk.data[pos - chunk.offset:]
+      out.write(data)
+      digest.update(data)
+      pos += len(data)
+    if pos != self.size or digest.hexdigest() != self.checksum:
+      logging.warn('Upload session %d is corrupt', self.key().id())
+      return None
+    out.seek(0)
+    return out
+
+  def discard(self):
+    """Deletes the session and its chunks."""
+    db.delete(list(UploadChunk.gql('WHERE session = :1', self)))
+    self.delete()
+
+
+class UploadChunk(db.Model):
+  """A part of an uploaded file, see UploadSession.
+
+  This is a descendant of an UploadSession, with the key name from
+  key_name_for().
+  """
+
+  session = db.ReferenceProperty(UploadSession)  # == parent
+  offset = db.IntegerProperty()
+  data = db.BlobProperty()
+
+  @staticmethod
+  def key_name_for(session, offset):
+    """Returns the key name of the chunk of a session at an offset."""
+    # Key names are unique among all entities of a kind, not per parent.
+    return 's%do%d' % (session.key().id(), offset)
+
+
+def delete_stale_upload_sessions():
+  """Task deleting upload sessions older than UPLOAD_SESSION_LIFETIME."""
+  since = datetime.datetime.now() - UPLOAD_SESSION_LIFETIME
+  while True:
+    sessions = UploadSession.gql('WHERE created < :1', since).fetch(20)
+    if not sessions:
+      break
+    for session in sessions:
+      session.discard()
+    logging.info('Deleted %d stale upload sessions', len(sessions))
+
+
+### Full-text search ###
+
+# Issues are indexed this long after they were saved; all saves within the
+# same period are indexed by one task.
+SEARCH_INDEX_DELAY = 60
+# The weight of each occurrence of a term, by the part of the issue.
+SEARCH_WEIGHTS = {
+  'subject': 4,
+  'filename': 3,
+  'description': 2,
+  'message': 1,
+  'comment': 1,
+}
+# Memcache key of the version of the cached search rankings.
+SEARCH_VERSION_KEY = 'search_version'
+# File name terms are also indexed with this prefix, see IssueSearch.
+FILENAME_TERM_PREFIX = 'file:'
+# Longer words are cut to this length.
+MAX_TERM_LENGTH = 100
+SEARCH_STOPWORDS = frozenset([
+  'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'if', 'in',
+  'into', 'is', 'it', 'no', 'not', 'of', 'on', 'or', 'so', 'that', 'the',
+  'this', 'to', 'was', 'we', 'with',
+])
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+  """Split text into lowercased search terms, leaving out stopwords."""
+  if not text:
+    return []
+  return [word[:MAX_TERM_LENGTH] for word in _WORD_RE.findall(text.lower())
+          if len(word) > 1 and word not in SEARCH_STOPWORDS]
+
+
+class SearchDocument(db.Model):
+  """The search terms of an issue as they were last indexed.
+
+  The key name is 'i<issue id>'.  The lists are parallel: term terms[i]
+  has weight weights[i].  index_issue() compares them with the current
+  terms, so only the SearchPostings that changed are written.
+  """
+
+  terms = db.ListProperty(basestring, indexed=False)
+  weights = db.ListProperty(int, indexed=False)
+
+
+class SearchPosting(db.Model):
+  """One issue containing a search term, i.e. an entry of its posting list.
+
+  The key name is from key_name_for().  Each (term, issue) pair has its own
+  entry, so indexing issues concurrently doesn't write the same entities
+  and the work per issue doesn't grow with the number of issues.
+  """
+
+  term = db.StringProperty(required=True)
+  issue_id = db.IntegerProperty(required=True)
+  weight = db.IntegerProperty(required=True)
+
+  @staticmethod
+  def key_name_for(term, issue_id):
+    """Returns the key name of the entry of a term in an issue."""
+    return _hashed_key_name('p%d:' % issue_id, term)
+
+  @classmethod
+  def update(cls, issue_id, weights):
+    """Sets the weights of terms in an issue.
+
+    The existing entries are looked up with one batch get.
+
+    Args:
+      issue_id: The id of the issue.
+      weights: A dict mapping terms to their weight, 0 removes the term.
+    """
+    terms = list(weights)
+    entries = cls.get_by_key_name([cls.key_name_for(term, issue_id)
+                                   for term in terms])
+    tbd = []
+    tbp = []
+    for term, entry in zip(terms, entries):
+      weight = weights[term]
+      if entry is None and weight:
+        # Another task may have added it meanwhile.
+        entry = cls.get_or_insert(cls.key_name_for(term, issue_id),
+                                  term=term, issue_id=issue_id, weight=weight)
+      if entry is None:
+        continue
+      if not weight:
+        tbd.append(entry)
+      elif entry.weight != weight:
+        entry.weight = weight
+        tbp.append(entry)
+    if tbd:
+      db.delete(tbd)
+    if tbp:
+      db.put(tbp)
+
+  @classmethod
+  def get_postings(cls, term, limit):
+    """Returns the issues with a term.
+
+    Args:
+      term: The search term.
+      limit: The maximum number of postings read, those with the highest
+        weight are read first.
+
+    Returns:
+      A 2-tuple (postings, number of issues with the term); postings is a
+      dict mapping issue ids to weights.
+    """
+    postings = dict((entry.issue_id, entry.weight) for entry in
+                    gql(cls, 'WHERE term = :1 ORDER BY weight DESC',
+                        term).fetch(limit))
+    num_issues = len(postings)
+    if num_issues == limit:
+      num_issues = gql(cls, 'WHERE term = :1', term).count()
+    return postings, num_issues
+
+
+def get_search_terms(issue):
+  """Return a dict mapping the search terms of an issue to their weights.
+
+  The subject, description, file names and published messages and
+  comments are indexed.  Drafts are left out, they're private.
+  """
+  weights = {}
+
+  def add(text, part, prefix=''):
+    for term in tokenize(text):
+      term = prefix + term
+      weights[term] = weights.get(term, 0) + SEARCH_WEIGHTS[part]
+
+  add(issue.subject, 'subject')
+  add(issue.description, 'description')
+  filenames = set()
+  for patchset in issue.patchset_set:
+    add(patchset.message, 'message')
+    filenames.update(patch.filename for patch in patchset.get_navigation())
+  for filename in filenames:
+    add(filename, 'filename')
+    add(filename, 'filename', FILENAME_TERM_PREFIX)
+  for message in gql(Message, 'WHERE ANCESTOR IS :1 AND draft = FALSE',
+                     issue):
+    add(message.text, 'message')
+  for comment in gql(Comment, 'WHERE ANCESTOR IS :1 AND draft = FALSE',
+                     issue):
+    add(comment.text, 'comment')
+  return weights
+
+
+def enqueue_index_issue(issue):
+  """Queues index_issue() to run at the end of the current period."""
+  issue_id = issue.key().id()
+  window = int(time.time() // SEARCH_INDEX_DELAY)
+  try:
+    deferred.defer(index_issue, issue_id,
+                   _name='search-index-%d-%d' % (issue_id, window),
+                   _countdown=(window + 1) * SEARCH_INDEX_DELAY - time.time())
+  except taskqueue.TaskAlreadyExistsError:
+    pass
+
+
+def index_issue(issue_id):
+  """Task bringing the search index up to date with an issue.
+
+  Only the terms whose weight changed are written.  A deleted issue is
+  removed from the index.
+  """
+  issue = Issue.get_by_id(issue_id)
+  key_name = 'i%d' % issue_id
+  document = SearchDocument.get_by_key_name(key_name)
+  old_weights = {}
+  if document is not None:
+    old_weights = dict(zip(document.terms, document.weights))
+  new_weights = {}
+  if issue is not None:
+    new_weights = get_search_terms(issue)
+  changed = dict((term, new_weights.get(term, 0))
+                 for term in set(old_weights) | set(new_weights)
+                 if old_weights.get(term) != new_weights.get(term))
+  SearchPosting.update(issue_id, changed)
+  if changed:
+    # Cached rankings are out of date, see IssueSearch.get_ranking().
+    memcache.set(SEARCH_VERSION_KEY, time.time())
+  if issue is None:
+    if document is not None:
+      document.delete()
+    return
+  if document is None:
+    document = SearchDocument(key_name=key_name)
+  document.terms = sorted(new_weights)
+  document.weights = [new_weights[term] for term in document.terms]
+  document.put()
+  if changed:
+    logging.info('Indexed issue %d, %d terms changed', issue_id, len(changed))
+
+
+def index_all_issues(since=None, batch_size=50):
+  """Task indexing every issue, e.g. those created before the index existed.
+
+  Each run indexes batch_size issues created after 'since' and queues the
+  next run.  Start it once with deferred.defer(models.index_all_issues).
+  """
+  if since is None:
+    query = gql(Issue, 'ORDER BY created')
+  else:
+    query = gql(Issue, 'WHERE created > :1 ORDER BY created', since)
+  issues = query.fetch(batch_size)
+  for issue in issues:
+    index_issue(issue.key().id())
+  if len(issues) == batch_size:
+    deferred.defer(index_all_issues, issues[-1].created, batch_size)
+
+
+class IssueSearch(object):
+  """A full-text search over issues that works like an Issue query.
+
+  It supports the fetch(), cursor(), with_cursor() and equality filter()
+  calls views.search() makes.  All terms must be found in an issue.  The
+  issues are ranked by the sum of the weights of the terms in the issue,
+  each divided by the log of the number of issues with the term, then
+  newest first.  The cursor is the position in that ranking; the filters
+  are applied to the issues while fetching.  Private issues are only
+  returned to users who can view them, also when fetching keys only.
+  """
+
+  # Issues are loaded in batches of this size while fetching.
+  BATCH_SIZE = 50
+  # At most this many postings are read per term, the highest weights
+  # first, so a common term doesn't load an entry for nearly every issue.
+  MAX_POSTINGS = 1000
+  # The ranking of a query is cached this long, for the following pages.
+  RANKING_TIMEOUT = 10 * 60
+
+  def __init__(self, text='', filename='', keys_only=False, user=None):
+    """Constructor.
+
+    Args:
+      text: Words to find anywhere in the issues.
+      filename: Words to find in the file names of the issues.
+      keys_only: If True, fetch() returns issue keys.
+      user: The user searching, None if not logged in.
+    """
+    self.terms = set(tokenize(text))
+    self.terms.update(FILENAME_TERM_PREFIX + term
+                      for term in tokenize(filename))
+    self.keys_only = keys_only
+    self.user = user
+    self._filters = []
+    self._position = 0
+    self._ranking = None
+
+  def filter(self, property_operator, value):
+    prop, operator = property_operator.split()
+    if operator != '=':
+      raise db.BadArgumentError('Only equality filters are supported.')
+    self._filters.append((prop, value))
+    return self
+
+  def with_cursor(self, cursor):
+    try:
+      self._position = max(0, int(cursor))
+    except ValueError:
+      raise db.BadArgumentError('Invalid cursor %r' % cursor)
+
+  def cursor(self):
+    return str(self._position)
+
+  def get_ranking(self):
+    """Return the ids of all issues with all terms, best match first.
+
+    The ranking is cached in memcache by the terms, so the requests for
+    the following pages, whose cursor is a position in it, don't read the
+    postings again.  Indexing an issue starts a new version of the cache.
+    """
+    if self._ranking is not None:
+      return self._ranking
+    if not self.terms:
+      self._ranking = []
+      return self._ranking
+    digest = md5.new(repr(memcache.get(SEARCH_VERSION_KEY)))
+    for term in sorted(self.terms):
+      digest.update('\0' + term.encode('utf-8'))
+    cache_key = 'search_ranking:' + digest.hexdigest()
+    self._ranking = memcache.get(cache_key)
+    if self._ranking is None:
+      self._ranking = self._rank()
+      memcache.set(cache_key, self._ranking, self.RANKING_TIMEOUT)
+    return self._ranking
+
+  def _rank(self):
+    """Reads the postings of the terms and ranks the issues."""
+    scores = None
+    for term in self.terms:
+      postings, num_issues = SearchPosting.get_postings(term,
+                                                        self.MAX_POSTINGS)
+      if not postings:
+        return []
+      idf = 1.0 / math.log(2 + num_issues)
+      term_scores = dict((issue_id, weight * idf)
+                         for issue_id, weight in postings.iteritems())
+      if scores is None:
+        scores = term_scores
+      else:
+        scores = dict((issue_id, score + term_scores[issue_id])
+                      for issue_id, score in scores.iteritems()
+                      if issue_id in term_scores)
+    return sorted(scores,
+                  key=lambda issue_id: (-scores[issue_id], -issue_id))
+
+  def _matches(self, issue):
+    if not issue.user_can_view(self.user):
+      return False
+    for prop, value in self._filters:
+      actual = getattr(issue, prop)
+      if isinstance(actual, list):
+        if value not in actual:
+          return False
+      elif actual != value:
+        return False
+    return True
+
+  def fetch(self, limit):
+    """Return the next matching issues and move the cursor past them."""
+    ranking = self.get_ranking()
+    results = []
+    while len(results) < limit and self._position < len(ranking):
+      issue_ids = ranking[self._position:self._position + self.BATCH_SIZE]
+      for issue in Issue.get_by_id(issue_ids):
+        self._position += 1
+        if issue is not None and self._matches(issue):
+          results.append(issue)
+          if len(results) == limit:
+            break
+    if self.keys_only:
+      return [issue.key() for issue in results]
+    return results
@@ -90,6 +90,21 @@ def PatchChunks(old_lines, chunks):
     yield ("equal", eq, eq)
 
 
+def MakeUnifiedDiff(old_lines, new_lines, name, context=3):
+  """Returns a unified diff of two lists of lines, like svn diff prints it.
+
+  ParsePatchToChunks() and PatchChunks() turn the result and old_lines
+  back into new_lines.
+  """
+  lines = ["Index: %s\n" % name, "=" * 67 + "\n"]
+  for line in difflib.unified_diff(old_lines, new_lines, name, name,
+                                   n=context, lineterm="\n"):
+    if not line.endswith("\n"):
+      line += "\n" + _NO_NEWLINE_MESSAGE + "\n"
+    lines.append(line)
+  return "".join(lines)
+
+
 def ParseRevision(lines):
   """Parse the revision number out of the raw lines of the patch.
 
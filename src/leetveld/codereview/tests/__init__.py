@@ -0,0 +1,32 @@
+"""Loads all the test_*.py files into the top level of the package.
+
+Django expects the tests of an application in a single tests module, so
+the test cases of every test_*.py file in this package are made
+attributes of the package itself, like in gae2django.tests.
+"""
+
+import os
+import re
+import types
+import unittest
+
+
+TEST_RE = r'^test_.*\.py$'
+
+
+test_names = []
+for filename in os.listdir(os.path.dirname(__file__)):
+  if not re.match(TEST_RE, filename):
+    continue
+  test_module = __import__('codereview.tests.%s' % filename[:-3],
+                           {}, {}, filename[:-3])
+  for name in dir(test_module):
+    item = getattr(test_module, name)
+    if not (isinstance(item, (type, types.ClassType)) and
+            issubclass(item, unittest.TestCase)):
+      continue
+    globals()[name] = item
+    test_names.append(name)
+
+
+__all__ = test_names
@@ -0,0 +1,52 @@
+"""Helpers shared by the codereview tests."""
+
+from django.contrib.auth.models import User
+from django.test import TestCase as DjangoTestCase
+
+from gae2django import middleware
+
+from codereview import models
+
+
+class TestCase(DjangoTestCase):
+  """A test case creating users and issues in the test database."""
+
+  def make_user(self, name):
+    """Returns a new User with the email <name>@example.com."""
+    return User.objects.create_user(name, '%s@example.com' % name, 'testpw')
+
+  def make_issue(self, owner, subject='Test issue', **kwds):
+    """Returns a new saved Issue; kwds are further Issue properties."""
+    issue = models.Issue(subject=subject, owner=owner, **kwds)
+    issue.put()
+    return issue
+
+  def make_patchset(self, issue, files):
+    """Returns a new PatchSet and its Patches.
+
+    Args:
+      issue: the Issue the patchset belongs to.
+      files: a list of (filename, diff text) pairs, one per Patch.
+    """
+    patchset = models.PatchSet(issue=issue, parent=issue)
+    patchset.put()
+    patches = []
+    for filename, text in files:
+      patch = models.Patch(patchset=patchset, filename=filename, text=text,
+                           parent=patchset)
+      patch.put()
+      patches.append(patch)
+    return patchset, patches
+
+  def login(self, user):
+    """Logs the test client in as user."""
+    self.client.logout()
+    self.client.login(username=user.username, password='testpw')
+
+  def post(self, path, user, **data):
+    """Posts data as user, with a valid XSRF token."""
+    # Account.get_xsrf_token() compares with the user of the request.
+    middleware._thread_locals.user = user
+    account = models.Account.get_account_for_user(user)
+    data['xsrf_token'] = account.get_xsrf_token()
+    return self.client.post(path, data)
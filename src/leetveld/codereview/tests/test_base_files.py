@@ -0,0 +1,22 @@
+"""Tests for the cache of base files."""
+
+from codereview import models
+from codereview.tests.base import TestCase
+
+
+class BaseFileTest(TestCase):
+
+  URL = 'http://svn.example.com/trunk/a.py?r=1'
+
+  def test_store_once(self):
+    models.BaseFile.store(self.URL, 'text')
+    models.BaseFile.store(self.URL.replace('http:', 'HTTP:'), 'text')
+    self.assertEqual(models.BaseFile.get_texts([self.URL]),
+                     {self.URL: 'text'})
+    self.assertEqual(models.BaseFileCacheSize.get_total(), 4)
+
+  def test_size_shards(self):
+    for i in range(10):
+      models.BaseFileCacheSize.add(10)
+    models.BaseFileCacheSize.add(-30)
+    self.assertEqual(models.BaseFileCacheSize.get_total(), 70)
@@ -0,0 +1,108 @@
+"""Tests for the dashboard entries maintained when issues are saved."""
+
+from google.appengine.ext import db
+
+from gae2django.models import Task
+
+from codereview import models
+from codereview.tests.base import TestCase
+
+
+class DashboardTest(TestCase):
+
+  def setUp(self):
+    self.alice = self.make_user('alice')
+    self.bob = self.make_user('bob')
+    self.carol = self.make_user('carol')
+
+  def make_issue(self, owner, subject='Test issue', **kwds):
+    issue = super(DashboardTest, self).make_issue(owner, subject, **kwds)
+    models.update_dashboards(issue.key().id())
+    return issue
+
+  def save(self, issue):
+    issue.put()
+    models.update_dashboards(issue.key().id())
+
+  def get_ids(self, user, offsets=None, limit=models.DASHBOARD_LIMIT):
+    lists, next_offsets = models.DashboardEntry.get_issues(user, offsets,
+                                                           limit)
+    ids = dict((name, [issue.key().id() for issue in issues])
+               for name, issues in lists.iteritems())
+    return ids, next_offsets
+
+  def test_participants(self):
+    issue = self.make_issue(self.alice, reviewers=['Bob@example.com'],
+                            cc=['carol@example.com'])
+    issue_id = issue.key().id()
+    ids, next_offsets = self.get_ids(self.alice)
+    self.assertEqual(ids, {'mine': [issue_id], 'reviews': [], 'cc': [],
+                           'closed': []})
+    self.assertEqual(next_offsets, None)
+    self.assertEqual(self.get_ids(self.bob)[0]['reviews'], [issue_id])
+    self.assertEqual(self.get_ids(self.carol)[0]['cc'], [issue_id])
+
+  def test_removed_and_closed(self):
+    issue = self.make_issue(self.alice, reviewers=['bob@example.com'])
+    issue.reviewers = []
+    issue.closed = True
+    self.save(issue)
+    self.assertEqual(self.get_ids(self.bob)[0]['reviews'], [])
+    ids = self.get_ids(self.alice)[0]
+    self.assertEqual(ids['mine'], [])
+    self.assertEqual(ids['closed'], [issue.key().id()])
+
+  def test_multi_entity_put(self):
+    issue = self.make_issue(self.alice)
+    issue.cc = ['carol@example.com']
+    Task.objects.all().delete()
+    db.put([issue])
+    self.assertEqual(
+        Task.objects.filter(name__startswith='dashboard-%d-' %
+                            issue.key().id()).count(), 1)
+    self.assertEqual(self.get_ids(self.carol)[0]['cc'], [])
+    models.update_dashboards(issue.key().id())
+    self.assertEqual(self.get_ids(self.carol)[0]['cc'], [issue.key().id()])
+
+  def test_pages(self):
+    issue_ids = [self.make_issue(self.alice).key().id() for i in range(3)]
+    issue_ids.reverse()
+    ids, next_offsets = self.get_ids(self.alice, None, 2)
+    self.assertEqual(ids['mine'], issue_ids[:2])
+    self.assertEqual(next_offsets['mine'], 2)
+    ids, next_offsets = self.get_ids(self.alice, next_offsets, 2)
+    self.assertEqual(ids['mine'], issue_ids[2:])
+    self.assertEqual(next_offsets, None)
+
+  def test_pages_per_list(self):
+    # Paging through a long list doesn't skip issues of a short one.
+    mine = [self.make_issue(self.alice).key().id() for i in range(3)]
+    mine.reverse()
+    review = self.make_issue(self.bob, reviewers=['alice@example.com'])
+    ids, next_offsets = self.get_ids(self.alice, {'reviews': 0}, 1)
+    self.assertEqual(ids['reviews'], [review.key().id()])
+    self.assertEqual(next_offsets, {'mine': 1, 'reviews': 1, 'cc': 0,
+                                    'closed': 0})
+    ids, next_offsets = self.get_ids(self.alice, next_offsets, 1)
+    self.assertEqual((ids['mine'], ids['reviews']), (mine[1:2], []))
+    self.login(self.alice)
+    response = self.client.get('/mine', {'limit': '1', 'offset_mine': '2'})
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual([issue.key().id()
+                      for issue in response.context['my_issues']], mine[2:])
+    self.assertEqual(
+        [issue.key().id() for issue in response.context['review_issues']],
+        [review.key().id()])
+
+  def test_remove_issue(self):
+    issue = self.make_issue(self.alice, reviewers=['bob@example.com'])
+    models.DashboardEntry.remove_issue(issue.key().id())
+    self.assertEqual(self.get_ids(self.alice)[0]['mine'], [])
+    self.assertEqual(self.get_ids(self.bob)[0]['reviews'], [])
+
+  def test_deleted_issue(self):
+    issue = self.make_issue(self.alice)
+    issue_id = issue.key().id()
+    issue.delete()
+    models.update_dashboards(issue_id)
+    self.assertEqual(self.get_ids(self.alice)[0]['mine'], [])
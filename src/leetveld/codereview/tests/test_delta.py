@@ -0,0 +1,95 @@
+"""Tests for the DeltaIndex and calculating Patch.delta from it."""
+
+from codereview import models
+from codereview import views
+from codereview.tests.base import TestCase
+
+
+class DeltaIndexTest(TestCase):
+
+  def setUp(self):
+    self.issue = self.make_issue(self.make_user('alice'))
+    self.ps1, self.patches1 = self.make_patchset(
+        self.issue, [('a.py', 'diff a'), ('b.py', 'diff b')])
+
+  def index(self, patchset, patches, complete=False):
+    views._add_to_delta_index(
+        self.issue, patchset,
+        [(patch.filename, views._text_digest(patch.text))
+         for patch in patches], complete)
+
+  def test_concurrent_uploads(self):
+    # Separately uploaded patches of one patchset add their own entries.
+    self.index(self.ps1, self.patches1[:1])
+    self.index(self.ps1, self.patches1[1:])
+    self.index(self.ps1, self.patches1[1:])
+    digests = models.DeltaIndex.get_digests(self.issue, ['a.py', 'b.py'])
+    ps1_id = self.ps1.key().id()
+    self.assertEqual(digests, {
+        'a.py': {ps1_id: views._text_digest('diff a')},
+        'b.py': {ps1_id: views._text_digest('diff b')},
+        })
+
+  def test_calculate_delta(self):
+    self.index(self.ps1, self.patches1, complete=True)
+    ps2, patches2 = self.make_patchset(
+        self.issue, [('a.py', 'diff a'), ('b.py', 'diff b2'),
+                     ('c.py', 'diff c')])
+    self.index(ps2, patches2)
+    views._calculate_delta(self.issue, ps2, patches2)
+    ps1_id = self.ps1.key().id()
+    self.assertEqual([patch.delta for patch in patches2],
+                     [[], [ps1_id], [ps1_id]])
+    self.assertTrue(all(patch.delta_calculated for patch in patches2))
+
+  def test_partially_indexed_patchset(self):
+    # b.py of the first patchset isn't indexed yet; it's not new though.
+    self.index(self.ps1, self.patches1[:1])
+    ps2, patches2 = self.make_patchset(self.issue, [('b.py', 'diff b')])
+    self.index(ps2, patches2)
+    views._calculate_delta(self.issue, ps2, patches2)
+    self.assertEqual(patches2[0].delta, [])
+    self.assertEqual(
+        models.DeltaIndex.get_digests(self.issue, ['b.py'])['b.py'],
+        {self.ps1.key().id(): views._text_digest('diff b'),
+         ps2.key().id(): views._text_digest('diff b')})
+
+  def test_unindexed_patchsets_are_backfilled(self):
+    ps2, patches2 = self.make_patchset(self.issue, [('a.py', 'diff a2')])
+    views._calculate_delta(self.issue, ps2, patches2)
+    self.assertEqual(patches2[0].delta, [self.ps1.key().id()])
+    self.assertEqual(models.DeltaIndex.get_complete(self.issue,
+                                                    [self.ps1.key().id()]),
+                     set([self.ps1.key().id()]))
+
+  def test_pending_diff_not_complete(self):
+    self.patches1[1].text = None
+    self.patches1[1].put()
+    ps2, patches2 = self.make_patchset(self.issue, [('a.py', 'diff a')])
+    views._calculate_delta(self.issue, ps2, patches2)
+    self.assertEqual(patches2[0].delta, [])
+    self.assertEqual(
+        models.DeltaIndex.get_complete(self.issue, [self.ps1.key().id()]),
+        set())
+
+  def test_complete_patchset_not_loaded(self):
+    # The index of the complete first patchset answers for a.py and for
+    # c.py, which it doesn't have, without loading any of its patches.
+    self.index(self.ps1, self.patches1, complete=True)
+    for patch in self.patches1:
+      patch.delete()
+    ps2, patches2 = self.make_patchset(
+        self.issue, [('a.py', 'diff a'), ('c.py', 'diff c')])
+    views._calculate_delta(self.issue, ps2, patches2)
+    self.assertEqual([patch.delta for patch in patches2],
+                     [[], [self.ps1.key().id()]])
+
+  def test_remove_patchset(self):
+    self.index(self.ps1, self.patches1, complete=True)
+    models.DeltaIndex.remove_patchset(self.issue, self.ps1.key().id())
+    self.assertEqual(
+        models.DeltaIndex.get_complete(self.issue, [self.ps1.key().id()]),
+        set())
+    self.assertEqual(
+        models.DeltaIndex.get_filenames(self.issue, self.ps1.key().id()),
+        set())
@@ -0,0 +1,138 @@
+"""Tests for keeping DraftCounts and DraftIndex up to date."""
+
+from codereview import models
+from codereview.tests.base import TestCase
+
+
+DIFF = """Index: a.py
+--- a.py
++++ a.py
+@@ -1 +1 @@
+-old
++new
+"""
+
+
+class DraftCountsTest(TestCase):
+
+  def setUp(self):
+    self.alice = self.make_user('alice')
+    self.bob = self.make_user('bob')
+    self.issue = self.make_issue(self.alice, reviewers=['bob@example.com'])
+    self.ps1, self.patches1 = self.make_patchset(self.issue,
+                                                 [('a.py', DIFF)])
+    self.ps2, self.patches2 = self.make_patchset(self.issue,
+                                                 [('a.py', DIFF)])
+    self.login(self.bob)
+
+  def add_draft(self, patchset, patch, lineno=1):
+    response = self.client.post('/inline_draft', {
+        'snapshot': 'new',
+        'side': 'b',
+        'issue': str(self.issue.key().id()),
+        'patchset': str(patchset.key().id()),
+        'patch': str(patch.key().id()),
+        'lineno': str(lineno),
+        'text': 'Draft',
+        })
+    self.assertEqual(response.status_code, 200)
+
+  def get_total(self):
+    return models.DraftCounts.get_for(self.issue, self.bob).total
+
+  def has_drafts(self):
+    issue_ids = models.DraftIndex.get_for_user(self.bob).issue_ids
+    return self.issue.key().id() in issue_ids
+
+  def test_viewing_stores_nothing(self):
+    self.assertFalse(models.DraftCounts.get_for(self.issue,
+                                                self.bob).is_saved())
+    response = self.client.get('/%d' % self.issue.key().id())
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(
+        models.DraftCounts.gql('WHERE ANCESTOR IS :1', self.issue).count(), 0)
+
+  def test_publish(self):
+    self.add_draft(self.ps1, self.patches1[0])
+    self.add_draft(self.ps2, self.patches2[0])
+    self.assertEqual(self.get_total(), 2)
+    self.assertTrue(self.has_drafts())
+    self.post('/%d/publish' % self.issue.key().id(), self.bob,
+              subject=self.issue.subject, reviewers='bob@example.com',
+              message='Comments')
+    self.assertEqual(self.get_total(), 0)
+    self.assertFalse(self.has_drafts())
+
+  def test_publish_counts_comments(self):
+    self.add_draft(self.ps1, self.patches1[0])
+    self.add_draft(self.ps1, self.patches1[0], lineno=2)
+    # Comments published meanwhile by someone else are kept.
+    patch = models.Patch.get(self.patches1[0].key())
+    patch.n_comments = 1
+    patch.put()
+    self.post('/%d/publish' % self.issue.key().id(), self.bob,
+              subject=self.issue.subject, reviewers='bob@example.com',
+              message='Comments')
+    self.assertEqual(models.Patch.get(patch.key()).n_comments, 3)
+    self.assertEqual(models.PatchSet.get(self.ps1.key()).n_comments, 2)
+    self.assertEqual(models.Issue.get(self.issue.key()).n_comments, 2)
+
+  def test_publish_clears_stale_counts(self):
+    counts = models.DraftCounts.get_for(self.issue, self.bob)
+    counts.add(self.ps1.key().id(), self.patches1[0].key().id(), 1)
+    counts.put()
+    self.post('/%d/publish' % self.issue.key().id(), self.bob,
+              subject=self.issue.subject, reviewers='bob@example.com',
+              message='Nothing to publish')
+    self.assertEqual(self.get_total(), 0)
+
+  def test_reconcile_counts(self):
+    self.add_draft(self.ps1, self.patches1[0])
+    patch = models.Patch.get(self.patches1[0].key())
+    patch.n_comments = 5
+    patch.put()
+    counts = models.DraftCounts.get_for(self.issue, self.bob)
+    counts.clear()
+    counts.put()
+    models.reconcile_counts(self.issue.key().id())
+    self.assertEqual(models.Patch.get(patch.key()).n_comments, 0)
+    self.assertEqual(self.get_total(), 1)
+    self.assertTrue(self.has_drafts())
+
+  def test_legacy_comment_count_stored(self):
+    patch = models.Patch.get(self.patches1[0].key())
+    patch.n_comments = None
+    patch.put()
+    self.assertEqual(patch.num_comments, 0)
+    self.assertEqual(models.Patch.get(patch.key()).n_comments, 0)
+
+  def test_delete_patchset(self):
+    self.add_draft(self.ps1, self.patches1[0])
+    self.add_draft(self.ps2, self.patches2[0])
+    self.login(self.alice)
+    self.post('/%d/patchset/%d/delete' % (self.issue.key().id(),
+                                          self.ps1.key().id()), self.alice)
+    self.assertEqual(self.get_total(), 1)
+    self.assertTrue(self.has_drafts())
+    self.post('/%d/patchset/%d/delete' % (self.issue.key().id(),
+                                          self.ps2.key().id()), self.alice)
+    self.assertEqual(self.get_total(), 0)
+    self.assertFalse(self.has_drafts())
+
+  def test_delete_issue(self):
+    self.add_draft(self.ps1, self.patches1[0])
+    self.login(self.alice)
+    self.post('/%d/delete' % self.issue.key().id(), self.alice)
+    self.assertFalse(self.has_drafts())
+
+
+class DraftIndexTest(TestCase):
+
+  def test_long_email(self):
+    # Key names are limited to 64 characters.
+    user = self.make_user('carol')
+    user.email = 'carol.' + 'x' * 80 + '@example.com'
+    user.save()
+    index = models.DraftIndex.get_for_user(user)
+    self.assertEqual(index.issue_ids, [])
+    self.assertEqual(models.DraftIndex.get_for_user(user).key(), index.key())
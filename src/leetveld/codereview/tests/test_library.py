@@ -0,0 +1,25 @@
+"""Tests for the nickname lookups of the template library."""
+
+from codereview import library
+from codereview import models
+from codereview.tests.base import TestCase
+
+
+class NicknamesTest(TestCase):
+
+  def setUp(self):
+    self.account = models.Account.get_account_for_user(self.make_user('bob'))
+
+  def test_lookup(self):
+    self.assertEqual(library.get_nicknames(['bob@example.com',
+                                            'carol@example.com']),
+                     {'bob@example.com': 'bob',
+                      'carol@example.com': 'carol_example.com'})
+
+  def test_renamed_mixed_case(self):
+    self.assertEqual(library.get_nicknames(['Bob@Example.com']),
+                     {'Bob@Example.com': 'bob'})
+    self.account.nickname = 'robert'
+    self.account.put()
+    self.assertEqual(library.get_nicknames(['Bob@Example.com']),
+                     {'Bob@Example.com': 'robert'})
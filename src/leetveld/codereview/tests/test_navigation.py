@@ -0,0 +1,55 @@
+"""Tests for the file navigation stored with patchsets."""
+
+from codereview import models
+from codereview import views
+from codereview.tests.base import TestCase
+
+
+class NavigationTest(TestCase):
+
+  def setUp(self):
+    self.issue = self.make_issue(self.make_user('alice'))
+    self.patchset, self.patches = self.make_patchset(
+        self.issue, [('a.py', 'diff a'), ('b.py', 'diff b')])
+
+  def test_built_and_stored(self):
+    navigation = self.patchset.get_navigation()
+    self.assertEqual([patch.filename for patch in navigation],
+                     ['a.py', 'b.py'])
+    stored = models.PatchSet.get(self.patchset.key())
+    self.assertNotEqual(stored.navigation, None)
+
+  def test_num_lines(self):
+    self.patches[1].text = 'line 1\nline 2\n'
+    self.patches[1].put()
+    navigation = models.PatchSet.get(self.patchset.key()).get_navigation()
+    self.assertEqual([patch.num_lines for patch in navigation], [1, 2])
+
+  def test_old_format_rebuilt(self):
+    self.patchset.navigation = '[[%d, "a.py", 0, []]]' % (
+        self.patches[0].key().id())
+    self.patchset.put()
+    navigation = models.PatchSet.get(self.patchset.key()).get_navigation()
+    self.assertEqual([patch.filename for patch in navigation],
+                     ['a.py', 'b.py'])
+
+  def test_stale_patchset_not_written(self):
+    # A comment count published while the navigation is built survives.
+    stale = models.PatchSet.get(self.patchset.key())
+    self.patchset.n_comments = 3
+    self.patchset.put()
+    stale.get_navigation()
+    stored = models.PatchSet.get(self.patchset.key())
+    self.assertEqual(stored.n_comments, 3)
+    self.assertEqual(stored.navigation, None)
+
+  def test_reset_only_when_delta_changed(self):
+    self.patchset.get_navigation()
+    views._calculate_delta(self.issue, self.patchset, self.patches)
+    self.assertEqual(models.PatchSet.get(self.patchset.key()).navigation,
+                     None)
+    self.patchset = models.PatchSet.get(self.patchset.key())
+    self.patchset.get_navigation()
+    views._calculate_delta(self.issue, self.patchset, self.patches)
+    self.assertNotEqual(
+        models.PatchSet.get(self.patchset.key()).navigation, None)
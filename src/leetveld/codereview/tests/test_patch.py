@@ -0,0 +1,91 @@
+"""Tests for the properties of patches derived from their diff."""
+
+from codereview import models
+from codereview.tests.base import TestCase
+
+
+DIFF = """Index: a.py
+--- a.py
++++ a.py
+@@ -1,2 +1,2 @@
+-old
++new
+ same
+"""
+
+
+class PatchTest(TestCase):
+
+  def test_diff_not_generated(self):
+    # With upload.py --server_diff the text is set by _generate_diff().
+    patch = models.Patch(filename='a.py')
+    self.assertEqual(patch.property_changes, [])
+    self.assertEqual(patch.num_added, 0)
+    self.assertEqual(patch.num_removed, 0)
+    self.assertEqual(patch.num_chunks, 0)
+    patch.text = DIFF
+    self.assertEqual(patch.num_added, 1)
+    self.assertEqual(patch.num_removed, 1)
+    self.assertEqual(patch.num_chunks, 1)
+
+  def test_cached_without_text(self):
+    patch = models.Patch(filename='a.py', text=DIFF)
+    patch.num_added
+    patch.text = None
+    self.assertEqual(patch.num_added, 1)
+
+
+class ContentTest(TestCase):
+
+  def setUp(self):
+    user = self.make_user('owner')
+    issue = self.make_issue(user)
+    _, patches = self.make_patchset(issue, [('a.py', DIFF)])
+    self.patch = patches[0]
+
+  def test_get_line(self):
+    content = models.Content(text='one\ntwo\n', parent=self.patch)
+    self.assertEqual(content.get_line(2), 'two\n')
+    self.assertEqual(content.get_line(3), '')
+
+  def test_new_text_drops_offsets(self):
+    content = models.Content(text='one\ntwo\n', parent=self.patch)
+    content.update_line_offsets()
+    content.put()
+    content = models.Content.get(content.key())
+    self.assertEqual(content.get_line(2), 'two\n')
+    content.text = 'first line\nsecond line\n'
+    content.put()
+    self.assertEqual(content.line_offsets, None)
+    content = models.Content.get(content.key())
+    self.assertEqual(content.get_line(2), 'second line\n')
+
+
+class MaterializeTest(TestCase):
+
+  def setUp(self):
+    issue = self.make_issue(self.make_user('owner'))
+    _, patches = self.make_patchset(issue, [('a.py', DIFF)])
+    self.patch = patches[0]
+    content = models.Content(text='old\nsame\n', parent=self.patch)
+    content.put()
+    self.patch.content = content
+    self.patch.put()
+
+  def test_materialize(self):
+    self.assertTrue(self.patch.materialize_patched_content())
+    self.assertFalse(self.patch.materialize_patched_content())
+    patch = models.Patch.get(self.patch.key())
+    self.assertEqual(patch.patched_content.text, 'new\nsame\n')
+
+  def test_upload_wins(self):
+    # The current content is uploaded while the task computes it.
+    stale = models.Patch.get(self.patch.key())
+    uploaded = models.Content(text='uploaded\n', is_uploaded=True,
+                              parent=self.patch)
+    uploaded.put()
+    self.patch.patched_content = uploaded
+    self.patch.put()
+    self.assertFalse(stale.materialize_patched_content())
+    patch = models.Patch.get(self.patch.key())
+    self.assertEqual(patch.patched_content.key(), uploaded.key())
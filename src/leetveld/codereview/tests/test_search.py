@@ -0,0 +1,77 @@
+"""Tests for the full-text search index and its use by /search."""
+
+from django.utils import simplejson
+
+from codereview import models
+from codereview.tests.base import TestCase
+
+
+class SearchTest(TestCase):
+
+  def setUp(self):
+    self.alice = self.make_user('alice')
+    self.bob = self.make_user('bob')
+
+  def make_indexed_issue(self, subject, **kwds):
+    issue = self.make_issue(self.alice, subject, **kwds)
+    models.index_issue(issue.key().id())
+    return issue
+
+  def search(self, **params):
+    params['format'] = 'json'
+    response = self.client.get('/search', params)
+    self.assertEqual(response.status_code, 200)
+    return simplejson.loads(response.content)['results']
+
+  def test_ranking(self):
+    weak = self.make_indexed_issue('Fix parser', description='cache')
+    strong = self.make_indexed_issue('Cache the parser')
+    search = models.IssueSearch('parser cache')
+    self.assertEqual(search.get_ranking(),
+                     [strong.key().id(), weak.key().id()])
+    self.assertEqual(models.IssueSearch('parser missing').get_ranking(), [])
+
+  def test_cached_ranking(self):
+    first = self.make_indexed_issue('Cached ranking')
+    self.assertEqual(models.IssueSearch('cached').get_ranking(),
+                     [first.key().id()])
+    # Indexing another issue makes the next search rank again.
+    second = self.make_indexed_issue('Cached ranking again')
+    self.assertEqual(sorted(models.IssueSearch('cached').get_ranking()),
+                     sorted([first.key().id(), second.key().id()]))
+
+  def test_max_postings(self):
+    issues = [self.make_indexed_issue('Common word') for _ in range(3)]
+    search = models.IssueSearch('common')
+    search.MAX_POSTINGS = 2
+    self.assertEqual(len(search._rank()), 2)
+    postings, num_issues = models.SearchPosting.get_postings('common', 2)
+    self.assertEqual((len(postings), num_issues), (2, len(issues)))
+
+  def test_reindex(self):
+    issue = self.make_indexed_issue('Old subject')
+    issue.subject = 'New subject'
+    issue.put()
+    models.index_issue(issue.key().id())
+    self.assertEqual(models.IssueSearch('old').get_ranking(), [])
+    self.assertEqual(models.IssueSearch('new').get_ranking(),
+                     [issue.key().id()])
+    self.assertEqual(
+        models.SearchPosting.all().filter('term =', 'old').count(), 0)
+
+  def test_deleted_issue(self):
+    issue = self.make_indexed_issue('Removed feature')
+    issue_id = issue.key().id()
+    issue.delete()
+    models.index_issue(issue_id)
+    self.assertEqual(models.IssueSearch('feature').get_ranking(), [])
+
+  def test_private_keys_only(self):
+    public = self.make_indexed_issue('Secret public')
+    private = self.make_indexed_issue('Secret private', private=True,
+                                      reviewers=['bob@example.com'])
+    self.assertEqual(self.search(text='secret', keys_only='True'),
+                     [public.key().id()])
+    self.login(self.bob)
+    self.assertEqual(sorted(self.search(text='secret', keys_only='True')),
+                     sorted([public.key().id(), private.key().id()]))
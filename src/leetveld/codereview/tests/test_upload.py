@@ -0,0 +1,48 @@
+"""Tests for storing uploaded diffs as patchsets."""
+
+from cStringIO import StringIO
+
+from codereview import models
+from codereview import views
+from codereview.tests.base import TestCase
+
+
+DIFF = """Index: a.py
+--- a.py
++++ a.py
+@@ -1 +1 @@
+-old
++new
+Index: b.py
+--- b.py
++++ b.py
+@@ -1 +1 @@
+-old
++new
+"""
+
+
+class StorePatchSetDataTest(TestCase):
+
+  def setUp(self):
+    self.issue = self.make_issue(self.make_user('alice'))
+    self.patchset = models.PatchSet(issue=self.issue, parent=self.issue)
+    self.patchset.put()
+    self.max_size = views.PATCHSET_DATA_MAX_SIZE
+
+  def tearDown(self):
+    views.PATCHSET_DATA_MAX_SIZE = self.max_size
+
+  def store(self):
+    file_digests = views._store_patchset_data(self.patchset, StringIO(DIFF))
+    self.assertEqual([filename for filename, _ in file_digests],
+                     ['a.py', 'b.py'])
+    return models.PatchSet.get(self.patchset.key())
+
+  def test_data_kept(self):
+    self.assertEqual(self.store().data, DIFF)
+
+  def test_large_diff_without_data(self):
+    views.PATCHSET_DATA_MAX_SIZE = len(DIFF) - 1
+    self.assertEqual(self.store().data, None)
+    self.assertEqual(self.patchset.patch_set.count(), 2)
@@ -0,0 +1,69 @@
+"""Tests for files uploaded in chunks to upload sessions."""
+
+import md5
+
+from google.appengine.ext import db
+
+from codereview import models
+from codereview import views
+from codereview.tests.base import TestCase
+
+
+class UploadSessionTest(TestCase):
+
+  def setUp(self):
+    self.user = self.make_user('alice')
+
+  def start(self, data):
+    return models.UploadSession.get_or_start(self.user, len(data),
+                                             md5.new(data).hexdigest())
+
+  def add_chunk(self, session, offset, data):
+    return db.run_in_transaction(session.add_chunk, offset, data)
+
+  def test_two_uploads(self):
+    first = self.start('abcdef')
+    second = self.start('ghijkl')
+    self.assertNotEqual(first.key().id(), second.key().id())
+    self.add_chunk(first, 0, 'abc')
+    self.add_chunk(second, 0, 'ghi')
+    self.add_chunk(first, 3, 'def')
+    self.add_chunk(second, 3, 'jkl')
+    self.assertEqual(first.open().read(), 'abcdef')
+    self.assertEqual(second.open().read(), 'ghijkl')
+
+  def test_chunk_sent_again(self):
+    session = self.start('abcdef')
+    self.assertEqual(self.add_chunk(session, 0, 'abc'), 3)
+    self.assertEqual(self.add_chunk(session, 0, 'abcd'), 4)
+    self.assertEqual(self.add_chunk(session, 4, 'ef'), 6)
+    self.assertEqual(session.open().read(), 'abcdef')
+
+  def test_gap(self):
+    session = self.start('abcdef')
+    self.assertRaises(ValueError, self.add_chunk, session, 3, 'def')
+
+  def test_resume(self):
+    session = self.start('abcdef')
+    self.add_chunk(session, 0, 'abc')
+    self.assertEqual(self.start('abcdef').received, 3)
+
+  def test_open_keeps_session(self):
+    # A request failing after opening the session can be retried.
+    session = self.start('abcdef')
+    self.add_chunk(session, 0, 'abcdef')
+    session_id = session.key().id()
+    for _ in range(2):
+      stream, error = views._open_upload_session(self.user, session_id)
+      self.assertEqual(error, None)
+      self.assertEqual(stream.read(), 'abcdef')
+    views._discard_upload_session(session_id)
+    self.assertEqual(models.UploadSession.get_by_id(session_id), None)
+    self.assertEqual(self.start('abcdef').received, 0)
+
+  def test_open_incomplete(self):
+    session = self.start('abcdef')
+    self.add_chunk(session, 0, 'abc')
+    stream, error = views._open_upload_session(self.user, session.key().id())
+    self.assertEqual(stream, None)
+    self.assertTrue('incomplete' in error)
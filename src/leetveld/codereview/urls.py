@@ -41,6 +41,7 @@ urlpatterns = patterns(
     (r'^(\d+)/patch/(\d+)/(\d+)$', 'patch'),
     (r'^(\d+)/image/(\d+)/(\d+)/(\d+)$', 'image'),
     (r'^(\d+)/diff/(\d+)/(.+)$', 'diff'),
+    (r'^(\d+)/diff_all/(\d+)$', 'diff_all'),
     (r'^(\d+)/diff2/(\d+):(\d+)/(.+)$', 'diff2'),
     (r'^(\d+)/diff_skipped_lines/(\d+)/(\d+)/(\d+)/(\d+)/([tba])/(\d+)$',
      'diff_skipped_lines'),
@@ -51,7 +52,12 @@ urlpatterns = patterns(
     (r'^(\d+)/diff2_skipped_lines/(\d+):(\d+)/(\d+)/$',
      django.views.defaults.page_not_found, {}, 'diff2_skipped_lines_prefix'),
     (r'^(\d+)/upload_content/(\d+)/(\d+)$', 'upload_content'),
+    (r'^(\d+)/upload_content_batch/(\d+)$', 'upload_content_batch'),
+    (r'^(\d+)/reuse_content/(\d+)$', 'reuse_content'),
     (r'^(\d+)/upload_patch/(\d+)$', 'upload_patch'),
+    (r'^(\d+)/generate_diffs/(\d+)$', 'generate_diffs'),
+    (r'^upload_session$', 'upload_session'),
+    (r'^upload_session/(\d+)$', 'upload_session_chunk'),
     (r'^(\d+)/description$', 'description'),
     (r'^(\d+)/fields', 'fields'),
     (r'^(\d+)/star$', 'star'),
@@ -80,6 +86,7 @@ urlpatterns = patterns(
     # patching upload.py on the fly
     (r'^dynamic/upload.py$', 'customized_upload_py'),
     (r'^search$', 'search'),
+    (r'^tasks/calculate_delta$', 'task_calculate_delta'),
     )
 
 feed_dict = {
@@ -35,10 +35,12 @@ from xml.etree import ElementTree
 # AppEngine imports
 from google.appengine.api import mail
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.api import urlfetch
 from google.appengine.api import xmpp
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from google.appengine.ext.db import djangoforms
 from google.appengine.runtime import DeadlineExceededError
 from google.appengine.runtime import apiproxy_errors
@@ -202,8 +204,14 @@ class UploadForm(forms.Form):
   description = forms.CharField(max_length=10000, required=False)
   content_upload = forms.BooleanField(required=False)
   separate_patches = forms.BooleanField(required=False)
+  # Instead of a diff, the base and current content of the files are
+  # uploaded, see generate_diffs().
+  server_diff = forms.BooleanField(required=False)
+  files = forms.CharField(required=False)
   base = forms.CharField(max_length=2000, required=False)
   data = forms.FileField(required=False)
+  # Instead of data, see upload_session().
+  upload_session = forms.IntegerField(required=False)
   issue = forms.IntegerField(required=False)
   description = forms.CharField(max_length=10000, required=False)
   reviewers = forms.CharField(max_length=1000, required=False)
@@ -218,6 +226,12 @@ class UploadForm(forms.Form):
       raise forms.ValidationError, 'Base URL is required.'
     return self.cleaned_data.get('base')
 
+  def clean_server_diff(self):
+    server_diff = self.cleaned_data.get('server_diff')
+    if server_diff and not self.cleaned_data.get('content_upload', False):
+      raise forms.ValidationError, 'Server diffs require content upload.'
+    return server_diff
+
   def get_base(self):
     return self.cleaned_data.get('base')
 
@@ -229,22 +243,35 @@ class UploadContentForm(forms.Form):
   file_too_large = forms.BooleanField(required=False)
   is_binary = forms.BooleanField(required=False)
   is_current = forms.BooleanField(required=False)
+  # Instead of data, see upload_session().
+  upload_session = forms.IntegerField(required=False)
 
   def clean(self):
     # Check presence of 'data'. We cannot use FileField because
     # it disallows empty files.
     super(UploadContentForm, self).clean()
-    if not self.files and 'data' not in self.files:
+    if (not self.cleaned_data.get('upload_session') and
+        self.add_prefix('data') not in self.files):
       raise forms.ValidationError, 'No content uploaded.'
     return self.cleaned_data
 
   def get_uploaded_content(self):
-    return self.files['data'].read()
+    return self.files[self.add_prefix('data')].read()
+
+
+class ReuseContentForm(forms.Form):
+  patch = forms.IntegerField()
+  status = forms.CharField(required=False, max_length=20)
+  checksum = forms.CharField(max_length=32)
+  is_binary = forms.BooleanField(required=False)
+  is_current = forms.BooleanField(required=False)
 
 
 class UploadPatchForm(forms.Form):
   filename = forms.CharField(max_length=255)
   content_upload = forms.BooleanField(required=False)
+  # Instead of data, see upload_session().
+  upload_session = forms.IntegerField(required=False)
 
   def get_uploaded_patch(self):
     return self.files['data'].read()
@@ -400,6 +427,15 @@ class SearchForm(forms.Form):
       max_value=1000,
       initial=10,
       widget=forms.HiddenInput(attrs={'value': '10'}))
+  text = forms.CharField(required=False,
+                         max_length=500,
+                         widget=forms.TextInput(attrs={'size': 60}),
+                         help_text=('Words in the subject, description, '
+                                    'file names, messages or comments.'))
+  filename = forms.CharField(required=False,
+                             max_length=500,
+                             widget=forms.TextInput(attrs={'size': 60}),
+                             help_text='Words in the file names.')
   closed = forms.NullBooleanField(required=False)
   owner = forms.CharField(required=False,
                           max_length=1000,
@@ -464,6 +500,25 @@ class InvalidIncomingEmailError(Exception):
 counter = 0
 
 
+def _get_shown_emails(request, params):
+  """Helper for respond() returning the users whose nicknames are shown.
+
+  These are the current user, the user of a dashboard, and the owner,
+  reviewers, CCs and message senders of an issue.
+  """
+  emails = [request.user]
+  if params.get('email'):
+    emails.append(params['email'])
+  issue = params.get('issue')
+  if isinstance(issue, models.Issue):
+    emails.append(issue.owner)
+    emails += issue.reviewers
+    emails += issue.cc
+  for message in params.get('messages') or []:
+    emails.append(message.sender)
+  return emails
+
+
 def respond(request, template, params=None):
   """Helper to render a response, passing standard stuff to the response.
 
@@ -505,6 +560,7 @@ def respond(request, template, params=None):
   params['must_choose_nickname'] = must_choose_nickname
   params['uploadpy_hint'] = uploadpy_hint
   params['rietveld_revision'] = django_settings.RIETVELD_REVISION
+  library.prime_nicknames(request, _get_shown_emails(request, params))
   try:
     return render_to_response(template, params,
                               context_instance=RequestContext(request))
@@ -556,17 +612,11 @@ def _clean_int(value, default, min_value=None, max_value=None):
 
 
 def _can_view_issue(user, issue):
-  if user is None:
-    return not issue.private
-  user_email = db.Email(user.email().lower())
-  return (not issue.private
-          or issue.owner == user
-          or user_email in issue.cc
-          or user_email in issue.reviewers)
+  return issue.user_can_view(user)
 
 
 def _notify_issue(request, issue, message):
-  """Try sending an XMPP (chat) message.
+  """Queue an XMPP (chat) message about an issue.
 
   Args:
     request: The request object.
@@ -574,9 +624,7 @@ def _notify_issue(request, issue, message):
     message: Text of message to send, e.g. 'Created'.
 
   The current user and the issue's subject and URL are appended to the message.
-
-  Returns:
-    True if the message was (apparently) delivered, False if not.
+  It is sent by _send_issue_notification() on the task queue.
   """
   iid = issue.key().id()
   emails = [issue.owner.email()]
@@ -584,17 +632,6 @@ def _notify_issue(request, issue, message):
     emails.extend(issue.reviewers)
   if issue.cc:
     emails.extend(issue.cc)
-  accounts = models.Account.get_multiple_accounts_by_email(emails)
-  jids = []
-  for account in accounts.itervalues():
-    logging.debug('email=%r,chat=%r', account.email, account.notify_by_chat)
-    if account.notify_by_chat:
-      jids.append(account.email)
-  if not jids:
-    logging.debug('No XMPP jids to send to for issue %d', iid)
-    return True  # Nothing to do.
-  jids_str = ', '.join(jids)
-  logging.debug('Sending XMPP for issue %d to %s', iid, jids_str)
   sender = '?'
   if models.Account.current_user_account:
     sender = models.Account.current_user_account.nickname
@@ -605,20 +642,40 @@ def _notify_issue(request, issue, message):
                                   issue.subject,
                                   request.build_absolute_uri(
                                     reverse(show, args=[iid])))
+  deferred.defer(_send_issue_notification, iid, emails, message)
+
+
+def _send_issue_notification(iid, emails, message):
+  """Task sending an XMPP message to those who want chat notifications.
+
+  Args:
+    iid: Id of the issue the message is about.
+    emails: Emails of the issue's owner, reviewers and CC.
+    message: Text of the message.
+  """
+  accounts = models.Account.get_multiple_accounts_by_email(emails)
+  jids = []
+  for account in accounts.itervalues():
+    logging.debug('email=%r,chat=%r', account.email, account.notify_by_chat)
+    if account.notify_by_chat:
+      jids.append(account.email)
+  if not jids:
+    logging.debug('No XMPP jids to send to for issue %d', iid)
+    return  # Nothing to do.
+  jids_str = ', '.join(jids)
+  logging.debug('Sending XMPP for issue %d to %s', iid, jids_str)
   try:
     sts = xmpp.send_message(jids, message)
   except Exception, err:
+    # Raising again makes the task queue retry.
     logging.exception('XMPP exception %s sending for issue %d to %s',
                       err, iid, jids_str)
-    return False
+    raise
+  if sts == [xmpp.NO_ERROR] * len(jids):
+    logging.info('XMPP message sent for issue %d to %s', iid, jids_str)
   else:
-    if sts == [xmpp.NO_ERROR] * len(jids):
-      logging.info('XMPP message sent for issue %d to %s', iid, jids_str)
-      return True
-    else:
-      logging.error('XMPP error %r sending for issue %d to %s',
-                    sts, iid, jids_str)
-      return False
+    logging.error('XMPP error %r sending for issue %d to %s',
+                  sts, iid, jids_str)
 
 
 ### Decorators for request handlers ###
@@ -676,6 +733,20 @@ def xsrf_required(func):
   return xsrf_wrapper
 
 
+def taskqueue_required(func):
+  """Decorator that only lets requests made by the task queue through.
+
+  The X-AppEngine-QueueName header is stripped from all other requests.
+  """
+
+  def taskqueue_wrapper(request, *args, **kwds):
+    if 'HTTP_X_APPENGINE_QUEUENAME' not in request.META:
+      return HttpResponseForbidden('This is only available to the task queue.')
+    return func(request, *args, **kwds)
+
+  return taskqueue_wrapper
+
+
 def upload_required(func):
   """Decorator for POST requests from the upload.py script.
 
@@ -1147,58 +1218,56 @@ def show_user(request):
 def _show_user(request):
   user = request.user_to_show
   if user == request.user:
-    query = models.Comment.all().filter('draft =', True)
-    query = query.filter('author =', request.user).fetch(100)
-    draft_keys = set(d.parent_key().parent().parent() for d in query)
-    draft_issues = models.Issue.get(draft_keys)
+    draft_ids = models.Account.current_user_account.drafts
+    draft_issues = [issue for issue in models.Issue.get_by_id(draft_ids)
+                    if issue is not None]
+    draft_keys = set(issue.key() for issue in draft_issues)
   else:
     draft_issues = draft_keys = []
-  my_issues = [
-      issue for issue in db.GqlQuery(
-          'SELECT * FROM Issue '
-          'WHERE closed = FALSE AND owner = :1 '
-          'ORDER BY modified DESC '
-          'LIMIT 100',
-          user)
-      if issue.key() not in draft_keys and _can_view_issue(request.user, issue)]
-  review_issues = [
-      issue for issue in db.GqlQuery(
-          'SELECT * FROM Issue '
-          'WHERE closed = FALSE AND reviewers = :1 '
-          'ORDER BY modified DESC '
-          'LIMIT 100',
-          user.email().lower())
-      if (issue.key() not in draft_keys and issue.owner != user
-          and _can_view_issue(request.user, issue))]
-  closed_issues = [
-      issue for issue in db.GqlQuery(
-          'SELECT * FROM Issue '
-          'WHERE closed = TRUE AND modified > :1 AND owner = :2 '
-          'ORDER BY modified DESC '
-          'LIMIT 100',
-          datetime.datetime.now() - datetime.timedelta(days=7),
-          user)
-      if issue.key() not in draft_keys and _can_view_issue(request.user, issue)]
-  cc_issues = [
-      issue for issue in db.GqlQuery(
-          'SELECT * FROM Issue '
-          'WHERE closed = FALSE AND cc = :1 '
-          'ORDER BY modified DESC '
-          'LIMIT 100',
-          user.email())
-      if (issue.key() not in draft_keys and issue.owner != user
-          and _can_view_issue(request.user, issue))]
+  # Each list is paged separately, with its offset in offset_<list name>.
+  offsets = dict((list_name,
+                  _clean_int(request.GET.get('offset_' + list_name), 0, 0))
+                 for list_name in models.DashboardEntry.LISTS)
+  limit = _clean_int(request.GET.get('limit'), models.DASHBOARD_LIMIT, 1,
+                     models.DASHBOARD_LIMIT)
+  dashboard, next_offsets = models.DashboardEntry.get_issues(user, offsets,
+                                                             limit)
+
+  def visible(issues, others_only=False):
+    return [issue for issue in issues
+            if (issue.key() not in draft_keys
+                and not (others_only and issue.owner == user)
+                and _can_view_issue(request.user, issue))]
+  my_issues = visible(dashboard['mine'])
+  review_issues = visible(dashboard['reviews'], others_only=True)
+  closed_issues = visible(dashboard['closed'])
+  cc_issues = visible(dashboard['cc'], others_only=True)
   all_issues = my_issues + review_issues + closed_issues + cc_issues
   _load_users_for_issues(all_issues)
   _optimize_draft_counts(all_issues)
-  return respond(request, 'user.html',
-                 {'email': user.email(),
-                  'my_issues': my_issues,
-                  'review_issues': review_issues,
-                  'closed_issues': closed_issues,
-                  'cc_issues': cc_issues,
-                  'draft_issues': draft_issues,
-                  })
+  nav_parameters = {'limit': str(limit)}
+  params = {'email': user.email(),
+            'my_issues': my_issues,
+            'review_issues': review_issues,
+            'closed_issues': closed_issues,
+            'cc_issues': cc_issues,
+            'draft_issues': draft_issues,
+            'prev': None,
+            'next': None,
+            }
+  def page_url(offsets):
+    page_parameters = dict(nav_parameters)
+    for list_name, offset in offsets.iteritems():
+      if offset > 0:
+        page_parameters['offset_' + list_name] = str(offset)
+    return _url(request.path, **page_parameters)
+  if next_offsets is not None:
+    params['next'] = page_url(next_offsets)
+  if max(offsets.itervalues()) > 0:
+    params['prev'] = page_url(dict(
+        (list_name, max(0, offset - limit))
+        for list_name, offset in offsets.iteritems()))
+  return respond(request, 'user.html', params)
 
 
 @login_required
@@ -1306,6 +1375,13 @@ def upload(request):
           checksum, filename = file_info.split(":", 1)
           base_hashes[filename] = checksum
 
+        if form.cleaned_data.get('server_diff'):
+          # The text is generated once the contents are uploaded.
+          db.put([models.Patch(patchset=patchset, filename=filename,
+                               parent=patchset)
+                  for filename in form.cleaned_data['files'].splitlines()
+                  if filename])
+
         content_entities = []
         new_content_entities = []
         patches = list(patchset.patch_set)
@@ -1349,60 +1425,271 @@ def upload(request):
   return HttpResponse(msg, content_type='text/plain')
 
 
-@post_required
-@patch_required
-@upload_required
-def upload_content(request):
-  """/<issue>/upload_content/<patchset>/<patch> - Upload base file contents.
-
-  Used by upload.py to upload base files.
-  """
-  form = UploadContentForm(request.POST, request.FILES)
-  if not form.is_valid():
-    return HttpResponse('ERROR: Upload content errors:\n%s' % repr(form.errors),
-                        content_type='text/plain')
+def _check_upload_user(request):
+  """Returns an error response if upload.py isn't logged in."""
   if request.user is None:
     if IS_DEV:
-      request.user = users.User(request.POST.get('user', 'test@example.com'))
+      request.user = users.User(request.REQUEST.get('user',
+                                                    'test@example.com'))
     else:
       return HttpResponse('Error: Login required', status=401)
+  return None
+
+
+def _check_upload_owner(request):
+  """Returns an error response if the user may not upload to the issue."""
+  response = _check_upload_user(request)
+  if response is not None:
+    return response
   if request.user != request.issue.owner:
     return HttpResponse('ERROR: You (%s) don\'t own this issue (%s).' %
                         (request.user, request.issue.key().id()))
-  patch = request.patch
+  return None
+
+
+def _get_upload_target(patch, form):
+  """Updates a patch for uploaded content and returns its Content.
+
+  Args:
+    patch: The Patch the content belongs to.
+    form: A valid UploadContentForm or ReuseContentForm.
+
+  Returns:
+    The Content entity to store the data in, or None if the current content
+    was already uploaded.
+  """
   patch.status = form.cleaned_data['status']
   patch.is_binary = form.cleaned_data['is_binary']
   patch.put()
 
   if form.cleaned_data['is_current']:
-    if patch.patched_content:
-      return HttpResponse('ERROR: Already have current content.')
-    content = models.Content(is_uploaded=True, parent=patch)
-    content.put()
-    patch.patched_content = content
-    patch.put()
+    content = patch.patched_content
+    if content is not None and content.is_uploaded:
+      return None
+    if content is None:
+      content = models.Content(is_uploaded=True, parent=patch)
+      content.put()
+      patch.patched_content = content
+      patch.put()
+    else:
+      # Stored by Patch.materialize_patched_content(), the upload wins.
+      content.is_uploaded = True
   else:
     content = patch.content
+  return content
+
+
+def _get_uploaded_patch(request, patches, patch_id):
+  """Returns a patch of request.patchset, using patches as cache."""
+  patch = patches.get(patch_id)
+  if patch is None:
+    patch = models.Patch.get_by_id(patch_id, parent=request.patchset)
+    if patch is not None:
+      patch.patchset = request.patchset
+      patches[patch_id] = patch
+  return patch
+
+
+def _store_uploaded_content(patch, form, stream=None):
+  """Stores the base or current content uploaded for a patch.
+
+  Args:
+    patch: The Patch the content belongs to.
+    form: A valid UploadContentForm.
+    stream: Optional file with the content, instead of the form's data.
+
+  Returns:
+    None on success, otherwise an error message.
+  """
+  content = _get_upload_target(patch, form)
+  if content is None:
+    return 'ERROR: Already have current content.'
 
   if form.cleaned_data['file_too_large']:
     content.file_too_large = True
+    if not form.cleaned_data['is_current']:
+      # Without a base file there are no delta links (see _calculate_delta()),
+      # but the delta task may already have run.
+      patch.delta = []
+      patch.put()
   else:
-    data = form.get_uploaded_content()
+    if stream is not None:
+      data = stream.read()
+    else:
+      data = form.get_uploaded_content()
     checksum = md5.new(data).hexdigest()
-    if checksum != request.POST.get('checksum'):
+    if checksum != form.cleaned_data['checksum']:
       content.is_bad = True
       content.put()
-      return HttpResponse('ERROR: Checksum mismatch.',
-                          content_type='text/plain')
+      return 'ERROR: Checksum mismatch.'
     if patch.is_binary:
       content.data = data
     else:
       content.text = engine.ToText(engine.UnifyLinebreaks(data))
     content.checksum = checksum
   content.put()
+  if not content.file_too_large:
+    models.ContentChecksum.register(content, patch.is_binary)
+  return None
+
+
+@post_required
+@patch_required
+@upload_required
+def upload_content(request):
+  """/<issue>/upload_content/<patchset>/<patch> - Upload base file contents.
+
+  Used by upload.py to upload base files.
+  """
+  form = UploadContentForm(request.POST, request.FILES)
+  if not form.is_valid():
+    return HttpResponse('ERROR: Upload content errors:\n%s' % repr(form.errors),
+                        content_type='text/plain')
+  response = _check_upload_owner(request)
+  if response is not None:
+    return response
+  stream = None
+  if form.cleaned_data.get('upload_session'):
+    stream, error = _open_upload_session(request.user,
+                                         form.cleaned_data['upload_session'])
+    if error:
+      return HttpResponse('ERROR: %s' % error, content_type='text/plain')
+  error = _store_uploaded_content(request.patch, form, stream)
+  if error:
+    return HttpResponse(error, content_type='text/plain')
+  _discard_upload_session(form.cleaned_data.get('upload_session'))
+  if not form.cleaned_data['is_current']:
+    _enqueue_materialize_patched_contents(request.issue, request.patchset,
+                                          [request.patch])
   return HttpResponse('OK', content_type='text/plain')
 
 
+# Matches MAX_UPLOAD_BATCH_FILES in upload.py.
+MAX_BATCH_FILES = 50
+
+
+def _get_batch_count(request):
+  """Returns the number of files sent to a batch view, None if invalid."""
+  try:
+    count = int(request.POST.get('count', ''))
+  except ValueError:
+    return None
+  if not 0 <= count <= MAX_BATCH_FILES:
+    return None
+  return count
+
+
+@post_required
+@patchset_required
+@upload_required
+def upload_content_batch(request):
+  """/<issue>/upload_content_batch/<patchset> - Upload several base files.
+
+  Used by upload.py to upload many small files in one request.  The
+  fields of upload_content() are sent once per file, prefixed with the
+  index of the file (e.g. "0-filename", "0-data"), together with the
+  patch id ("0-patch") and the number of files ("count"), which is at
+  most MAX_BATCH_FILES.
+
+  The response has one line per file, "<index> OK" or "<index> ERROR: ...".
+  """
+  response = _check_upload_owner(request)
+  if response is not None:
+    return response
+  count = _get_batch_count(request)
+  if count is None:
+    return HttpResponseBadRequest(
+        'ERROR: Missing or invalid count (at most %d files).' %
+        MAX_BATCH_FILES, content_type='text/plain')
+  patches = {}
+  based = []
+  lines = []
+  for index in xrange(count):
+    prefix = str(index)
+    form = UploadContentForm(request.POST, request.FILES, prefix=prefix)
+    if not form.is_valid():
+      lines.append('%d ERROR: Upload content errors: %r' %
+                   (index, form.errors))
+      continue
+    patch_id = request.POST.get('%s-patch' % prefix, '')
+    if not patch_id.isdigit():
+      lines.append('%d ERROR: Missing patch id.' % index)
+      continue
+    # The base and current content of a file are often in the same batch.
+    patch = _get_uploaded_patch(request, patches, int(patch_id))
+    if patch is None:
+      lines.append('%d ERROR: No patch exists with that id (%s/%s)' %
+                   (index, request.patchset.key().id(), patch_id))
+      continue
+    error = _store_uploaded_content(patch, form)
+    lines.append('%d %s' % (index, error or 'OK'))
+    if not error and not form.cleaned_data['is_current']:
+      based.append(patch)
+  _enqueue_materialize_patched_contents(request.issue, request.patchset, based)
+  return HttpResponse('\n'.join(lines), content_type='text/plain')
+
+
+@post_required
+@patchset_required
+@upload_required
+def reuse_content(request):
+  """/<issue>/reuse_content/<patchset> - Reuse already uploaded files.
+
+  Used by upload.py before uploading base and current files.  For each
+  file it sends the fields of upload_content() without the data, prefixed
+  like for upload_content_batch(), and at most MAX_BATCH_FILES files.
+  Files with a checksum the server has seen in any issue are copied from
+  there.
+
+  The response has one line per file, "<index> OK" if the file was
+  reused, "<index> MISSING" if it must be uploaded.
+  """
+  response = _check_upload_owner(request)
+  if response is not None:
+    return response
+  count = _get_batch_count(request)
+  if count is None:
+    return HttpResponseBadRequest(
+        'ERROR: Missing or invalid count (at most %d files).' %
+        MAX_BATCH_FILES, content_type='text/plain')
+  reuse_forms = [ReuseContentForm(request.POST, prefix=str(index))
+                 for index in xrange(count)]
+  known = models.ContentChecksum.get_contents(
+    form.cleaned_data['checksum'] for form in reuse_forms if form.is_valid())
+  patches = {}
+  based = []
+  lines = []
+  for index, form in enumerate(reuse_forms):
+    if not form.is_valid():
+      lines.append('%d ERROR: Reuse content errors: %r' % (index, form.errors))
+      continue
+    source, is_binary = known.get(form.cleaned_data['checksum'],
+                                  (None, None))
+    if source is None or is_binary != form.cleaned_data['is_binary']:
+      lines.append('%d MISSING' % index)
+      continue
+    patch = _get_uploaded_patch(request, patches, form.cleaned_data['patch'])
+    if patch is None:
+      lines.append('%d ERROR: No patch exists with that id (%s/%s)' %
+                   (index, request.patchset.key().id(),
+                    form.cleaned_data['patch']))
+      continue
+    content = _get_upload_target(patch, form)
+    if content is None:
+      lines.append('%d ERROR: Already have current content.' % index)
+      continue
+    # Contents are deleted with their issue, so this issue gets a copy.
+    content.text = source.text
+    content.data = source.data
+    content.checksum = source.checksum
+    content.put()
+    lines.append('%d OK' % index)
+    if not form.cleaned_data['is_current']:
+      based.append(patch)
+  _enqueue_materialize_patched_contents(request.issue, request.patchset, based)
+  return HttpResponse('\n'.join(lines), content_type='text/plain')
+
+
 @post_required
 @patchset_required
 @upload_required
@@ -1412,14 +1699,9 @@ def upload_patch(request):
   Used by upload.py to upload a patch when the diff is too large to upload all
   together.
   """
-  if request.user is None:
-    if IS_DEV:
-      request.user = users.User(request.POST.get('user', 'test@example.com'))
-    else:
-      return HttpResponse('Error: Login required', status=401)
-  if request.user != request.issue.owner:
-    return HttpResponse('ERROR: You (%s) don\'t own this issue (%s).' %
-                        (request.user, request.issue.key().id()))
+  response = _check_upload_owner(request)
+  if response is not None:
+    return response
   form = UploadPatchForm(request.POST, request.FILES)
   if not form.is_valid():
     return HttpResponse('ERROR: Upload patch errors:\n%s' % repr(form.errors),
@@ -1428,7 +1710,15 @@ def upload_patch(request):
   if patchset.data:
     return HttpResponse('ERROR: Can\'t upload patches to patchset with data.',
                         content_type='text/plain')
-  text = engine.ToText(engine.UnifyLinebreaks(form.get_uploaded_patch()))
+  if form.cleaned_data.get('upload_session'):
+    stream, error = _open_upload_session(request.user,
+                                         form.cleaned_data['upload_session'])
+    if error:
+      return HttpResponse('ERROR: %s' % error, content_type='text/plain')
+    data = stream.read()
+  else:
+    data = form.get_uploaded_patch()
+  text = engine.ToText(engine.UnifyLinebreaks(data))
   patch = models.Patch(patchset=patchset,
                        text=text,
                        filename=form.cleaned_data['filename'], parent=patchset)
@@ -1438,11 +1728,182 @@ def upload_patch(request):
     content.put()
     patch.content = content
     patch.put()
+  _discard_upload_session(form.cleaned_data.get('upload_session'))
+  _add_to_delta_index(request.issue, patchset,
+                      [(patch.filename, _text_digest(patch.text))])
+  _enqueue_calculate_delta(request.issue, patchset, patch)
+  if not form.cleaned_data.get('content_upload'):
+    _enqueue_prefetch_base_files(request.issue, patchset, patch)
 
   msg = 'OK\n' + str(patch.key().id())
   return HttpResponse(msg, content_type='text/plain')
 
 
+@post_required
+@upload_required
+def upload_session(request):
+  """/upload_session - Start or resume uploading a file in chunks.
+
+  Used by upload.py for files too large for one request.  The POST fields
+  are the size and MD5 checksum of the file; an unfinished session for the
+  same file is resumed.  The chunks are sent to upload_session_chunk(),
+  then the session id is passed as upload_session field to upload(),
+  upload_patch() or upload_content() instead of the data.
+
+  The response is "OK", the session id and the number of bytes already
+  received, on separate lines.
+  """
+  response = _check_upload_user(request)
+  if response is not None:
+    return response
+  try:
+    size = int(request.POST.get('size', ''))
+  except ValueError:
+    size = -1
+  checksum = request.POST.get('checksum', '')
+  if (not 0 <= size <= models.UPLOAD_SESSION_MAX_SIZE or
+      not re.match(r'[0-9a-f]{32}$', checksum)):
+    return HttpResponseBadRequest('ERROR: Invalid size or checksum.',
+                                  content_type='text/plain')
+  session = models.UploadSession.get_or_start(request.user, size, checksum)
+  return HttpResponse('OK\n%d\n%d' % (session.key().id(), session.received),
+                      content_type='text/plain')
+
+
+@post_required
+@upload_required
+def upload_session_chunk(request, session_id):
+  """/upload_session/<session> - Upload a chunk of a file.
+
+  The request body is the chunk, the offset query parameter its position
+  in the file.  Chunks must be sent in order, sending one again is
+  harmless.
+
+  The response is "OK" and the number of bytes received so far.
+  """
+  response = _check_upload_user(request)
+  if response is not None:
+    return response
+  session = models.UploadSession.get_by_id(int(session_id))
+  if session is None or session.owner != request.user:
+    return HttpResponseNotFound('No upload session exists with that id (%s)' %
+                                session_id)
+  try:
+    offset = int(request.GET.get('offset', ''))
+  except ValueError:
+    return HttpResponseBadRequest('ERROR: Missing or invalid offset.',
+                                  content_type='text/plain')
+  data = request.raw_post_data
+  if len(data) > models.UPLOAD_CHUNK_MAX_SIZE:
+    return HttpResponse('ERROR: Chunk too large.', status=413,
+                        content_type='text/plain')
+  try:
+    received = db.run_in_transaction(session.add_chunk, offset, data)
+  except ValueError, err:
+    return HttpResponse('ERROR: %s' % err, content_type='text/plain')
+  return HttpResponse('OK\n%d' % received, content_type='text/plain')
+
+
+def _open_upload_session(user, session_id):
+  """Returns a file with the data of a finished upload session.
+
+  The file is independent of the session.  The session is kept, so that
+  a request failing afterwards can be retried without uploading the data
+  again; _discard_upload_session() deletes it once the data is stored.
+
+  Returns:
+    A 2-tuple (file, error message), file is None if there's an error.
+  """
+  session = models.UploadSession.get_by_id(session_id)
+  if session is None or session.owner != user:
+    return None, 'No upload session exists with that id (%s)' % session_id
+  stream = session.open()
+  if stream is None and session.received < session.size:
+    return None, ('Upload session %s is incomplete (%d of %d bytes).' %
+                  (session_id, session.received, session.size))
+  if stream is None:
+    # A client uploading the same file again must start a new session.
+    session.discard()
+    return None, 'Upload session %s is corrupt.' % session_id
+  return stream, None
+
+
+def _discard_upload_session(session_id):
+  """Deletes an upload session whose data was stored for good.
+
+  A client uploading the same file again must start a new session then.
+  """
+  if not session_id:
+    return
+  session = models.UploadSession.get_by_id(session_id)
+  if session is not None:
+    session.discard()
+
+
+@post_required
+@patchset_required
+@upload_required
+def generate_diffs(request):
+  """/<issue>/generate_diffs/<patchset> - Generate the diffs of a patchset.
+
+  Used by upload.py --server_diff once the base and current content of all
+  files is uploaded.  The diffs are generated on the task queue, see
+  _generate_diff().
+  """
+  response = _check_upload_owner(request)
+  if response is not None:
+    return response
+  issue_id = request.issue.key().id()
+  patchset_id = request.patchset.key().id()
+  count = 0
+  for patch in request.patchset.patch_set:
+    if patch.text is not None:
+      continue
+    count += 1
+    try:
+      deferred.defer(_generate_diff, issue_id, patchset_id, patch.key().id(),
+                     _name='diff-%d-%d' % (patchset_id, patch.key().id()))
+    except taskqueue.TaskAlreadyExistsError:
+      pass
+  return HttpResponse('OK\n%d' % count, content_type='text/plain')
+
+
+def _generate_diff(issue_id, patchset_id, patch_id):
+  """Task creating Patch.text from the uploaded base and current content.
+
+  The current content is stored already, so it never has to be created by
+  applying the patch.  The delta links of the patch are calculated here
+  too.
+  """
+  issue = models.Issue.get_by_id(issue_id)
+  patchset = issue and models.PatchSet.get_by_id(patchset_id, parent=issue)
+  patch = patchset and models.Patch.get_by_id(patch_id, parent=patchset)
+  if patch is None or patch.text is not None:
+    return
+  patch.patchset = patchset
+  header = 'Index: %s\n%s\n' % (patch.filename, '=' * 67)
+  if patch.is_binary:
+    text = (header + 'Cannot display: file marked as a binary type.\n'
+            'svn:mime-type = application/octet-stream\n')
+  elif patch.no_base_file or (patch.patched_content and
+                              patch.patched_content.file_too_large):
+    text = header + 'Cannot display: file too large.\n'
+  else:
+    contents = [patch.content, patch.patched_content]
+    for content in contents:
+      if content is None or content.text is None or content.is_bad:
+        # Raising makes the task queue try again later.
+        raise engine.FetchError('Content of %s not uploaded yet.' %
+                                patch.filename)
+    text = patching.MakeUnifiedDiff(contents[0].lines, contents[1].lines,
+                                    patch.filename)
+  patch.text = engine.ToText(text)
+  patch.put()
+  _add_to_delta_index(issue, patchset,
+                      [(patch.filename, _text_digest(patch.text))])
+  _calculate_delta(issue, patchset, [patch])
+
+
 class EmptyPatchSet(Exception):
   """Exception used inside _make_new() to break out of the transaction."""
 
@@ -1455,7 +1916,7 @@ def _make_new(request, form):
   if not form.is_valid():
     return None
 
-  data_url = _get_data_url(form)
+  data_url = _get_data_url(form, request.user)
   if data_url is None:
     return None
   data, url, separate_patches = data_url
@@ -1482,15 +1943,15 @@ def _make_new(request, form):
                          n_comments=0)
     issue.put()
 
-    patchset = models.PatchSet(issue=issue, data=data, url=url, parent=issue)
+    patchset = models.PatchSet(issue=issue, url=url, parent=issue)
     patchset.put()
     issue.patchset = patchset
 
     if not separate_patches:
-      patches = engine.ParsePatchSet(patchset)
-      if not patches:
+      file_digests = _store_patchset_data(patchset, data)
+      if not file_digests:
         raise EmptyPatchSet  # Abort the transaction
-      db.put(patches)
+      _add_to_delta_index(issue, patchset, file_digests, complete=True)
     return issue
 
   try:
@@ -1499,6 +1960,11 @@ def _make_new(request, form):
     errkey = url and 'url' or 'data'
     form.errors[errkey] = ['Patch set contains no recognizable patches']
     return None
+  _discard_upload_session(form.cleaned_data.get('upload_session'))
+  if not separate_patches:
+    _enqueue_calculate_delta(issue, issue.patchset)
+    if not form.cleaned_data.get('content_upload'):
+      _enqueue_prefetch_base_files(issue, issue.patchset)
 
   if form.cleaned_data.get('send_mail'):
     msg = _make_message(request, issue, '', '', True)
@@ -1507,15 +1973,16 @@ def _make_new(request, form):
   return issue
 
 
-def _get_data_url(form):
+def _get_data_url(form, user):
   """Helper for _make_new() above and add() below.
 
   Args:
     form: Django form object.
+    user: The user uploading the patchset.
 
   Returns:
     3-tuple (data, url, separate_patches).
-      data: the diff content, if available.
+      data: a file-like object with the diff content, if available.
       url: the url of the diff, if given.
       separate_patches: True iff the patches will be uploaded separately for
         each file.
@@ -1525,7 +1992,19 @@ def _get_data_url(form):
 
   data = cleaned_data['data']
   url = cleaned_data.get('url')
-  separate_patches = cleaned_data.get('separate_patches')
+  # Patches are added later by upload_patch() or generate_diffs().
+  separate_patches = (cleaned_data.get('separate_patches') or
+                      cleaned_data.get('server_diff'))
+  session_id = cleaned_data.get('upload_session')
+  if session_id:
+    if data:
+      form.errors['data'] = ['You must specify either an upload session or '
+                             'upload a file but not both.']
+      return None
+    data, error = _open_upload_session(user, session_id)
+    if error:
+      form.errors['data'] = [error]
+      return None
   if not (data or url or separate_patches):
     form.errors['data'] = ['You must specify a URL or upload a file (< 1 MB).']
     return None
@@ -1539,7 +2018,7 @@ def _get_data_url(form):
     return None
 
   if data is not None:
-    data = db.Blob(engine.UnifyLinebreaks(data.read()))
+    # Read by _store_patchset_data(), large uploads are temporary files.
     url = None
   elif url:
     try:
@@ -1550,11 +2029,58 @@ def _get_data_url(form):
     if fetch_result.status_code != 200:
       form.errors['url'] = ['HTTP status code %s' % fetch_result.status_code]
       return None
-    data = db.Blob(engine.UnifyLinebreaks(fetch_result.content))
+    data = StringIO(fetch_result.content)
 
   return data, url, separate_patches
 
 
+# Diffs up to this size are also kept whole in PatchSet.data, for
+# downloading them.  Larger ones are only stored as patches.
+PATCHSET_DATA_MAX_SIZE = 1024 * 1024
+
+
+def _store_patchset_data(patchset, stream):
+  """Stores a diff in a new patchset and creates its patches.
+
+  The diff is read in chunks and each Patch is put as soon as its part of
+  the diff is complete, so only one file's patch is held in memory.  Diffs
+  up to PATCHSET_DATA_MAX_SIZE are also kept for PatchSet.data; larger
+  ones don't get data, like patchsets uploaded as separate patches.
+
+  Args:
+    patchset: The saved PatchSet, without data.
+    stream: A file-like object with the diff.
+
+  Returns:
+    A list of (filename, digest) for the new patches, see
+    _add_to_delta_index().  If it's empty, no patches were found and the
+    patchset is left unchanged.
+  """
+  chunks = []
+  sizes = [0]
+
+  def read_chunks():
+    for chunk in engine.IterUnifiedChunks(stream):
+      sizes[0] += len(chunk)
+      if sizes[0] <= PATCHSET_DATA_MAX_SIZE:
+        chunks.append(chunk)
+      else:
+        del chunks[:]
+      yield chunk
+
+  file_digests = []
+  for filename, text in engine.IterSplitPatch(
+      engine.IterLines(read_chunks())):
+    patch = models.Patch(patchset=patchset, text=engine.ToText(text),
+                         filename=filename, parent=patchset)
+    patch.put()
+    file_digests.append((filename, _text_digest(patch.text)))
+  if file_digests and sizes[0] <= PATCHSET_DATA_MAX_SIZE:
+    patchset.data = db.Blob(''.join(chunks))
+    patchset.put()
+  return file_digests
+
+
 @post_required
 @issue_owner_required
 @xsrf_required
@@ -1572,7 +2098,7 @@ def _add_patchset_from_form(request, issue, form, message_key='message',
   """Helper for add() and upload()."""
   # TODO(guido): use a transaction like in _make_new(); may be share more code?
   if form.is_valid():
-    data_url = _get_data_url(form)
+    data_url = _get_data_url(form, request.user)
   if not form.is_valid():
     return None
   if request.user != issue.owner:
@@ -1580,18 +2106,22 @@ def _add_patchset_from_form(request, issue, form, message_key='message',
     return None
   data, url, separate_patches = data_url
   message = form.cleaned_data[message_key]
-  patchset = models.PatchSet(issue=issue, message=message, data=data, url=url,
+  patchset = models.PatchSet(issue=issue, message=message, url=url,
                              parent=issue)
   patchset.put()
 
   if not separate_patches:
-    patches = engine.ParsePatchSet(patchset)
-    if not patches:
+    file_digests = _store_patchset_data(patchset, data)
+    if not file_digests:
       patchset.delete()
       errkey = url and 'url' or 'data'
       form.errors[errkey] = ['Patch set contains no recognizable patches']
       return None
-    db.put(patches)
+    _discard_upload_session(form.cleaned_data.get('upload_session'))
+    _add_to_delta_index(issue, patchset, file_digests, complete=True)
+    _enqueue_calculate_delta(issue, patchset)
+    if not form.cleaned_data.get('content_upload'):
+      _enqueue_prefetch_base_files(issue, patchset)
 
   if emails_add_only:
     emails = _get_emails(form, 'reviewers')
@@ -1615,6 +2145,134 @@ def _add_patchset_from_form(request, issue, form, message_key='message',
   return patchset
 
 
+PREFETCH_KEY = 'prefetch_base:%d'
+PREFETCH_TIMEOUT = 24 * 60 * 60
+
+
+def _enqueue_prefetch_base_files(issue, patchset, patch=None):
+  """Queues fetching the base files of new patches, unless they're uploaded.
+
+  Args:
+    issue: The issue the patchset belongs to.
+    patchset: The patchset with new patches.
+    patch: If given, only this patch is new.
+  """
+  if issue.local_base or not issue.base:
+    return
+  if patch is None:
+    # Tells _get_patchset_info() that this patchset is taken care of.
+    memcache.add(PREFETCH_KEY % patchset.key().id(), True, PREFETCH_TIMEOUT)
+  deferred.defer(_prefetch_base_files, issue.key().id(), patchset.key().id(),
+                 patch and patch.key().id())
+
+
+def _prefetch_base_files(issue_id, patchset_id, patch_id=None):
+  """Task fetching base files so the diff views don't have to.
+
+  Without it the first view of each file fetches its base file.  Missing
+  base files are fetched concurrently and stored with one put.
+  """
+  issue = models.Issue.get_by_id(issue_id)
+  if issue is None or issue.local_base:
+    return
+  patchset = models.PatchSet.get_by_id(patchset_id, parent=issue)
+  if patchset is None:
+    return
+  if patch_id is None:
+    patches = list(patchset.patch_set)
+  else:
+    patches = [models.Patch.get_by_id(patch_id, parent=patchset)]
+  fetched = _fetch_base_files(issue, [p for p in patches if p is not None])
+  patchset.issue = issue
+  for patch in fetched:
+    patch.patchset = patchset
+    _materialize_patched_content(patch)
+
+
+def _fetch_base_files(issue, patches):
+  """Fetches and stores the base files of patches that don't have one.
+
+  Missing base files are fetched concurrently and stored with one put.
+
+  Returns:
+    The patches whose base file was stored.
+  """
+  missing = []
+  for patch in patches:
+    try:
+      if patch.content is not None:
+        continue
+    except db.Error:
+      # This may happen when a Content entity was deleted behind our back.
+      patch.content = None
+    missing.append(patch)
+  fetched = []
+  contents = []
+  for patch, content, err in engine.FetchBases(issue.base, missing):
+    if err is not None:
+      # The diff views report the error when the file is shown.
+      logging.info('Fetching base of %s failed: %s', patch.filename, err)
+    else:
+      fetched.append(patch)
+      contents.append(content)
+  if contents:
+    db.put(contents)
+    for patch, content in zip(fetched, contents):
+      patch.content = content
+    db.put(fetched)
+  return fetched
+
+
+def _enqueue_materialize_patched_contents(issue, patchset, patches):
+  """Queues storing the patched content of patches with a new base file.
+
+  Args:
+    issue: The issue the patchset belongs to.
+    patchset: The patchset of the patches.
+    patches: Patches whose base content was just stored.
+  """
+  patch_ids = [patch.key().id() for patch in patches
+               if not patch.is_binary and patch.text is not None]
+  if patch_ids:
+    deferred.defer(_materialize_patched_contents, issue.key().id(),
+                   patchset.key().id(), patch_ids)
+
+
+def _materialize_patched_contents(issue_id, patchset_id, patch_ids):
+  """Task storing patched contents so the diff views don't compute them.
+
+  The patches are read again, so a task running twice or after the new
+  content was uploaded doesn't store anything.
+  """
+  issue = models.Issue.get_by_id(issue_id)
+  if issue is None:
+    return
+  patchset = models.PatchSet.get_by_id(patchset_id, parent=issue)
+  if patchset is None:
+    return
+  patchset.issue = issue
+  for patch_id in patch_ids:
+    patch = models.Patch.get_by_id(patch_id, parent=patchset)
+    if patch is not None:
+      patch.patchset = patchset
+      _materialize_patched_content(patch)
+
+
+def _materialize_patched_content(patch):
+  """Helper storing the patched content of a patch with a base file."""
+  try:
+    if patch.content is None or patch.content.file_too_large:
+      return
+  except db.Error:
+    # This may happen when a Content entity was deleted behind our back.
+    return
+  try:
+    patch.materialize_patched_content()
+  except engine.FetchError, err:
+    # The diff views report the error when the file is shown.
+    logging.info('Patching %s failed: %s', patch.filename, err)
+
+
 def _get_emails(form, label):
   """Helper to return the list of reviewers, or None for error."""
   raw_emails = form.cleaned_data.get(label)
@@ -1649,176 +2307,226 @@ def _get_emails_from_raw(raw_emails, form=None, label=None):
   return emails
 
 
-def _calculate_delta(patch, patchset_id, patchsets):
-  """Calculates which files in earlier patchsets this file differs from.
+def _text_digest(text):
+  """Helper returning the hex digest used to compare patch texts."""
+  if isinstance(text, unicode):
+    text = text.encode('utf-8')
+  return md5.new(text or '').hexdigest()
+
+
+def _add_to_delta_index(issue, patchset, file_digests, complete=False):
+  """Records the digests of new patches in the issue's DeltaIndex.
 
   Args:
-    patch: The file to compare.
-    patchset_id: The file's patchset's key id.
-    patchsets: A list of existing patchsets.
+    issue: The issue the patchset belongs to.
+    patchset: The patchset with new patches.
+    file_digests: A list of (filename, _text_digest(patch.text)).
+    complete: True if these are all the files of the patchset.
+  """
+  models.DeltaIndex.add(issue, patchset.key().id(), file_digests, complete)
 
-  Returns:
-    A list of patchset ids.
+
+def _backfill_delta_index(issue, patchset_ids):
+  """Completes the DeltaIndex of patchsets not known to be indexed.
+
+  Those are patchsets uploaded before DeltaIndex existed and patchsets
+  whose patches were uploaded or generated one by one.  Only the texts of
+  patches missing from the index are loaded.  A patchset is marked
+  complete once every patch has a diff.
   """
-  delta = []
-  if patch.no_base_file:
-    return delta
-  for other in patchsets:
-    if patchset_id == other.key().id():
-      break
-    if other.data or other.parsed_patches:
-      # Loading all the Patch entities in every PatchSet takes too long
-      # (DeadLineExceeded) and consumes a lot of memory (MemoryError) so instead
-      # just parse the patchset's data.  Note we can only do this if the
-      # patchset was small enough to fit in the data property.
-      if other.parsed_patches is None:
-        # PatchSet.data is stored as db.Blob (str). Try to convert it
-        # to unicode so that Python doesn't need to do this conversion
-        # when comparing text and patch.text, which is db.Text
-        # (unicode).
-        try:
-          other.parsed_patches = engine.SplitPatch(other.data.decode('utf-8'))
-        except UnicodeDecodeError:  # Fallback to str - unicode comparison.
-          other.parsed_patches = engine.SplitPatch(other.data)
-        other.data = None  # Reduce memory usage.
-      for filename, text in other.parsed_patches:
-        if filename == patch.filename:
-          if text != patch.text:
-            delta.append(other.key().id())
-          break
+  for patchset_id in patchset_ids:
+    patchset = models.PatchSet.get_by_id(patchset_id, parent=issue)
+    if patchset is None:
+      continue
+    indexed = models.DeltaIndex.get_filenames(issue, patchset_id)
+    file_digests = []
+    complete = True
+    for patch in models.Patch.all().filter('patchset =', patchset):
+      if patch.filename in indexed:
+        continue
+      if patch.text is None:
+        # The diff isn't generated yet, _generate_diff() adds it.
+        complete = False
       else:
-        # We could not find the file in the previous patchset. It must
-        # be new wrt that patchset.
-        delta.append(other.key().id())
+        file_digests.append((patch.filename, _text_digest(patch.text)))
+    _add_to_delta_index(issue, patchset, file_digests, complete)
+
+
+def _calculate_delta(issue, patchset, patches):
+  """Calculates which files in earlier patchsets the given files differ from.
+
+  Each patch is compared to the same file in the patchsets uploaded before
+  its own by comparing the digests in the issue's DeltaIndex, so no patch
+  text is loaded.  The result is stored in Patch.delta.
+
+  Args:
+    issue: The issue the patchset belongs to.
+    patchset: The patchset the patches belong to.
+    patches: A list of models.Patch instances of that patchset.
+  """
+  if not patches:
+    return
+  patchset_id = patchset.key().id()
+  earlier_ids = []
+  for other in issue.patchset_set.order('created'):
+    if other.key().id() == patchset_id:
+      break
+    earlier_ids.append(other.key().id())
+  complete = models.DeltaIndex.get_complete(issue, earlier_ids)
+  missing = [other_id for other_id in earlier_ids if other_id not in complete]
+  if missing:
+    _backfill_delta_index(issue, missing)
+  digests = models.DeltaIndex.get_digests(
+      issue, set(patch.filename for patch in patches))
+  changed = False
+  for patch in patches:
+    old_delta = patch.delta_calculated and list(patch.delta)
+    if patch.no_base_file:
+      patch.delta = []
     else:
-      # other (patchset) is too big to hold all the patches inside itself, so
-      # we need to go to the datastore.  Use the index to see if there's a
-      # patch against our current file in other.
-      query = models.Patch.all()
-      query.filter("filename =", patch.filename)
-      query.filter("patchset =", other.key())
-      other_patches = query.fetch(100)
-      if other_patches and len(other_patches) > 1:
-        logging.info("Got %s patches with the same filename for a patchset",
-                     len(other_patches))
-      for op in other_patches:
-        if op.text != patch.text:
-          delta.append(other.key().id())
-          break
-      else:
-        # We could not find the file in the previous patchset. It must
-        # be new wrt that patchset.
-        delta.append(other.key().id())
+      known = digests.get(patch.filename, {})
+      digest = known.get(patchset_id) or _text_digest(patch.text)
+      # Files missing in an earlier patchset are new wrt that patchset.
+      patch.delta = [other_id for other_id in earlier_ids
+                     if known.get(other_id) != digest]
+    # New patches aren't in the navigation yet either.
+    changed = changed or old_delta != patch.delta
+    patch.delta_calculated = True
+    # A multi-entity put would be quicker, but it fails when the patches
+    # have content that is large.
+    patch.put()
+  if changed:
+    # The navigation lists the deltas.
+    models.PatchSet.reset_navigation(patchset.key())
+
 
-  return delta
+DELTA_KEY = 'calculate_delta:%d'
+DELTA_TIMEOUT = 24 * 60 * 60
+
+
+def _enqueue_calculate_delta(issue, patchset, patch=None):
+  """Adds a task calculating Patch.delta for new patches of a patchset.
+
+  Args:
+    issue: The issue the patchset belongs to.
+    patchset: The patchset with new patches.
+    patch: If given, only this patch is new.
+  """
+  # Tells _get_patchset_info() that this patchset is taken care of.
+  memcache.add(DELTA_KEY % patchset.key().id(), True, DELTA_TIMEOUT)
+  params = {'issue': issue.key().id(), 'patchset': patchset.key().id()}
+  name = 'delta-%d-%d' % (issue.key().id(), patchset.key().id())
+  if patch is not None:
+    params['patch'] = patch.key().id()
+    name += '-%d' % patch.key().id()
+  try:
+    taskqueue.add(url=reverse(task_calculate_delta), params=params,
+                  name=name)
+  except taskqueue.TaskAlreadyExistsError:
+    pass
+
+
+@post_required
+@taskqueue_required
+def task_calculate_delta(request):
+  """/tasks/calculate_delta - Calculates the delta links of new patches.
+
+  Runs on the task queue after a patchset was uploaded.  The patches are
+  compared against earlier patchsets here so that neither the upload nor
+  showing the patchset has to do it.
+  """
+  issue = models.Issue.get_by_id(_clean_int(request.POST.get('issue'), 0))
+  if issue is None:
+    return HttpResponse('Issue is gone.', content_type='text/plain')
+  patchset = models.PatchSet.get_by_id(
+      _clean_int(request.POST.get('patchset'), 0), parent=issue)
+  if patchset is None:
+    return HttpResponse('Patchset is gone.', content_type='text/plain')
+  patch_id = _clean_int(request.POST.get('patch'), None)
+  if patch_id is not None:
+    patches = [models.Patch.get_by_id(patch_id, parent=patchset)]
+  else:
+    patches = list(patchset.patch_set)
+  # Patches without text get their delta from _generate_diff().
+  patches = [patch for patch in patches
+             if patch is not None and not patch.delta_calculated and
+             patch.text is not None]
+  _calculate_delta(issue, patchset, patches)
+  return HttpResponse('OK', content_type='text/plain')
 
 
 def _get_patchset_info(request, patchset_id):
   """ Returns a list of patchsets for the issue.
 
+  This doesn't write anything.  Delta links are calculated on the task
+  queue (see task_calculate_delta()) when a patchset is uploaded; patches
+  whose delta isn't available yet are shown without them.
+
   Args:
     request: Django Request object.
-    patchset_id: The id of the patchset that the caller is interested in.  This
-      is the one that we generate delta links to if they're not available.  We
-      can't generate for all patchsets because it would take too long on issues
-      with many patchsets.  Passing in None is equivalent to doing it for the
-      last patchset.
+    patchset_id: The id of the patchset that the caller is interested in.
+      Its patches are loaded.  Passing in None is equivalent to doing it
+      for the last patchset.
 
   Returns:
-    A 3-tuple of (issue, patchsets, HttpResponse).
-    If HttpResponse is not None, further processing should stop and it should be
-    returned.
+    A 2-tuple of (issue, patchsets).
   """
   issue = request.issue
   patchsets = list(issue.patchset_set.order('created'))
-  response = None
   if not patchset_id and patchsets:
     patchset_id = patchsets[-1].key().id()
 
+  drafts = None
   if request.user:
-    drafts = list(models.Comment.gql('WHERE ANCESTOR IS :1 AND draft = TRUE'
-                                     '  AND author = :2',
-                                     issue, request.user))
-  else:
-    drafts = []
-  comments = list(models.Comment.gql('WHERE ANCESTOR IS :1 AND draft = FALSE',
-                                     issue))
-  issue.draft_count = len(drafts)
-  for c in drafts:
-    c.ps_key = c.patch.patchset.key()
+    drafts = models.DraftCounts.get_for(issue, request.user)
+    issue._num_drafts = drafts.total
+  issue.draft_count = issue.num_drafts
   patchset_id_mapping = {}  # Maps from patchset id to its ordering number.
   for patchset in patchsets:
     patchset_id_mapping[patchset.key().id()] = len(patchset_id_mapping) + 1
-    patchset.n_drafts = sum(c.ps_key == patchset.key() for c in drafts)
+    draft_counts = {}
+    if drafts is not None:
+      draft_counts = drafts.get_patch_counts(patchset.key().id())
+    patchset.n_drafts = sum(draft_counts.itervalues())
     patchset.patches = None
-    patchset.parsed_patches = None
     if patchset_id == patchset.key().id():
       patchset.patches = list(patchset.patch_set.order('filename'))
-      try:
-        attempt = _clean_int(request.GET.get('attempt'), 0, 0)
-        if attempt < 0:
-          response = HttpResponse('Invalid parameter', status=404)
-          break
-        for patch in patchset.patches:
-          pkey = patch.key()
-          patch._num_comments = sum(c.parent_key() == pkey for c in comments)
-          patch._num_drafts = sum(c.parent_key() == pkey for c in drafts)
-          if not patch.delta_calculated:
-            if attempt > 2:
-              # Too many patchsets or files and we're not able to generate the
-              # delta links.  Instead of giving a 500, try to render the page
-              # without them.
-              patch.delta = []
-            else:
-              # Compare each patch to the same file in earlier patchsets to see
-              # if they differ, so that we can generate the delta patch urls.
-              # We do this once and cache it after.  It's specifically not done
-              # on upload because we're already doing too much processing there.
-              # NOTE: this function will clear out patchset.data to reduce
-              # memory so don't ever call patchset.put() after calling it.
-              patch.delta = _calculate_delta(patch, patchset_id, patchsets)
-              patch.delta_calculated = True
-              # A multi-entity put would be quicker, but it fails when the
-              # patches have content that is large.  App Engine throws
-              # RequestTooLarge.  This way, although not as efficient, allows
-              # multiple refreshes on an issue to get things done, as opposed to
-              # an all-or-nothing approach.
-              patch.put()
-          # Reduce memory usage: if this patchset has lots of added/removed
-          # files (i.e. > 100) then we'll get MemoryError when rendering the
-          # response.  Each Patch entity is using a lot of memory if the files
-          # are large, since it holds the entire contents.  Call num_chunks and
-          # num_drafts first though since they depend on text.
-          patch.num_chunks
-          patch.num_drafts
-          patch.num_added
-          patch.num_removed
-          patch.text = None
-          patch._lines = None
-          patch.parsed_deltas = []
-          for delta in patch.delta:
+      pending = False
+      for patch in patchset.patches:
+        patch._num_drafts = draft_counts.get(patch.key().id(), 0)
+        if not patch.delta_calculated and patch.text is not None:
+          pending = True
+        # Reduce memory usage: if this patchset has lots of added/removed
+        # files (i.e. > 100) then we'll get MemoryError when rendering the
+        # response.  Each Patch entity is using a lot of memory if the files
+        # are large, since it holds the entire contents.  Call num_chunks and
+        # num_comments first though since they depend on text.
+        patch.num_chunks
+        patch.num_comments
+        patch.num_added
+        patch.num_removed
+        patch.text = None
+        patch._lines = None
+        patch.parsed_deltas = []
+        for delta in patch.delta:
+          if delta in patchset_id_mapping:
             patch.parsed_deltas.append([patchset_id_mapping[delta], delta])
-      except DeadlineExceededError:
-        logging.exception('DeadlineExceededError in _get_patchset_info')
-        if attempt > 2:
-          response = HttpResponse('DeadlineExceededError - create a new issue.')
-        else:
-          response = HttpResponseRedirect('%s?attempt=%d' %
-                                          (request.path, attempt + 1))
-        break
-  # Reduce memory usage (see above comment).
-  for patchset in patchsets:
-    patchset.parsed_patches = None
-  return issue, patchsets, response
+      if pending and memcache.get(DELTA_KEY % patchset_id) is None:
+        # Uploaded before deltas were calculated on upload, or the task was
+        # queued so long ago that it must have been lost.
+        _enqueue_calculate_delta(issue, patchset)
+      if (not issue.local_base and
+          memcache.get(PREFETCH_KEY % patchset_id) is None):
+        # Uploaded before base files were prefetched on upload.
+        _enqueue_prefetch_base_files(issue, patchset)
+  return issue, patchsets
 
 
 @issue_required
 @login_required
 def show(request, form=None):
   """/<issue> - Show an issue."""
-  issue, patchsets, response = _get_patchset_info(request, None)
-  if response:
-    return response
+  issue, patchsets = _get_patchset_info(request, None)
   if not form:
     form = AddForm(initial={'reviewers': ', '.join(issue.reviewers)})
   last_patchset = first_patch = None
@@ -1848,9 +2556,7 @@ def show(request, form=None):
 def patchset(request):
   """/patchset/<key> - Returns patchset information."""
   patchset = request.patchset
-  issue, patchsets, response = _get_patchset_info(request, patchset.key().id())
-  if response:
-    return response
+  issue, patchsets = _get_patchset_info(request, patchset.key().id())
   for ps in patchsets:
     if ps.key().id() == patchset.key().id():
       patchset = ps
@@ -1952,10 +2658,9 @@ def edit(request):
   issue.base = base
   issue.reviewers = reviewers
   issue.cc = cc
-  if base_changed:
-    for patchset in issue.patchset_set:
-      db.run_in_transaction(_delete_cached_contents, list(patchset.patch_set))
   issue.put()
+  if base_changed:
+    deferred.defer(_delete_issue_cached_contents, issue.key().id())
   if issue.closed == was_closed:
     message = 'Edited'
   elif issue.closed:
@@ -1967,6 +2672,19 @@ def edit(request):
   return HttpResponseRedirect(reverse(show, args=[issue.key().id()]))
 
 
+def _delete_issue_cached_contents(issue_id):
+  """Task deleting the cached contents of an issue after its base changed.
+
+  The base files are fetched again from the new base afterwards.
+  """
+  issue = models.Issue.get_by_id(issue_id)
+  if issue is None:
+    return
+  for patchset in issue.patchset_set:
+    db.run_in_transaction(_delete_cached_contents, list(patchset.patch_set))
+    _enqueue_prefetch_base_files(issue, patchset)
+
+
 def _delete_cached_contents(patch_set):
   """Transactional helper for edit() to delete cached contents."""
   # TODO(guido): No need to do this in a transaction.
@@ -2004,8 +2722,19 @@ def delete(request):
   issue = request.issue
   tbd = [issue]
   for cls in [models.PatchSet, models.Patch, models.Comment,
-              models.Message, models.Content]:
+              models.Message, models.Content, models.DeltaIndex,
+              models.DeltaIndexPatchSet, models.DraftCounts]:
     tbd += cls.gql('WHERE ANCESTOR IS :1', issue)
+  draft_authors = dict((entity.author.email(), entity.author)
+                       for entity in tbd
+                       if isinstance(entity, models.Comment) and
+                       entity.draft and entity.author is not None)
+  for author in draft_authors.itervalues():
+    db.run_in_transaction(models.DraftIndex.update, author, issue.key().id(),
+                          False)
+  models.DashboardEntry.remove_issue(issue.key().id())
+  # The task finds the issue gone and removes it from the search index.
+  models.enqueue_index_issue(issue)
   db.delete(tbd)
   _notify_issue(request, issue, 'Deleted')
   return HttpResponseRedirect(reverse(mine))
@@ -2029,7 +2758,14 @@ def delete_patchset(request):
       if patch.delta_calculated:
         if ps_id in patch.delta:
           patches.append(patch)
-  db.run_in_transaction(_patchset_delete, ps_delete, patches)
+  draft_counts = db.run_in_transaction(_patchset_delete, ps_delete, patches)
+  for counts in draft_counts:
+    if not counts.total:
+      db.run_in_transaction(models.DraftIndex.update, counts.user,
+                            issue.key().id(), False)
+  # Corrects the comment counts of the issue, and the drafts of users who
+  # didn't have DraftCounts yet.
+  models.enqueue_reconcile_counts(issue)
   _notify_issue(request, issue, 'Patchset deleted')
   return HttpResponseRedirect(reverse(show, args=[issue.key().id()]))
 
@@ -2041,6 +2777,8 @@ def _patchset_delete(ps_delete, patches):
     ps_delete: The patchset to be deleted.
     patches: Patches that have delta against patches of ps_delete.
 
+  Returns:
+    The DraftCounts that counted drafts on the patchset.
   """
   patchset_id = ps_delete.key().id()
   tbp = []
@@ -2049,10 +2787,18 @@ def _patchset_delete(ps_delete, patches):
     tbp.append(patch)
   if tbp:
     db.put(tbp)
+  models.DeltaIndex.remove_patchset(ps_delete.issue, patchset_id)
+  draft_counts = [counts for counts in
+                  models.DraftCounts.gql('WHERE ANCESTOR IS :1',
+                                         ps_delete.issue)
+                  if counts.remove_patchset(patchset_id)]
+  if draft_counts:
+    db.put(draft_counts)
   tbd = [ps_delete]
   for cls in [models.Patch, models.Comment]:
     tbd += cls.gql('WHERE ANCESTOR IS :1', ps_delete)
   db.delete(tbd)
+  return draft_counts
 
 
 @post_required
@@ -2370,9 +3116,12 @@ def diff(request):
                   })
 
 
-def _get_diff_table_rows(request, patch, context, column_width):
+def _get_diff_table_rows(request, patch, context, column_width,
+                         comments=None, read_only=False):
   """Helper function that returns rendered rows for a patch.
 
+  The optional arguments are passed on to engine.RenderDiffTableRows().
+
   Raises:
     engine.FetchError if patch parsing or download of base files fails.
   """
@@ -2380,13 +3129,16 @@ def _get_diff_table_rows(request, patch, context, column_width):
   if chunks is None:
     raise engine.FetchError('Can\'t parse the patch to chunks')
 
-  # Possible engine.FetchErrors are handled in diff() and diff_skipped_lines().
-  content = request.patch.get_content()
+  # Possible engine.FetchErrors are handled in diff(), diff_all() and
+  # diff_skipped_lines().
+  content = patch.get_content()
 
   rows = list(engine.RenderDiffTableRows(request, content.lines,
                                          chunks, patch,
                                          context=context,
-                                         colwidth=column_width))
+                                         colwidth=column_width,
+                                         comments=comments,
+                                         read_only=read_only))
   if rows and rows[-1] is None:
     del rows[-1]
     # Get rid of content, which may be bad
@@ -2398,12 +3150,87 @@ def _get_diff_table_rows(request, patch, context, column_width):
       content.put()
     else:
       content.delete()
-      request.patch.content = None
-      request.patch.put()
+      patch.content = None
+      patch.put()
 
   return rows
 
 
+# Patch lines rendered per request by diff_all(), the following files are
+# loaded when the page is scrolled to them.
+DIFF_ALL_MAX_LINES = 2000
+
+
+@patchset_required
+@login_required
+def diff_all(request):
+  """/<issue>/diff_all/<patchset> - View all patches as side-by-side diffs.
+
+  Files are rendered in ranges of about DIFF_ALL_MAX_LINES patch lines,
+  starting with the file at index ?start=.  The ranges are sized from the
+  patchset's navigation, so only the patches shown and their comments are
+  loaded; missing base files are fetched concurrently.  With ?fragment=1
+  only the files are returned; the page uses this to load the next range
+  when it's scrolled to the end.
+
+  Comments are shown read-only, they're added on the diff page of a file.
+  """
+  issue = request.issue
+  patchset = request.patchset
+  navigation = patchset.get_navigation()
+  start = _clean_int(request.GET.get('start'), 0, 0, len(navigation))
+  end = start
+  num_lines = 0
+  while end < len(navigation) and num_lines < DIFF_ALL_MAX_LINES:
+    num_lines += navigation[end].num_lines
+    end += 1
+  shown = [patch for patch in models.Patch.get_by_id(
+               [entry.id for entry in navigation[start:end]],
+               parent=patchset)
+           if patch is not None]
+  for patch in shown:
+    patch.patchset = patchset
+  if issue.base and not issue.local_base:
+    _fetch_base_files(issue, [p for p in shown if not p.is_binary])
+
+  comments_by_patch = {}
+  for patch in shown:
+    if patch.num_comments:
+      comments_by_patch[patch.key()] = list(models.Comment.gql(
+          'WHERE patch = :1 AND draft = FALSE ORDER BY date', patch))
+
+  context = _get_context_for_user(request)
+  column_width = _get_column_width_for_user(request)
+  for patch in shown:
+    patch.rows = patch.error = None
+    if patch.is_binary or patch.no_base_file:
+      continue
+    comments = engine.GroupComments(comments_by_patch.get(patch.key(), []),
+                                    patch, None)
+    try:
+      patch.rows = _get_diff_table_rows(request, patch, context, column_width,
+                                        comments=comments, read_only=True)
+    except engine.FetchError, err:
+      patch.error = str(err)
+
+  params = {'issue': issue,
+            'patchset': patchset,
+            'patches': shown,
+            'next_url': None,
+            'context': context,
+            'context_values': models.CONTEXT_CHOICES,
+            'column_width': column_width,
+            }
+  if end < len(navigation):
+    query = request.GET.copy()
+    query['start'] = end
+    query.pop('fragment', None)
+    params['next_url'] = '%s?%s' % (request.path, query.urlencode())
+  if request.GET.get('fragment'):
+    return respond(request, 'diff_all_files.html', params)
+  return respond(request, 'diff_all.html', params)
+
+
 @patch_required
 @json_response
 @login_required
@@ -2614,42 +3441,30 @@ def diff2_skipped_lines(request, ps_left_id, ps_right_id, patch_id,
                                      where, context)
 
 
-def _get_comment_counts(account, patchset):
-  """Helper to get comment counts for all patches in a single query.
+def _get_navigation(patchset):
+  """Helper returning the navigation of a patchset, see _add_next_prev().
 
-  The helper returns two dictionaries comments_by_patch and
-  drafts_by_patch with patch key as key and comment count as
-  value. Patches without comments or drafts are not present in those
-  dictionaries.
+  The entries have num_drafts set for the current user.
   """
-  # A key-only query won't work because we need to fetch the patch key
-  # in the for loop further down.
-  comment_query = models.Comment.all()
-  comment_query.ancestor(patchset)
-
-  # Get all comment counts with one query rather than one per patch.
-  comments_by_patch = {}
-  drafts_by_patch = {}
-  for c in comment_query:
-    pkey = models.Comment.patch.get_value_for_datastore(c)
-    if not c.draft:
-      comments_by_patch[pkey] = comments_by_patch.setdefault(pkey, 0) + 1
-    elif account and c.author == account.user:
-      drafts_by_patch[pkey] = drafts_by_patch.setdefault(pkey, 0) + 1
-
-  return comments_by_patch, drafts_by_patch
+  patches = patchset.get_navigation()
+  account = models.Account.current_user_account
+  if account is not None:
+    drafts = models.DraftCounts.get_for(patchset.issue, account.user)
+    counts = drafts.get_patch_counts(patchset.key().id())
+    for p in patches:
+      p.num_drafts = counts.get(p.id, 0)
+  return patches
 
 
 def _add_next_prev(patchset, patch):
-  """Helper to add .next and .prev attributes to a patch object."""
+  """Helper to add .next and .prev attributes to a patch object.
+
+  They're models.PatchNavigation instances, not patches.
+  """
   patch.prev = patch.next = None
-  patches = list(models.Patch.gql("WHERE patchset = :1 ORDER BY filename",
-                                  patchset))
+  patches = _get_navigation(patchset)
   patchset.patches = patches  # Required to render the jump to select.
 
-  comments_by_patch, drafts_by_patch = _get_comment_counts(
-     models.Account.current_user_account, patchset)
-
   last_patch = None
   next_patch = None
   last_patch_with_comment = None
@@ -2661,9 +3476,6 @@ def _add_next_prev(patchset, patch):
         found_patch = True
         continue
 
-      p._num_comments = comments_by_patch.get(p.key(), 0)
-      p._num_drafts = drafts_by_patch.get(p.key(), 0)
-
       if not found_patch:
           last_patch = p
           if p.num_comments > 0 or p.num_drafts > 0:
@@ -2684,15 +3496,14 @@ def _add_next_prev(patchset, patch):
 
 
 def _add_next_prev2(ps_left, ps_right, patch_right):
-  """Helper to add .next and .prev attributes to a patch object."""
+  """Helper to add .next and .prev attributes to a patch object.
+
+  They're models.PatchNavigation instances, not patches.
+  """
   patch_right.prev = patch_right.next = None
-  patches = list(models.Patch.gql("WHERE patchset = :1 ORDER BY filename",
-                                  ps_right))
+  patches = _get_navigation(ps_right)
   ps_right.patches = patches  # Required to render the jump to select.
 
-  n_comments, n_drafts = _get_comment_counts(
-    models.Account.current_user_account, ps_right)
-
   last_patch = None
   next_patch = None
   last_patch_with_comment = None
@@ -2704,9 +3515,6 @@ def _add_next_prev2(ps_left, ps_right, patch_right):
         found_patch = True
         continue
 
-      p._num_comments = n_comments.get(p.key(), 0)
-      p._num_drafts = n_drafts.get(p.key(), 0)
-
       if not found_patch:
           last_patch = p
           if ((p.num_comments > 0 or p.num_drafts > 0) and
@@ -2790,6 +3598,8 @@ def _inline_draft(request):
   if not text.rstrip():
     if comment is not None:
       assert comment.draft and comment.author == request.user
+      db.run_in_transaction(models.DraftCounts.update, issue, request.user,
+                            patchset_id, patch_id, -1)
       comment.delete()  # Deletion
       comment = None
       # Re-query the comment count.
@@ -2797,6 +3607,8 @@ def _inline_draft(request):
   else:
     if comment is None:
       comment = models.Comment(key_name=message_id, parent=patch)
+      db.run_in_transaction(models.DraftCounts.update, issue, request.user,
+                            patchset_id, patch_id, 1)
     comment.patch = patch
     comment.lineno = lineno
     comment.left = left
@@ -2805,6 +3617,7 @@ def _inline_draft(request):
     comment.put()
     # The actual count doesn't matter, just that there's at least one.
     models.Account.current_user_account.update_drafts(issue, 1)
+  models.enqueue_reconcile_counts(issue)
 
   query = models.Comment.gql(
       'WHERE patch = :patch AND lineno = :lineno AND left = :left '
@@ -2949,13 +3762,13 @@ def publish(request):
     return respond(request, 'publish.html', {'form': form, 'issue': issue})
   issue.reviewers = reviewers
   issue.cc = cc
+  drafts = None
   if not form.cleaned_data.get('message_only', False):
     tbd, comments = _get_draft_comments(request, issue)
+    drafts = models.DraftCounts.get_for(issue, request.user)
   else:
     tbd = []
     comments = []
-  issue.update_comment_count(len(comments))
-  tbd.append(issue)
 
   if comments:
     logging.warn('Publishing %d comments', len(comments))
@@ -2966,8 +3779,15 @@ def publish(request):
                       draft=draft_message)
   tbd.append(msg)
 
-  for obj in tbd:
-    db.put(obj)
+  if drafts is not None and drafts.total:
+    # All drafts are published now; this also drops counts of drafts that
+    # are gone, e.g. with their patchset.
+    drafts.clear()
+    tbd.append(drafts)
+  # Everything in tbd belongs to the issue's entity group.
+  issue = db.run_in_transaction(_put_published, issue, tbd, comments)
+  if comments:
+    models.enqueue_reconcile_counts(issue)
 
   _notify_issue(request, issue, 'Comments published')
 
@@ -2985,11 +3805,57 @@ def _encode_safely(s):
   return s
 
 
+def _put_published(issue, tbd, comments):
+  """Transactional helper for publish().
+
+  The issue and the patchsets and patches with comments are loaded again
+  in the transaction, so that comments published concurrently by others
+  are counted too.
+
+  Args:
+    issue: The Issue with the subject, reviewers and CC to store.
+    tbd: The published comments and other entities to put().
+    comments: The published comments, with their patch set.
+
+  Returns:
+    The stored Issue.
+  """
+  stored = models.Issue.get(issue.key())
+  stored.subject = issue.subject
+  stored.reviewers = issue.reviewers
+  stored.cc = issue.cc
+  stored.update_comment_count(len(comments))
+  counts = {}  # Maps patchset keys to {patch id: number of comments}.
+  for c in comments:
+    pkey = c.patch.key()
+    patch_counts = counts.setdefault(pkey.parent(), {})
+    patch_counts[pkey.id()] = patch_counts.get(pkey.id(), 0) + 1
+  tbp = list(tbd)
+  for ps_key, patch_counts in counts.iteritems():
+    patchset = models.PatchSet.get(ps_key)
+    for patch in models.Patch.get_by_id(patch_counts.keys(),
+                                        parent=patchset):
+      if patch is not None:
+        patch.update_comment_count(patch_counts[patch.key().id()])
+        tbp.append(patch)
+    patchset.update_comment_count(sum(patch_counts.itervalues()))
+    patchset.update_navigation(patch_counts)
+    tbp.append(patchset)
+  db.put(tbp)
+  # Not part of tbp: Issue.put() also queues indexing the issue.
+  stored.put()
+  return stored
+
+
 def _get_draft_comments(request, issue, preview=False):
   """Helper to return objects to put() and a list of draft comments.
 
   If preview is True, the list of objects to put() is empty to avoid changes
-  to the datastore.
+  to the datastore.  Otherwise it holds the comments; publish() updates the
+  comment counts in its transaction, see _put_published().
+
+  The drafts are found with a single query and only the patches they're on
+  are loaded, in one batch get per patchset.
 
   Args:
     request: Django Request object.
@@ -2999,42 +3865,75 @@ def _get_draft_comments(request, issue, preview=False):
   Returns:
     2-tuple (put_objects, comments).
   """
+  drafts = list(models.Comment.gql(
+      'WHERE ANCESTOR IS :1 AND author = :2 AND draft = TRUE',
+      issue, request.user))
+  if not drafts:
+    return [], []
+  by_patch = {}  # Maps patch keys to lists of drafts.
+  for c in drafts:
+    # Get the patch key value without loading the patch entity.
+    pkey = models.Comment.patch.get_value_for_datastore(c)
+    by_patch.setdefault(pkey, []).append(c)
+  patch_ids = {}  # Maps patchset ids to lists of patch ids.
+  for pkey in by_patch:
+    patch_ids.setdefault(pkey.parent().id(), []).append(pkey.id())
+  patchsets = [ps for ps in models.PatchSet.get_by_id(patch_ids.keys(),
+                                                      parent=issue)
+               if ps is not None]
+  patchsets.sort(key=lambda ps: ps.created)
+
   comments = []
   tbd = []
-  # XXX Should request all drafts for this issue once, now we can.
-  for patchset in issue.patchset_set.order('created'):
-    ps_comments = list(models.Comment.gql(
-        'WHERE ANCESTOR IS :1 AND author = :2 AND draft = TRUE',
-        patchset, request.user))
-    if ps_comments:
-      patches = dict((p.key(), p) for p in patchset.patch_set)
-      for p in patches.itervalues():
-        p.patchset = patchset
-      for c in ps_comments:
+  for patchset in patchsets:
+    ps_comments = []
+    for patch in models.Patch.get_by_id(patch_ids[patchset.key().id()],
+                                        parent=patchset):
+      if patch is None:
+        continue
+      patch.patchset = patchset
+      patch_comments = by_patch[patch.key()]
+      for c in patch_comments:
         c.draft = False
-        # Get the patch key value without loading the patch entity.
-        # NOTE: Unlike the old version of this code, this is the
-        # recommended and documented way to do this!
-        pkey = models.Comment.patch.get_value_for_datastore(c)
-        if pkey in patches:
-          patch = patches[pkey]
-          c.patch = patch
-      if not preview:
-        tbd.append(ps_comments)
-        patchset.update_comment_count(len(ps_comments))
-        tbd.append(patchset)
-      ps_comments.sort(key=lambda c: (c.patch.filename, not c.left,
-                                      c.lineno, c.date))
-      comments += ps_comments
+        c.patch = patch
+      ps_comments += patch_comments
+    if not preview:
+      tbd += ps_comments
+    ps_comments.sort(key=lambda c: (c.patch.filename, not c.left,
+                                    c.lineno, c.date))
+    comments += ps_comments
   return tbd, comments
 
 
+# Rendered comment details are kept this long, so that sending the
+# comments after a preview doesn't render them again.
+DRAFT_DETAILS_TIMEOUT = 10 * 60
+
+
 def _get_draft_details(request, comments):
-  """Helper to display comments with context in the email message."""
+  """Helper to display comments with context in the email message.
+
+  The result is cached for the exact comments shown, keyed on their
+  keys, line numbers, text and modification dates.
+  """
+  digest = md5.new(request.get_host())
+  digest.update(str(request.issue.key().id()))
+  for c in comments:
+    digest.update('\0%s\0%s\0%s\0%s\0' % (c.key(), c.left, c.lineno, c.date))
+    digest.update(c.text.encode('utf-8'))
+  cache_key = 'draft_details:' + digest.hexdigest()
+  details = memcache.get(cache_key)
+  if details is None:
+    details = _render_draft_details(request, comments)
+    memcache.set(cache_key, details, DRAFT_DETAILS_TIMEOUT)
+  return details
+
+
+def _render_draft_details(request, comments):
+  """Helper for _get_draft_details() doing the actual work."""
   last_key = None
   output = []
-  linecache = {}  # Maps (c.patch.key(), c.left) to list of lines
-  modified_patches = []
+  modified_contents = []
   for c in comments:
     if (c.patch.key(), c.left) != last_key:
       url = request.build_absolute_uri(
@@ -3046,15 +3945,17 @@ def _get_draft_details(request, comments):
       last_key = (c.patch.key(), c.left)
       patch = c.patch
       if patch.no_base_file:
-        linecache[last_key] = patching.ParsePatchToLines(patch.lines)
+        file_lines = patching.ParsePatchToLines(patch.lines)
       else:
         if c.left:
-          old_lines = patch.get_content().text.splitlines(True)
-          linecache[last_key] = old_lines
+          content = patch.get_content()
         else:
-          new_lines = patch.get_patched_content().text.splitlines(True)
-          linecache[last_key] = new_lines
-    file_lines = linecache[last_key]
+          content = patch.get_patched_content()
+        # Single lines are taken from the text by offset, without
+        # splitting it.  The offsets are stored for the next time.
+        if (content.line_offsets is None and
+            content.update_line_offsets() and content.is_saved()):
+          modified_contents.append(content)
     context = ''
     if patch.no_base_file:
       for old_line_no, new_line_no, line_text in file_lines:
@@ -3063,8 +3964,7 @@ def _get_draft_details(request, comments):
           context = line_text.strip()
           break
     else:
-      if 1 <= c.lineno <= len(file_lines):
-        context = file_lines[c.lineno - 1].strip()
+      context = content.get_line(c.lineno).strip()
     url = request.build_absolute_uri(
       '%s#%scode%d' % (reverse(diff, args=[request.issue.key().id(),
                                            c.patch.patchset.key().id(),
@@ -3073,8 +3973,8 @@ def _get_draft_details(request, comments):
                        c.lineno))
     output.append('\n%s\n%s:%d: %s\n%s' % (url, c.patch.filename, c.lineno,
                                            context, c.text.rstrip()))
-  if modified_patches:
-    db.put(modified_patches)
+  if modified_contents:
+    db.put(modified_contents)
   return '\n'.join(output)
 
 
@@ -3160,21 +4060,9 @@ def _make_message(request, issue, message, comments=None, send_mail=False,
       send_args['attachments'] = [('issue_%s_patch.diff' % issue.key().id(),
                                    patch)]
 
-    attempts = 0
-    while True:
-      try:
-        mail.send_mail(**send_args)
-        break
-      except apiproxy_errors.DeadlineExceededError:
-        # apiproxy_errors.DeadlineExceededError is raised when the
-        # deadline of an API call is reached (e.g. for mail it's
-        # something about 5 seconds). It's not the same as the lethal
-        # runtime.DeadlineExeededError.
-        attempts += 1
-        if attempts >= 3:
-          raise
-    if attempts:
-      logging.warning("Retried sending email %s times", attempts)
+    # This only adds the mail to the outbox (settings.MAIL_USE_OUTBOX);
+    # it's delivered, and retried if needed, by the task queue.
+    mail.send_mail(**send_args)
 
   return msg
 
@@ -3302,7 +4190,13 @@ def search(request):
   format = form.cleaned_data.get('format') or 'html'
   if format == 'html':
     keys_only = False
-  q = models.Issue.all(keys_only=keys_only)
+  if form.cleaned_data.get('text') or form.cleaned_data.get('filename'):
+    # Ranked by relevance instead of a datastore query.
+    q = models.IssueSearch(form.cleaned_data.get('text'),
+                           form.cleaned_data.get('filename'),
+                           keys_only=keys_only, user=request.user)
+  else:
+    q = models.Issue.all(keys_only=keys_only)
   if form.cleaned_data.get('cursor'):
     q.with_cursor(form.cleaned_data['cursor'])
   if form.cleaned_data.get('closed') != None:
@@ -3331,7 +4225,8 @@ def search(request):
   form.cleaned_data['cursor'] = q.cursor()
   if keys_only:
     # There's not enough information to filter. The only thing that is leaked is
-    # the issue's key.
+    # the issue's key.  IssueSearch filters itself, or the words searched for
+    # would reveal what private issues contain.
     filtered_results = results
   else:
     filtered_results = [i for i in results if _can_view_issue(request.user, i)]
@@ -1,6 +1,8 @@
 from settings import *
 
 DEBUG = False
+TEMPLATE_TIMING = False
+TEMPLATE_LOADERS = CACHED_TEMPLATE_LOADERS
 
 DATABASES = {
     'default': {
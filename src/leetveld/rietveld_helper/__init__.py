@@ -40,3 +40,12 @@ def on_post_save_user(sender, **kwds):
     account = models.Account.get_account_for_user(user)
     account.put()
 post_save.connect(on_post_save_user)
+
+
+def on_post_save_issue(sender, **kwds):
+    from codereview import models
+    if sender != models.Issue:
+        return
+    # Issue.put() isn't called for multi-entity puts, this handler is.
+    models.enqueue_dashboard_update(kwds['instance'])
+post_save.connect(on_post_save_issue)
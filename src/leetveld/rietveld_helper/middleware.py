@@ -1,6 +1,88 @@
+import tempfile
+import zlib
+
+from django.conf import settings
 from django.contrib.messages.api import get_messages
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.template.loader import render_to_string
 
 from codereview import models
+from rietveld_helper import template_timing
+
+# Decompressed request bodies larger than this are rejected.
+MAX_DECOMPRESSED_REQUEST_SIZE = getattr(
+    settings, 'MAX_DECOMPRESSED_REQUEST_SIZE', 64 * 1024 * 1024)
+# Decompressed bodies up to this size are kept in memory.
+_SPOOL_SIZE = 1024 * 1024
+_CHUNK_SIZE = 64 * 1024
+_WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class RequestTooLarge(Exception):
+    """The decompressed request body exceeds the size limit."""
+
+
+class RequestIncomplete(Exception):
+    """The request body or its compressed data ended early."""
+
+
+def _stream_ended(decompressor):
+    """Returns True if the decompressor has seen the end of its stream.
+
+    Python 2's zlib has no eof attribute, but input following the end of
+    the stream is kept in unused_data instead of being decompressed.
+    """
+    if decompressor.unused_data:
+        return True
+    try:
+        decompressor.decompress('\0')
+    except zlib.error:
+        return False
+    return bool(decompressor.unused_data)
+
+
+def _decompress(stream, length, wbits, max_size):
+    """Decompresses length bytes read from stream into a temporary file.
+
+    Returns:
+      A (file, size) tuple, file is positioned at the start.
+
+    Raises:
+      RequestTooLarge: If more than max_size bytes would be decompressed.
+      RequestIncomplete: If fewer than length bytes could be read, or the
+        compressed stream is truncated.
+      zlib.error: If the data is corrupt.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=_SPOOL_SIZE)
+    decompressor = zlib.decompressobj(wbits)
+    size = 0
+    while length > 0:
+        chunk = stream.read(min(_CHUNK_SIZE, length))
+        if not chunk:
+            raise RequestIncomplete()
+        length -= len(chunk)
+        while chunk:
+            # Never inflate more than allowed, even for a single chunk.
+            data = decompressor.decompress(chunk, max_size - size + 1)
+            size += len(data)
+            if size > max_size:
+                raise RequestTooLarge()
+            out.write(data)
+            chunk = decompressor.unconsumed_tail
+    if not _stream_ended(decompressor):
+        raise RequestIncomplete()
+    data = decompressor.flush()
+    size += len(data)
+    if size > max_size:
+        raise RequestTooLarge()
+    out.write(data)
+    out.seek(0)
+    return out, size
 
 
 class DisableCSRFMiddleware(object):
@@ -14,6 +96,47 @@ class DisableCSRFMiddleware(object):
         setattr(request, '_dont_enforce_csrf_checks', True)
 
 
+class DecompressRequestMiddleware(object):
+    """Decompresses request bodies sent with Content-Encoding gzip or deflate.
+
+    upload.py compresses diffs and base files.  The body is inflated into a
+    temporary file before any view parses it.
+    """
+
+    def process_request(self, request):
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '').lower()
+        if not encoding or not hasattr(request, 'environ'):
+            return None
+        if encoding not in _WBITS:
+            return HttpResponse('Unsupported Content-Encoding: %s' % encoding,
+                                status=415, content_type='text/plain')
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        try:
+            body, size = _decompress(request.environ['wsgi.input'], length,
+                                     _WBITS[encoding],
+                                     MAX_DECOMPRESSED_REQUEST_SIZE)
+        except RequestTooLarge:
+            return HttpResponse('Request too large.', status=413,
+                                content_type='text/plain')
+        except RequestIncomplete:
+            return HttpResponseBadRequest('Incomplete %s data.' % encoding,
+                                          content_type='text/plain')
+        except zlib.error, err:
+            return HttpResponseBadRequest('Invalid %s data: %s' %
+                                          (encoding, err),
+                                          content_type='text/plain')
+        request.environ['wsgi.input'] = body
+        request.environ['CONTENT_LENGTH'] = str(size)
+        del request.environ['HTTP_CONTENT_ENCODING']
+        if hasattr(request, '_stream'):
+            # Newer Django versions wrap wsgi.input on construction.
+            request._stream = body
+        return None
+
+
 class AddUserToRequestMiddleware(object):
     """Just add the account..."""
 
@@ -37,3 +160,41 @@ class AddUserToRequestMiddleware(object):
         response = view_func(request, *view_args, **view_kwargs)
         request.user = user
         return response
+
+
+class TemplateTimingMiddleware(object):
+    """Appends the render time of each template to HTML pages.
+
+    Only used when settings.TEMPLATE_TIMING is True.  The panel lists every
+    template rendered by the request with the number of renders and the
+    total time, slowest first, e.g. to spot inline_comment.html dominating
+    a diff page.
+    """
+
+    def __init__(self):
+        if not getattr(settings, 'TEMPLATE_TIMING', False):
+            raise MiddlewareNotUsed()
+        template_timing.install()
+
+    def process_request(self, request):
+        template_timing.start()
+
+    def process_response(self, request, response):
+        stats = template_timing.stop()
+        if (not stats or response.status_code != 200 or
+            not response.get('Content-Type', '').startswith('text/html')):
+            return response
+        content = response.content
+        pos = content.rfind('</body>')
+        if pos == -1:
+            return response
+        panel = render_to_string('template_timing.html', {
+            'templates': [{'name': name, 'count': count,
+                           'ms': seconds * 1000}
+                          for name, count, seconds in stats],
+        })
+        response.content = ''.join([content[:pos], panel.encode('utf-8'),
+                                    content[pos:]])
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+        return response
@@ -0,0 +1,56 @@
+"""Measures the time spent rendering each template during a request.
+
+install() wraps django.template.Template.render once per process.  Between
+start() and stop() every render is added to a per-thread table of
+template name -> [number of renders, seconds].  The times include the
+templates rendered from within a template, e.g. with {% include %}.
+"""
+
+import threading
+import time
+
+from django.template import Template
+
+_local = threading.local()
+_original_render = None
+
+
+def install():
+    """Instruments Template.render(); calling it again does nothing."""
+    global _original_render
+    if _original_render is not None:
+        return
+    _original_render = Template.render
+
+    def render(self, context):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return _original_render(self, context)
+        start = time.time()
+        try:
+            return _original_render(self, context)
+        finally:
+            entry = stats.setdefault(self.name or '<string>', [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.time() - start
+
+    Template.render = render
+
+
+def start():
+    """Starts collecting render times for the current thread."""
+    _local.stats = {}
+
+
+def stop():
+    """Stops collecting render times.
+
+    Returns:
+      A list of (template name, number of renders, seconds) tuples, the
+      slowest template first.
+    """
+    stats = getattr(_local, 'stats', None) or {}
+    _local.stats = None
+    return sorted(((name, count, seconds)
+                   for name, (count, seconds) in stats.iteritems()),
+                  key=lambda entry: entry[2], reverse=True)
@@ -0,0 +1,86 @@
+"""Tests for the request decompression middleware."""
+
+import gzip
+import StringIO
+import unittest
+import zlib
+
+from rietveld_helper import middleware
+
+
+def _gzip(data):
+    buf = StringIO.StringIO()
+    out = gzip.GzipFile(fileobj=buf, mode='wb')
+    out.write(data)
+    out.close()
+    return buf.getvalue()
+
+
+class FakeRequest(object):
+
+    def __init__(self, body, encoding='gzip', length=None):
+        if length is None:
+            length = len(body)
+        self.environ = {
+            'wsgi.input': StringIO.StringIO(body),
+            'CONTENT_LENGTH': str(length),
+            'HTTP_CONTENT_ENCODING': encoding,
+        }
+        self.META = self.environ
+
+
+class DecompressRequestMiddlewareTest(unittest.TestCase):
+
+    DATA = 'Index: a.py\n' + 'x' * 100000
+
+    def setUp(self):
+        self.middleware = middleware.DecompressRequestMiddleware()
+        self.max_size = middleware.MAX_DECOMPRESSED_REQUEST_SIZE
+
+    def tearDown(self):
+        middleware.MAX_DECOMPRESSED_REQUEST_SIZE = self.max_size
+
+    def process(self, request):
+        return self.middleware.process_request(request)
+
+    def test_gzip(self):
+        request = FakeRequest(_gzip(self.DATA))
+        self.assertEqual(self.process(request), None)
+        self.assertEqual(request.environ['wsgi.input'].read(), self.DATA)
+        self.assertEqual(request.environ['CONTENT_LENGTH'],
+                         str(len(self.DATA)))
+        self.assertFalse('HTTP_CONTENT_ENCODING' in request.environ)
+
+    def test_deflate(self):
+        request = FakeRequest(zlib.compress(self.DATA), 'deflate')
+        self.assertEqual(self.process(request), None)
+        self.assertEqual(request.environ['wsgi.input'].read(), self.DATA)
+
+    def test_unsupported_encoding(self):
+        response = self.process(FakeRequest('data', 'br'))
+        self.assertEqual(response.status_code, 415)
+
+    def test_too_large(self):
+        middleware.MAX_DECOMPRESSED_REQUEST_SIZE = len(self.DATA) - 1
+        response = self.process(FakeRequest(_gzip(self.DATA)))
+        self.assertEqual(response.status_code, 413)
+
+    def test_size_limit_exact(self):
+        middleware.MAX_DECOMPRESSED_REQUEST_SIZE = len(self.DATA)
+        self.assertEqual(self.process(FakeRequest(_gzip(self.DATA))), None)
+
+    def test_corrupt(self):
+        response = self.process(FakeRequest('not gzip data'))
+        self.assertEqual(response.status_code, 400)
+
+    def test_truncated_stream(self):
+        body = _gzip(self.DATA)
+        response = self.process(FakeRequest(body[:len(body) // 2]))
+        self.assertEqual(response.status_code, 400)
+        response = self.process(FakeRequest(body[:-4]))
+        self.assertEqual(response.status_code, 400)
+
+    def test_short_read(self):
+        body = _gzip(self.DATA)
+        response = self.process(FakeRequest(body, length=len(body) + 10))
+        self.assertEqual(response.status_code, 400)
@@ -13,5 +13,6 @@ urlpatterns = patterns('',
         (r'^accounts/logout/$', 'django.contrib.auth.views.logout_then_login'),
         ('^admin/', include(admin.site.urls)),
         ('^_ah/admin', 'rietveld_helper.views.admin_redirect'),
+        ('^_ah/queue/deferred$', 'gae2django.views.deferred'),
         ('', include('codereview.urls')),
     )
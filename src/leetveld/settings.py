@@ -60,22 +60,36 @@ ADMIN_MEDIA_PREFIX = '/media/'
 SECRET_KEY = 'el@4s$*(idwm5-87teftxlksckmy8$tyo7(tm!n-5x)zeuheex'
 
 # List of callables that know how to import templates from various sources.
-TEMPLATE_LOADERS = (
-    'django.template.loaders.filesystem.load_template_source',
-    'django.template.loaders.app_directories.load_template_source',
-#     'django.template.loaders.eggs.load_template_source',
+TEMPLATE_SOURCE_LOADERS = (
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+#     'django.template.loaders.eggs.Loader',
 )
+# Templates are read and compiled on every use, so that edits show up
+# without a restart.  production.py keeps the compiled templates instead.
+TEMPLATE_LOADERS = TEMPLATE_SOURCE_LOADERS
+CACHED_TEMPLATE_LOADERS = (
+    ('django.template.loaders.cached.Loader', TEMPLATE_SOURCE_LOADERS),
+)
+
+# Show the time spent rendering each template at the bottom of HTML pages,
+# see rietveld_helper.middleware.TemplateTimingMiddleware.
+TEMPLATE_TIMING = DEBUG
 
 
 MIDDLEWARE_CLASSES = (
+    # Must run before anything reads the request body.
+    'rietveld_helper.middleware.DecompressRequestMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'gae2django.middleware.FixRequestUserMiddleware',
+    'gae2django.middleware.TaskQueueHeadersMiddleware',
     # Keep in mind, that CSRF protection is DISABLED in this example!
     'rietveld_helper.middleware.DisableCSRFMiddleware',
     'rietveld_helper.middleware.AddUserToRequestMiddleware',
     'django.middleware.doc.XViewMiddleware',
+    'rietveld_helper.middleware.TemplateTimingMiddleware',
 )
 
 TEMPLATE_CONTEXT_PROCESSORS = (
@@ -106,6 +120,10 @@ LOGIN_REDIRECT_URL = '/'
 # This won't work with gae2django.
 RIETVELD_INCOMING_MAIL_ADDRESS = None
 
+# Queue outgoing mail and send it in batches from the task queue worker
+# (bin/django runtasks), see gae2django.outbox.
+MAIL_USE_OUTBOX = True
+
 RIETVELD_REVISION = '6bbee3d7523b'
 
 UPLOAD_PY_SOURCE = os.path.join(MEDIA_ROOT, 'upload.py')
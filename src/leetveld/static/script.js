@@ -2803,6 +2803,71 @@ function M_expandSkipped(id_before, id_after, where, id_skip) {
   httpreq.send('');
 }
 
+/**
+ * Replaces the "More files" link of the all files diff view with the next
+ * files.
+ * @param {Element} link The link, pointing to the page with the next files
+ * @return {Boolean} false if the files are loaded into this page
+ */
+function M_loadDiffAllMore(link) {
+  var div = M_getParent(link);
+  if (div.getAttribute("loading")) {
+    return false;
+  }
+  var httpreq = M_getXMLHttpRequest();
+  if (!httpreq) {
+    return true;
+  }
+  div.setAttribute("loading", "true");
+  var loading = div.getElementsByTagName("span")[0];
+  loading.style.visibility = "visible";
+  httpreq.onreadystatechange = function () {
+    if (httpreq.readyState == 4) {
+      if (httpreq.status == 200) {
+        var files = document.createElement("div");
+        files.innerHTML = httpreq.responseText;
+        var parent = M_getParent(div);
+        while (files.firstChild) {
+          parent.insertBefore(files.firstChild, div);
+        }
+        parent.removeChild(div);
+        M_checkDiffAllMore_(window);
+      } else {
+        loading.innerHTML = "An error occurred [" + httpreq.status + "]. ";
+        div.removeAttribute("loading");
+      }
+    }
+  }
+  httpreq.open("GET", link.href + "&fragment=1", true);
+  httpreq.send(null);
+  return false;
+}
+
+/**
+ * Loads the next files of the all files diff view once the "More files"
+ * link is scrolled into view.
+ */
+function M_checkDiffAllMore_(win) {
+  var divs = win.document.getElementsByTagName("div");
+  for (var i = 0; i < divs.length; i++) {
+    if (divs[i].className == "diff-all-more" &&
+        M_isElementVisible(win, divs[i])) {
+      M_loadDiffAllMore(divs[i].getElementsByTagName("a")[0]);
+    }
+  }
+}
+
+/**
+ * Sets up loading the next files of the all files diff view on scrolling.
+ * @param {Window} win The window showing the view
+ */
+function M_watchDiffAllMore(win) {
+  win.onscroll = function() {
+    M_checkDiffAllMore_(win);
+  }
+  M_checkDiffAllMore_(win);
+}
+
 /**
  * Finds the element position.
  */
@@ -33,14 +33,18 @@ against by using the '--rev' option.
 
 import cookielib
 import getpass
+import gzip
+import httplib
 import logging
 import mimetypes
 import optparse
 import os
 import re
 import socket
+import StringIO
 import subprocess
 import sys
+import threading
 import urllib
 import urllib2
 import urlparse
@@ -66,9 +70,26 @@ except ImportError:
 #  3: Debug logs.
 verbosity = 1
 
-# Max size of patch or base file.
+# Max size of patch or base file sent in one request.
 MAX_UPLOAD_SIZE = 900 * 1024
 
+# Max size of patch or base file sent in one request when request bodies are
+# compressed.  The server limits the decompressed size of a request to 64MB.
+MAX_COMPRESSED_UPLOAD_SIZE = 8 * MAX_UPLOAD_SIZE
+
+# Larger patches and base files are uploaded in chunks of MAX_UPLOAD_SIZE,
+# up to this size.  See UploadInChunks().
+MAX_CHUNKED_UPLOAD_SIZE = 32 * 1024 * 1024
+
+# How often an interrupted chunked upload is resumed.
+MAX_CHUNKED_UPLOAD_RETRIES = 5
+
+# Request bodies smaller than this aren't worth compressing.
+MIN_COMPRESS_SIZE = 1024
+
+# Max number of files sent in one upload_content_batch request.
+MAX_UPLOAD_BATCH_FILES = 50
+
 # Max length of the subject / message field.
 MAX_SUBJECT_LENGTH = 100
 
@@ -155,7 +176,7 @@ class AbstractRpcServer(object):
   """Provides a common interface for a simple RPC server."""
 
   def __init__(self, host, auth_function, host_override=None, extra_headers={},
-               save_cookies=False):
+               save_cookies=False, compress=False):
     """Creates a new HttpRpcServer.
 
     Args:
@@ -168,6 +189,7 @@ class AbstractRpcServer(object):
       save_cookies: If True, save the authentication cookies to local disk.
         If False, use an in-memory cookiejar instead.  Subclasses must
         implement this functionality.  Defaults to False.
+      compress: If True, send request bodies gzip compressed.
     """
     host_parts = host.split("://")
     self.protocol = host_parts[0]
@@ -177,6 +199,11 @@ class AbstractRpcServer(object):
     self.authenticated = False
     self.extra_headers = extra_headers
     self.save_cookies = save_cookies
+    self.compress = compress
+    # Send() may be called from several threads, only one of them should
+    # ask for credentials.
+    self._auth_lock = threading.Lock()
+    self._auth_count = 0
     self.opener = self._GetOpener()
     if self.host_override:
       logging.info("Server: %s; Host: %s", self.host, self.host_override)
@@ -345,18 +372,25 @@ class AbstractRpcServer(object):
     #if not self.authenticated:
     #  self._Authenticate()
 
+    content_encoding = None
+    if self.compress and payload and len(payload) >= MIN_COMPRESS_SIZE:
+      payload = GzipData(payload)
+      content_encoding = "gzip"
     old_timeout = socket.getdefaulttimeout()
     socket.setdefaulttimeout(timeout)
     try:
       tries = 0
       while True:
         tries += 1
+        auth_count = self._auth_count
         args = dict(kwargs)
         url = "%s://%s%s" % (self.protocol, self.host, request_path)
         if args:
           url += "?" + urllib.urlencode(args)
         req = self._CreateRequest(url=url, data=payload)
         req.add_header("Content-Type", content_type)
+        if content_encoding:
+          req.add_header("Content-Encoding", content_encoding)
         try:
           f = self.opener.open(req)
           response = f.read()
@@ -366,7 +400,14 @@ class AbstractRpcServer(object):
           if tries > 3:
             raise
           elif e.code == 401 or e.code == 302:
-            self._Authenticate()
+            self._auth_lock.acquire()
+            try:
+              # Another thread may have logged in while we were waiting.
+              if auth_count == self._auth_count:
+                self._Authenticate()
+                self._auth_count += 1
+            finally:
+              self._auth_lock.release()
 ##           elif e.code >= 500 and e.code < 600:
 ##             # Server Error - try again.
 ##             continue
@@ -376,6 +417,78 @@ class AbstractRpcServer(object):
       socket.setdefaulttimeout(old_timeout)
 
 
+class KeepAliveHandlerMixin(object):
+  """Reuses one HTTP connection per host and thread.
+
+  urllib2 closes the connection after every request, which adds a TCP
+  (and SSL) handshake to each file upload.  Responses are read completely,
+  so the connection is free for the next request when open() returns.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(KeepAliveHandlerMixin, self).__init__(*args, **kwargs)
+    self._local = threading.local()
+
+  def _Connections(self):
+    connections = getattr(self._local, "connections", None)
+    if connections is None:
+      connections = self._local.connections = {}
+    return connections
+
+  def _OpenKeepAlive(self, http_class, req):
+    if getattr(req, "_tunnel_host", None):
+      # Tunnelling through a proxy needs a connection per request.
+      return self.do_open(http_class, req)
+    host = req.get_host()
+    if not host:
+      raise urllib2.URLError("no host given")
+    headers = dict(req.unredirected_hdrs)
+    headers.update(dict((k, v) for k, v in req.headers.items()
+                        if k not in headers))
+    headers = dict((name.title(), val) for name, val in headers.items())
+    connections = self._Connections()
+    while True:
+      conn = connections.pop(host, None)
+      reused = conn is not None
+      if conn is None:
+        conn = http_class(host)
+      try:
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        response = conn.getresponse()
+        body = response.read()
+      except (socket.error, httplib.HTTPException), err:
+        conn.close()
+        if reused:
+          # The server closed the idle connection, try a new one.
+          continue
+        raise urllib2.URLError(err)
+      break
+    if response.will_close:
+      conn.close()
+    else:
+      connections[host] = conn
+    result = urllib.addinfourl(StringIO.StringIO(body), response.msg,
+                               req.get_full_url())
+    result.code = response.status
+    result.msg = response.reason
+    return result
+
+
+class KeepAliveHTTPHandler(KeepAliveHandlerMixin, urllib2.HTTPHandler):
+
+  def http_open(self, req):
+    return self._OpenKeepAlive(httplib.HTTPConnection, req)
+
+
+if hasattr(httplib, "HTTPSConnection"):
+  class KeepAliveHTTPSHandler(KeepAliveHandlerMixin, urllib2.HTTPSHandler):
+
+    def https_open(self, req):
+      return self._OpenKeepAlive(httplib.HTTPSConnection, req)
+else:
+  KeepAliveHTTPSHandler = None
+
+
 class HttpRpcServer(AbstractRpcServer):
   """Provides a simplified RPC-style interface for HTTP requests."""
 
@@ -427,9 +540,10 @@ class HttpRpcServer(AbstractRpcServer):
     opener = urllib2.OpenerDirector()
     opener.add_handler(urllib2.ProxyHandler())
     opener.add_handler(urllib2.UnknownHandler())
-    opener.add_handler(urllib2.HTTPHandler())
+    opener.add_handler(KeepAliveHTTPHandler())
     opener.add_handler(urllib2.HTTPDefaultErrorHandler())
-    opener.add_handler(urllib2.HTTPSHandler())
+    if KeepAliveHTTPSHandler is not None:
+      opener.add_handler(KeepAliveHTTPSHandler())
     opener.add_handler(urllib2.HTTPErrorProcessor())
     if self.save_cookies:
       self.cookie_file = os.path.expanduser("~/.codereview_upload_cookies")
@@ -486,6 +600,9 @@ group.add_option("-H", "--host", action="store", dest="host",
 group.add_option("--no_cookies", action="store_false",
                  dest="save_cookies", default=True,
                  help="Do not save authentication cookies to local disk.")
+group.add_option("--no_compress", action="store_false",
+                 dest="compress", default=True,
+                 help="Do not compress uploaded patches and files.")
 # Issue
 group = parser.add_option_group("Issue options")
 group.add_option("-d", "--description", action="store", dest="description",
@@ -526,6 +643,16 @@ group.add_option("--rev", action="store", dest="revision",
 group.add_option("--send_mail", action="store_true",
                  dest="send_mail", default=True,
                  help="Send notification email to reviewers.")
+group.add_option("--server_diff", action="store_true",
+                 dest="server_diff", default=False,
+                 help="Upload the base and new version of each file instead "
+                 "of the diff, the server generates the diffs.")
+group.add_option("--num_upload_threads", action="store", type="int",
+                 dest="num_upload_threads", default=8, metavar="N",
+                 help="Number of files to upload in parallel (default 8).")
+group.add_option("--no_batch_upload", action="store_false",
+                 dest="batch_upload", default=True,
+                 help="Upload every base file in a separate request.")
 group.add_option("--vcs", action="store", dest="vcs",
                  metavar="VCS", default=None,
                  help=("Version control system (optional, usually upload.py "
@@ -560,14 +687,16 @@ def GetRpcServer(options):
         options.server,
         lambda: (email, "password"),
         host_override=options.host,
-        save_cookies=options.save_cookies)
+        save_cookies=options.save_cookies,
+        compress=options.compress)
     # Don't try to talk to ClientLogin.
     server.authenticated = True
     return server
 
   return rpc_server_class(options.server, GetUserCredentials,
                           host_override=options.host,
-                          save_cookies=options.save_cookies)
+                          save_cookies=options.save_cookies,
+                          compress=options.compress)
 
 
 def EncodeMultipartFormData(fields, files):
@@ -605,6 +734,124 @@ def EncodeMultipartFormData(fields, files):
   return content_type, body
 
 
+def RunInParallel(func, items, num_threads):
+  """Calls func for every item using a pool of threads.
+
+  Args:
+    func: A function taking one item.
+    items: A sequence of items.
+    num_threads: Max number of concurrent calls.
+
+  Returns:
+    A list of the return values of func, in the order of items.  If a call
+    raised an exception (including SystemExit), the first one is re-raised
+    once all threads have finished.
+  """
+  items = list(items)
+  if num_threads <= 1 or len(items) <= 1:
+    return [func(item) for item in items]
+  results = [None] * len(items)
+  errors = []
+  lock = threading.Lock()
+  pending = iter(enumerate(items))
+
+  def Worker():
+    while True:
+      lock.acquire()
+      try:
+        if errors:
+          return
+        try:
+          index, item = pending.next()
+        except StopIteration:
+          return
+      finally:
+        lock.release()
+      try:
+        results[index] = func(item)
+      except:
+        lock.acquire()
+        errors.append(sys.exc_info())
+        lock.release()
+        return
+
+  threads = [threading.Thread(target=Worker)
+             for _ in range(min(num_threads, len(items)))]
+  for thread in threads:
+    thread.setDaemon(True)
+    thread.start()
+  # Join with a timeout, so that Ctrl-C still reaches the main thread.
+  for thread in threads:
+    while thread.isAlive():
+      thread.join(1)
+  if errors:
+    exc_type, exc_value, exc_traceback = errors[0]
+    raise exc_type, exc_value, exc_traceback
+  return results
+
+
+def GzipData(data):
+  """Returns data compressed with gzip."""
+  buf = StringIO.StringIO()
+  gz = gzip.GzipFile(fileobj=buf, mode="wb")
+  gz.write(data)
+  gz.close()
+  return buf.getvalue()
+
+
+def GetMaxUploadSize(options):
+  """Returns the max size of a patch or base file sent in one request."""
+  if options.compress:
+    return MAX_COMPRESSED_UPLOAD_SIZE
+  return MAX_UPLOAD_SIZE
+
+
+def UploadInChunks(rpc_server, data, options):
+  """Uploads data in chunks that can be resumed after errors.
+
+  The server keeps the chunks received in an upload session for a day, so
+  even running upload.py again resumes where the last attempt stopped.
+
+  Returns:
+    The upload session id, to be passed as upload_session form field
+    instead of the data.
+  """
+  form_fields = [("size", str(len(data))),
+                 ("checksum", md5(data).hexdigest())]
+  chunk_args = {}
+  if options.email:
+    form_fields.append(("user", options.email))
+    chunk_args["user"] = options.email
+  ctype, body = EncodeMultipartFormData(form_fields, [])
+  failures = 0
+  while True:
+    try:
+      # Starting the session again tells us where to resume.
+      lines = rpc_server.Send("/upload_session", body,
+                              content_type=ctype).splitlines()
+      if len(lines) < 3 or lines[0] != "OK":
+        StatusUpdate("  --> %s" % "\n".join(lines))
+        sys.exit(1)
+      session_id, received = lines[1], int(lines[2])
+      while received < len(data):
+        chunk = data[received:received + MAX_UPLOAD_SIZE]
+        lines = rpc_server.Send("/upload_session/%s" % session_id, chunk,
+                                offset=received, **chunk_args).splitlines()
+        if len(lines) < 2 or lines[0] != "OK":
+          StatusUpdate("  --> %s" % "\n".join(lines))
+          sys.exit(1)
+        received = int(lines[1])
+      return session_id
+    except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+      if isinstance(e, urllib2.HTTPError) and e.code < 500:
+        raise
+      failures += 1
+      if failures > MAX_CHUNKED_UPLOAD_RETRIES:
+        raise
+      StatusUpdate("Upload interrupted (%s), resuming." % e)
+      time.sleep(min(2 ** failures, 30))
+
+
 def GetContentType(filename):
   """Helper to guess the content-type from the filename."""
   return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
@@ -727,6 +974,21 @@ class VersionControlSystem(object):
     raise NotImplementedError(
         "abstract method -- subclass %s must override" % self.__class__)
 
+  def GetNewContent(self, filename, status):
+    """Get the content of the new version of a file, for --server_diff.
+
+    Subclasses override this for diffs that don't end at the working copy.
+
+    Returns:
+      The content of the file in the working copy, "" if it was deleted.
+    """
+    if not os.path.isfile(filename):
+      return ""
+    f = open(filename, "rb")
+    try:
+      return f.read()
+    finally:
+      f.close()
 
   def GetBaseFiles(self, diff):
     """Helper that calls GetBase file for each file in the patch.
@@ -749,24 +1011,27 @@ class VersionControlSystem(object):
 
   def UploadBaseFiles(self, issue, rpc_server, patch_list, patchset, options,
                       files):
-    """Uploads the base files (and if necessary, the current ones as well)."""
+    """Uploads the base files (and if necessary, the current ones as well).
 
-    def UploadFile(filename, file_id, content, is_binary, status, is_base):
-      """Uploads a file to the server."""
+    The checksums of all files are sent first, the server copies the files
+    it already has.  The others are uploaded by options.num_upload_threads
+    threads.  Unless options.batch_upload is False, small files are sent
+    together, see MAX_UPLOAD_BATCH_FILES.
+    """
+
+    def PrepareFile(filename, file_id, content, is_binary, status, is_base):
+      """Returns the form fields and content to upload for a file."""
       file_too_large = False
       if is_base:
         type = "base"
       else:
         type = "current"
-      if len(content) > MAX_UPLOAD_SIZE:
+      if len(content) > MAX_CHUNKED_UPLOAD_SIZE:
         print ("Not uploading the %s file for %s because it's too large." %
                (type, filename))
         file_too_large = True
         content = ""
       checksum = md5(content).hexdigest()
-      if options.verbose > 0 and not file_too_large:
-        print "Uploading %s file for %s" % (type, filename)
-      url = "/%d/upload_content/%d/%d" % (int(issue), int(patchset), file_id)
       form_fields = [("filename", filename),
                      ("status", status),
                      ("checksum", checksum),
@@ -775,18 +1040,96 @@ class VersionControlSystem(object):
                     ]
       if file_too_large:
         form_fields.append(("file_too_large", "1"))
+      return file_id, form_fields, filename, content, type
+
+    def ReuseContents(uploads):
+      """Lets the server reuse files it has, returns the files to upload."""
+      candidates = [upload for upload in uploads
+                    if ("file_too_large", "1") not in upload[1]]
+      reused = set()
+      # The server takes at most MAX_UPLOAD_BATCH_FILES files per request.
+      for start in range(0, len(candidates), MAX_UPLOAD_BATCH_FILES):
+        batch = candidates[start:start + MAX_UPLOAD_BATCH_FILES]
+        form_fields = [("count", str(len(batch)))]
+        if options.email:
+          form_fields.append(("user", options.email))
+        for index, upload in enumerate(batch):
+          form_fields.append(("%d-patch" % index, str(upload[0])))
+          for key, value in upload[1]:
+            form_fields.append(("%d-%s" % (index, key), value))
+        url = "/%d/reuse_content/%d" % (int(issue), int(patchset))
+        ctype, body = EncodeMultipartFormData(form_fields, [])
+        try:
+          response_body = rpc_server.Send(url, body, content_type=ctype)
+        except urllib2.HTTPError, e:
+          if e.code != 404:
+            raise
+          # The server can't reuse files.
+          return uploads
+        for line in response_body.splitlines():
+          index, status = line.split(" ", 1)
+          if status == "OK":
+            reused.add(id(batch[int(index)]))
+          elif status != "MISSING":
+            StatusUpdate("  --> %s" % line)
+            sys.exit(1)
+      if reused and options.verbose > 0:
+        print "Reusing %d files already on the server" % len(reused)
+      return [upload for upload in uploads if id(upload) not in reused]
+
+    def UploadFile(upload):
+      """Uploads a file to the server."""
+      file_id, form_fields, filename, content, _ = upload
+      form_fields = list(form_fields)
       if options.email:
         form_fields.append(("user", options.email))
-      ctype, body = EncodeMultipartFormData(form_fields,
-                                            [("data", filename, content)])
+      url = "/%d/upload_content/%d/%d" % (int(issue), int(patchset), file_id)
+      files = [("data", filename, content)]
+      if len(content) > GetMaxUploadSize(options):
+        form_fields.append(("upload_session",
+                            UploadInChunks(rpc_server, content, options)))
+        files = []
+      ctype, body = EncodeMultipartFormData(form_fields, files)
       response_body = rpc_server.Send(url, body,
                                       content_type=ctype)
       if not response_body.startswith("OK"):
         StatusUpdate("  --> %s" % response_body)
         sys.exit(1)
 
+    def UploadBatch(batch):
+      """Uploads several files in one request."""
+      if len(batch) == 1:
+        UploadFile(batch[0])
+        return
+      form_fields = [("count", str(len(batch)))]
+      if options.email:
+        form_fields.append(("user", options.email))
+      data = []
+      for index, (file_id, fields, filename, content, _) in enumerate(batch):
+        form_fields.append(("%d-patch" % index, str(file_id)))
+        for key, value in fields:
+          form_fields.append(("%d-%s" % (index, key), value))
+        data.append(("%d-data" % index, filename, content))
+      url = "/%d/upload_content_batch/%d" % (int(issue), int(patchset))
+      ctype, body = EncodeMultipartFormData(form_fields, data)
+      try:
+        response_body = rpc_server.Send(url, body, content_type=ctype)
+      except urllib2.HTTPError, e:
+        if e.code != 404:
+          raise
+        # The server doesn't know about batches.
+        for upload in batch:
+          UploadFile(upload)
+        return
+      lines = response_body.splitlines()
+      failed = [line for line in lines if line.split(" ", 1)[1:] != ["OK"]]
+      if len(lines) != len(batch) or failed:
+        StatusUpdate("  --> %s" % ("\n".join(failed) or response_body))
+        sys.exit(1)
+
     patches = dict()
     [patches.setdefault(v, k) for k, v in patch_list]
+    uploads = []
     if files:
       for filename in patches.keys():
         base_content, new_content, is_binary, status = files[filename]
@@ -796,9 +1139,29 @@ class VersionControlSystem(object):
           file_id_str = file_id_str[file_id_str.rfind("_") + 1:]
         file_id = int(file_id_str)
         if base_content != None:
-          UploadFile(filename, file_id, base_content, is_binary, status, True)
+          uploads.append(PrepareFile(filename, file_id, base_content,
+                                     is_binary, status, True))
         if new_content != None:
-          UploadFile(filename, file_id, new_content, is_binary, status, False)
+          uploads.append(PrepareFile(filename, file_id, new_content,
+                                     is_binary, status, False))
+    uploads = ReuseContents(uploads)
+    if options.verbose > 0:
+      for _, form_fields, filename, _, type in uploads:
+        if ("file_too_large", "1") not in form_fields:
+          print "Uploading %s file for %s" % (type, filename)
+    # Fill batches up to MAX_UPLOAD_SIZE; large files go on their own.
+    batches = []
+    batch_size = 0
+    for upload in uploads:
+      size = len(upload[3])
+      if (not options.batch_upload or not batches or
+          len(batches[-1]) >= MAX_UPLOAD_BATCH_FILES or
+          batch_size + size > MAX_UPLOAD_SIZE):
+        batches.append([])
+        batch_size = 0
+      batches[-1].append(upload)
+      batch_size += size
+    RunInParallel(UploadBatch, batches, options.num_upload_threads)
 
   def IsImage(self, filename):
     """Returns true if the filename has an image extension."""
@@ -1181,6 +1544,17 @@ class SubversionVCS(VersionControlSystem):
         base_content = ''
     return base_content, new_content, is_binary, status[0:5]
 
+  def GetNewContent(self, filename, status):
+    if not self.rev_end:
+      return super(SubversionVCS, self).GetNewContent(filename, status)
+    url = "%s/%s@%s" % (self.svn_base, filename, self.rev_end)
+    content, returncode = RunShellWithReturnCode(["svn", "cat", url],
+                                                 universal_newlines=False)
+    if returncode:
+      # Deleted in the requested revision.
+      return ""
+    return content
+
 
 class GitVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for Git."""
@@ -1320,6 +1694,15 @@ class GitVCS(VersionControlSystem):
 
     return (base_content, new_content, is_binary, status)
 
+  def GetNewContent(self, filename, status):
+    hash_before, hash_after = self.hashes.get(filename, (None, None))
+    if hash_after:
+      return self.GetFileContent(hash_after, self.IsBinary(filename))
+    if status == "D":
+      return ""
+    # Renamed without changes.
+    return super(GitVCS, self).GetNewContent(filename, status)
+
 
 class MercurialVCS(VersionControlSystem):
   """Implementation of the VersionControlSystem interface for Mercurial."""
@@ -1422,6 +1805,12 @@ class MercurialVCS(VersionControlSystem):
       new_content = None
     return base_content, new_content, is_binary, status
 
+  def GetNewContent(self, filename, status):
+    if status == "R":
+      return ""
+    return super(MercurialVCS, self).GetNewContent(self._GetRelPath(filename),
+                                                   status)
+
 
 # NOTE: The SplitPatch function is duplicated in engine.py, keep them in sync.
 def SplitPatch(data):
@@ -1467,29 +1856,38 @@ def SplitPatch(data):
 def UploadSeparatePatches(issue, rpc_server, patchset, data, options):
   """Uploads a separate patch for each file in the diff output.
 
+  The patches are uploaded by options.num_upload_threads threads.
+
   Returns a list of [patch_key, filename] for each file.
   """
-  patches = SplitPatch(data)
-  rv = []
-  for patch in patches:
-    if len(patch[1]) > MAX_UPLOAD_SIZE:
+  patches = []
+  for patch in SplitPatch(data):
+    if len(patch[1]) > MAX_CHUNKED_UPLOAD_SIZE:
       print ("Not uploading the patch for " + patch[0] +
              " because the file is too large.")
       continue
+    patches.append(patch)
+
+  def UploadPatch(patch):
     form_fields = [("filename", patch[0])]
     if not options.download_base:
       form_fields.append(("content_upload", "1"))
     files = [("data", "data.diff", patch[1])]
+    print "Uploading patch for " + patch[0]
+    if len(patch[1]) > GetMaxUploadSize(options):
+      form_fields.append(("upload_session",
+                          UploadInChunks(rpc_server, patch[1], options)))
+      files = []
     ctype, body = EncodeMultipartFormData(form_fields, files)
     url = "/%d/upload_patch/%d" % (int(issue), int(patchset))
-    print "Uploading patch for " + patch[0]
     response_body = rpc_server.Send(url, body, content_type=ctype)
     lines = response_body.splitlines()
     if not lines or lines[0] != "OK":
       StatusUpdate("  --> %s" % response_body)
       sys.exit(1)
-    rv.append([lines[1], patch[0]])
-  return rv
+    return [lines[1], patch[0]]
+
+  return RunInParallel(UploadPatch, patches, options.num_upload_threads)
 
 
 def GuessVCSName():
@@ -1628,6 +2026,14 @@ def RealMain(argv, data=None):
     data = vcs.GenerateDiff(args)
   if not vcs.IsNewFile():
     files = vcs.GetBaseFiles(data)
+  if options.server_diff:
+    if options.download_base or files is None:
+      ErrorExit("--server_diff requires uploading the base files.")
+    for filename, (base_content, new_content, is_binary,
+                   status) in files.items():
+      if new_content is None:
+        new_content = vcs.GetNewContent(filename, status)
+      files[filename] = (base_content or "", new_content, is_binary, status)
   if verbosity >= 1:
     print "Upload server:", options.server, "(change with -s/--server)"
   if options.issue:
@@ -1693,7 +2099,11 @@ def RealMain(argv, data=None):
     form_fields.append(("send_mail", "1"))
   if not options.download_base:
     form_fields.append(("content_upload", "1"))
-  if len(data) > MAX_UPLOAD_SIZE:
+  if options.server_diff:
+    form_fields.append(("server_diff", "1"))
+    form_fields.append(("files", "\n".join(sorted(files))))
+    uploaded_diff_file = []
+  elif len(data) > MAX_UPLOAD_SIZE:
     print "Patch is large, so uploading file patches separately."
     uploaded_diff_file = []
     form_fields.append(("separate_patches", "1"))
@@ -1718,13 +2128,19 @@ def RealMain(argv, data=None):
     sys.exit(0)
   issue = msg[msg.rfind("/")+1:]
 
-  if not uploaded_diff_file:
+  if not uploaded_diff_file and not options.server_diff:
     result = UploadSeparatePatches(issue, rpc_server, patchset, data, options)
     if not options.download_base:
       patches = result
 
   if not options.download_base:
     vcs.UploadBaseFiles(issue, rpc_server, patches, patchset, options, files)
+    if options.server_diff:
+      response_body = rpc_server.Send("/%s/generate_diffs/%s" %
+                                      (issue, patchset), payload="")
+      if not response_body.startswith("OK"):
+        StatusUpdate("  --> %s" % response_body)
+        sys.exit(1)
     if options.send_mail:
       rpc_server.Send("/" + issue + "/mail", payload="")
   return issue, patchset
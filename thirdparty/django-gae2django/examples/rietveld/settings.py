@@ -67,6 +67,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'gae2django.middleware.FixRequestUserMiddleware',
+    'gae2django.middleware.TaskQueueHeadersMiddleware',
     # Keep in mind, that CSRF protection is DISABLED in this example!
     'rietveld_helper.middleware.DisableCSRFMiddleware',
     'rietveld_helper.middleware.AddUserToRequestMiddleware',
@@ -16,6 +16,9 @@
 """Implements the mail fetch API.
 
 http://code.google.com/appengine/docs/mail/
+
+If settings.MAIL_USE_OUTBOX is True, messages are queued and delivered
+in batches by a task (see gae2django.outbox), like App Engine does.
 """
 
 from django.conf import settings
@@ -108,7 +111,13 @@ class EmailMessage(object):
             headers['Reply-To'] = ', '.join(self.reply_to)
         msg = _EmailMessage(self.subject, self.body, self.sender,
                             self.to, self.cc + self.bcc, headers=headers)
-        msg.send(fail_silently=True)
+        for filename, content in self.attachments:
+            msg.attach(filename, content)
+        if getattr(settings, 'MAIL_USE_OUTBOX', False):
+            from gae2django import outbox
+            outbox.enqueue(msg)
+        else:
+            msg.send(fail_silently=True)
 
 
 def send_mail(sender, to, subject, body, **kw):
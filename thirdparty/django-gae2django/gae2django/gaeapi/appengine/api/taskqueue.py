@@ -0,0 +1,217 @@
+#
+# Copyright 2008 Andi Albrecht <albrecht.andi@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Implements the task queue API.
+
+http://code.google.com/appengine/docs/python/taskqueue/
+
+Tasks are stored in the database (see gae2django.models.Task) and are
+executed by the runtasks management command, which must be kept running
+next to the web server:
+
+  python manage.py runtasks
+"""
+
+import base64
+import cPickle
+import datetime
+import re
+import urllib
+import uuid
+
+from django.db import IntegrityError
+
+DEFAULT_QUEUE = 'default'
+DEFAULT_QUEUE_PATH = '/_ah/queue'
+
+MAX_QUEUE_NAME_LENGTH = 100
+MAX_TASK_NAME_LENGTH = 500
+MAX_URL_LENGTH = 2000
+MAX_TASK_SIZE_BYTES = 10 * (2 ** 20)
+
+_QUEUE_NAME_RE = re.compile(r'^[a-zA-Z0-9-]{1,%d}$' % MAX_QUEUE_NAME_LENGTH)
+_TASK_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]{1,%d}$' % MAX_TASK_NAME_LENGTH)
+
+_METHODS = frozenset(['GET', 'POST', 'HEAD', 'PUT', 'DELETE'])
+_BODY_METHODS = frozenset(['POST', 'PUT'])
+
+
+class Error(Exception):
+    """Base class for all exceptions in this module."""
+
+
+class UnknownQueueError(Error):
+    pass
+
+
+class InvalidQueueNameError(Error):
+    pass
+
+
+class InvalidTaskError(Error):
+    pass
+
+
+class InvalidTaskNameError(InvalidTaskError):
+    pass
+
+
+class InvalidUrlError(InvalidTaskError):
+    pass
+
+
+class InvalidPayloadError(InvalidTaskError):
+    pass
+
+
+class TaskTooLargeError(InvalidTaskError):
+    pass
+
+
+class TaskAlreadyExistsError(InvalidTaskError):
+    pass
+
+
+class TombstonedTaskError(InvalidTaskError):
+    """Unused, names of finished tasks can be reused."""
+
+
+class Task(object):
+    """A task to be executed as a request to the given URL."""
+
+    def __init__(self, payload=None, **kwds):
+        """Constructor.
+
+        Args:
+          payload: Optional request body, only allowed for POST and PUT.
+          countdown: Seconds to wait before running the task.
+          eta: datetime.datetime when to run the task (local time).
+          headers: Dict of additional request headers.
+          method: HTTP method, defaults to POST.
+          name: Task name, generated if not given.
+          params: Dict of parameters, sent as form data for POST and PUT
+            and in the query string otherwise.  Excludes payload.
+          url: Relative URL of the handler, defaults to /_ah/queue/<queue>.
+        """
+        self.name = kwds.get('name')
+        if self.name is not None and not _TASK_NAME_RE.match(self.name):
+            raise InvalidTaskNameError(self.name)
+        self.method = kwds.get('method', 'POST').upper()
+        if self.method not in _METHODS:
+            raise InvalidTaskError('Invalid method: %s' % self.method)
+        self.headers = dict(kwds.get('headers') or {})
+        self._url = kwds.get('url')
+        if self._url is not None and not self._url.startswith('/'):
+            raise InvalidUrlError('Task URLs must be relative: %s'
+                                  % self._url)
+        params = kwds.get('params')
+        if params and payload is not None:
+            raise InvalidTaskError('Payload and params are exclusive.')
+        query = ''
+        if params:
+            encoded = urllib.urlencode(params, doseq=True)
+            if self.method in _BODY_METHODS:
+                payload = encoded
+                self.headers.setdefault('content-type',
+                                        'application/x-www-form-urlencoded')
+            else:
+                query = encoded
+        if payload is not None and self.method not in _BODY_METHODS:
+            raise InvalidPayloadError('Payload is only allowed for POST '
+                                      'and PUT requests.')
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        self.payload = payload or ''
+        if len(self.payload) > MAX_TASK_SIZE_BYTES:
+            raise TaskTooLargeError('Task payload exceeds %d bytes.'
+                                    % MAX_TASK_SIZE_BYTES)
+        self._query = query
+        countdown = kwds.get('countdown')
+        eta = kwds.get('eta')
+        if countdown is not None and eta is not None:
+            raise InvalidTaskError('Countdown and eta are exclusive.')
+        if eta is None:
+            eta = datetime.datetime.now()
+            if countdown:
+                eta += datetime.timedelta(seconds=countdown)
+        self.eta = eta
+        self.queue_name = None
+        self.was_enqueued = False
+
+    @property
+    def url(self):
+        url = self._url
+        if url is None:
+            url = '%s/%s' % (DEFAULT_QUEUE_PATH,
+                             self.queue_name or DEFAULT_QUEUE)
+        if self._query:
+            url += ('?' in url and '&' or '?') + self._query
+        return url
+
+    def add(self, queue_name=DEFAULT_QUEUE, transactional=False):
+        """Add this task to a queue.
+
+        Since tasks are stored in the same database as everything else,
+        a task added inside a transaction is only run if the transaction
+        commits, i.e. all tasks are transactional.
+        """
+        return Queue(queue_name).add(self)
+
+
+class Queue(object):
+    """A named queue of tasks."""
+
+    def __init__(self, name=DEFAULT_QUEUE):
+        if not _QUEUE_NAME_RE.match(name):
+            raise InvalidQueueNameError(name)
+        self.name = name
+
+    def add(self, task, transactional=False):
+        """Add a task or a list of tasks to this queue."""
+        from gae2django.models import Task as TaskModel
+        if isinstance(task, (list, tuple)):
+            return [self.add(t, transactional) for t in task]
+        if task.was_enqueued:
+            raise InvalidTaskError('Task has already been added.')
+        task.queue_name = self.name
+        if task.name is None:
+            task.name = 'task-%s' % uuid.uuid4().hex
+        url = task.url
+        if len(url) > MAX_URL_LENGTH:
+            raise InvalidUrlError('Task URL exceeds %d characters.'
+                                  % MAX_URL_LENGTH)
+        if TaskModel.objects.filter(name=task.name).count():
+            raise TaskAlreadyExistsError(task.name)
+        try:
+            TaskModel.objects.create(
+                queue_name=self.name, name=task.name, url=url,
+                method=task.method,
+                payload=base64.encodestring(task.payload),
+                headers=base64.encodestring(cPickle.dumps(task.headers)),
+                eta=task.eta)
+        except IntegrityError:
+            raise TaskAlreadyExistsError(task.name)
+        task.was_enqueued = True
+        return task
+
+
+def add(*args, **kwds):
+    """Create a task and add it to a queue.
+
+    Takes the same arguments as Task() plus queue_name and transactional.
+    """
+    queue_name = kwds.pop('queue_name', DEFAULT_QUEUE)
+    transactional = kwds.pop('transactional', False)
+    return Task(*args, **kwds).add(queue_name, transactional)
@@ -16,12 +16,25 @@
 """Implements the URL fetch API.
 
 http://code.google.com/appengine/docs/urlfetch/
+
+Connections are kept alive and reused per host.  These settings are
+used:
+
+  URLFETCH_DEADLINE: Default timeout in seconds (10).
+  URLFETCH_MAX_RESPONSE_SIZE: Larger responses raise ResponseTooLargeError
+    unless allow_truncated is True (32 MB).
+  URLFETCH_MAX_IDLE_CONNECTIONS: Idle connections kept per host (4).
 """
 
 import httplib
 import socket
+import threading
 import urlparse
 
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
 # Constants
 GET = 'GET'
 POST = 'POST'
@@ -38,68 +51,236 @@ REDIRECT_STATUSES = frozenset([
   httplib.TEMPORARY_REDIRECT,
 ])
 
+DEFAULT_DEADLINE = getattr(settings, 'URLFETCH_DEADLINE', 10)
+MAX_RESPONSE_SIZE = getattr(settings, 'URLFETCH_MAX_RESPONSE_SIZE',
+                            32 * (2 ** 20))
+MAX_IDLE_CONNECTIONS = getattr(settings, 'URLFETCH_MAX_IDLE_CONNECTIONS', 4)
+# Responses kept for conditional requests must fit into one cache entry.
+MAX_CACHED_RESPONSE_SIZE = 1000 * 1000
+
+_CACHE_PREFIX = 'gae2django.urlfetch:'
+
+
+class _ConnectionPool(object):
+    """Idle keep-alive connections by (scheme, host).
+
+    Thread-safe, so several threads can fetch from the same host
+    concurrently; each of them gets its own connection.
+    """
+
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, scheme, host, timeout):
+        """Returns a connection and whether it was used before."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.get((scheme, host))
+            connection = idle and idle.pop() or None
+        finally:
+            self._lock.release()
+        if connection is not None:
+            connection.sock.settimeout(timeout)
+            return connection, True
+        if scheme == 'http':
+            connection = httplib.HTTPConnection(host, timeout=timeout)
+        else:
+            connection = httplib.HTTPSConnection(host, timeout=timeout)
+        return connection, False
+
+    def put(self, scheme, host, connection):
+        """Returns a connection whose response has been read completely."""
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.max_idle and connection.sock is not None:
+                idle.append(connection)
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._lock.release()
+        for connections in idle.itervalues():
+            for connection in connections:
+                connection.close()
+
+
+_pool = _ConnectionPool(MAX_IDLE_CONNECTIONS)
+
+
+def _request(scheme, host, method, path, payload, headers, deadline):
+    """Sends a request on a pooled connection.
+
+    Returns:
+      A 2-tuple (httplib.HTTPResponse, connection).  The response hasn't
+      been read yet.
+    """
+    connection, reused = _pool.get(scheme, host, deadline)
+    try:
+        connection.request(method, path, payload, headers)
+        return connection.getresponse(), connection
+    except (httplib.BadStatusLine, socket.error), err:
+        connection.close()
+        if not reused or isinstance(err, socket.timeout):
+            raise
+    # The server has closed the idle connection, try a new one.
+    connection, reused = _pool.get(scheme, host, deadline)
+    try:
+        connection.request(method, path, payload, headers)
+        return connection.getresponse(), connection
+    except:
+        connection.close()
+        raise
+
 
-def fetch(url, payload=None, method=GET, headers={}, allow_truncated=False):
+def _read(http_response, allow_truncated):
+    """Reads a response body up to MAX_RESPONSE_SIZE.
+
+    Returns:
+      A 2-tuple (content, was_truncated).
+    """
+    content = http_response.read(MAX_RESPONSE_SIZE + 1)
+    if len(content) <= MAX_RESPONSE_SIZE:
+        return content, False
+    if not allow_truncated:
+        raise ResponseTooLargeError(None)
+    return content[:MAX_RESPONSE_SIZE], True
+
+
+def _cache_key(url):
+    return _CACHE_PREFIX + md5_constructor(url).hexdigest()
+
+
+def fetch(url, payload=None, method=GET, headers={}, allow_truncated=False,
+          follow_redirects=True, deadline=None, conditional=False):
+    """Fetches a URL.
+
+    Args:
+      url: The http or https URL.
+      payload: Request body for POST and PUT requests.
+      method: The HTTP method.
+      headers: Dict of additional request headers.
+      allow_truncated: If True, responses larger than MAX_RESPONSE_SIZE
+        are truncated instead of raising ResponseTooLargeError.
+      follow_redirects: If False, redirects are returned as is.
+      deadline: Timeout in seconds, defaults to URLFETCH_DEADLINE.
+      conditional: Not in the App Engine API.  If True, GET responses with
+        an ETag or Last-Modified header are cached, and refetching the URL
+        sends If-None-Match or If-Modified-Since.  When the server answers
+        304 Not Modified the cached response is returned.
+
+    Returns:
+      A Response instance.
+    """
     if method in [POST, PUT]:
         payload = payload or ''
     else:
         payload = ''
+    if deadline is None:
+        deadline = DEFAULT_DEADLINE
+    conditional = conditional and method == GET
     for redirect_number in xrange(MAX_REDIRECTS+1):
         scheme, host, path, params, query, fragment = urlparse.urlparse(url)
-        try:
-            if scheme == 'http':
-                connection = httplib.HTTPConnection(host)
-            elif scheme == 'https':
-                connection = httplib.HTTPSConnection(host)
-            else:
-                raise InvalidURLError('Protocol \'%s\' is not supported.')
+        if scheme not in ('http', 'https'):
+            raise InvalidURLError('Protocol \'%s\' is not supported.'
+                                  % scheme)
 
-            if query != '':
-                full_path = path + '?' + query
-            else:
-                full_path = path
+        if query != '':
+            full_path = path + '?' + query
+        else:
+            full_path = path
 
-            adjusted_headers = {
-                'Content-Length': len(payload),
-                'Host': host,
-                'Accept': '*/*',
-            }
-            for header in headers:
-                adjusted_headers[header] = headers[header]
+        adjusted_headers = {
+            'Content-Length': len(payload),
+            'Host': host,
+            'Accept': '*/*',
+        }
+        cached = None
+        if conditional:
+            cached = cache.get(_cache_key(url))
+            if cached is not None:
+                if cached['etag']:
+                    adjusted_headers['If-None-Match'] = cached['etag']
+                if cached['last_modified']:
+                    adjusted_headers['If-Modified-Since'] = \
+                        cached['last_modified']
+        for header in headers:
+            adjusted_headers[header] = headers[header]
 
+        try:
+            http_response, connection = _request(
+                scheme, host, method, full_path, payload, adjusted_headers,
+                deadline)
             try:
-                connection.request(method, full_path, payload,
-                                   adjusted_headers)
-                http_response = connection.getresponse()
-                http_response_data = http_response.read()
-            finally:
+                content, was_truncated = _read(http_response,
+                                               allow_truncated)
+            except:
+                connection.close()
+                raise
+            if was_truncated or http_response.will_close:
                 connection.close()
-
-            if http_response.status in REDIRECT_STATUSES:
-                newurl = http_response.getheader('Location', None)
-                if newurl is None:
-                    raise DownloadError('Redirect is missing Location header.')
-                else:
-                    url = urlparse.urljoin(url, newurl)
-                    method = 'GET'
             else:
-                response = Response()
-                response.content = http_response_data
-                response.status_code = http_response.status
-                response.headers = {}
-                for header_key, header_value in http_response.getheaders():
-                    response.headers[header_key] = header_value
-                return response
-
+                _pool.put(scheme, host, connection)
+        except socket.timeout, e:
+            raise DeadlineExceededError('Deadline exceeded while fetching '
+                                        '\'%s\': %s' % (url, e))
         except (httplib.error, socket.error, IOError), e:
             raise DownloadError('Download of \'%s\' failed: %s' % (url, e))
 
+        if (follow_redirects and
+            http_response.status in REDIRECT_STATUSES):
+            newurl = http_response.getheader('Location', None)
+            if newurl is None:
+                raise DownloadError('Redirect is missing Location header.')
+            else:
+                url = urlparse.urljoin(url, newurl)
+                method = 'GET'
+                payload = ''
+            continue
+
+        if cached is not None and http_response.status == httplib.NOT_MODIFIED:
+            content = cached['content']
+            status_code = cached['status_code']
+            response_headers = cached['headers']
+        else:
+            status_code = http_response.status
+            response_headers = {}
+            for header_key, header_value in http_response.getheaders():
+                response_headers[header_key] = header_value
+            etag = http_response.getheader('ETag')
+            last_modified = http_response.getheader('Last-Modified')
+            if (conditional and status_code == httplib.OK and
+                (etag or last_modified) and not was_truncated and
+                len(content) <= MAX_CACHED_RESPONSE_SIZE):
+                cache.set(_cache_key(url),
+                          {'etag': etag, 'last_modified': last_modified,
+                           'content': content, 'status_code': status_code,
+                           'headers': response_headers})
+        response = Response()
+        response.content = content
+        response.content_was_truncated = was_truncated
+        response.status_code = status_code
+        response.headers = response_headers
+        response.final_url = url
+        return response
+
+    raise DownloadError('Too many redirects fetching \'%s\'.' % url)
+
 
 class Response(object):
     content = None
     content_was_truncated = False
     status_code = -1
     headers = None
+    final_url = None
 
 
 class Error(Exception):
@@ -114,5 +295,14 @@ class DownloadError(Error):
     """Download failed."""
 
 
+class DeadlineExceededError(DownloadError):
+    """The deadline was exceeded."""
+
+
 class ResponseTooLargeError(Error):
-    """Unused."""
+    """The response was larger than MAX_RESPONSE_SIZE."""
+
+    def __init__(self, response):
+        Error.__init__(self, 'Response larger than %d bytes.'
+                       % MAX_RESPONSE_SIZE)
+        self.response = response
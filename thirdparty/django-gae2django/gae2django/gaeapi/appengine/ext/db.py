@@ -18,6 +18,7 @@ from django.db.models.fields.related import (
 from django.db.models.query import QuerySet
 from django.db.models.query_utils import Q
 from django.db.models.signals import post_init
+from django.db import IntegrityError
 from django.db import transaction
 from django.utils.hashcompat import md5_constructor
 
@@ -389,7 +390,15 @@ class Model(models.Model):
         except cls.DoesNotExist:
             kwds['gae_key'] = key
             new = cls(**kwds)
-            new.save()
+            # Another request may insert the key in the meantime, return
+            # its entity then like QuerySet.get_or_create() does.
+            sid = transaction.savepoint()
+            try:
+                new.save()
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                return cls.objects.get(gae_key=key)
+            transaction.savepoint_commit(sid)
             return new
 
     @classmethod
@@ -399,15 +408,12 @@ class Model(models.Model):
         if type(keys) not in [types.ListType, types.TupleType]:
             single = True
             keys = [keys]
-        result = []
-        for key in keys:
-            try:
-                kwds = {'gae_key': str(key)}
-                if parent is not None:
-                    kwds['gae_ancestry__icontains'] = str(parent.key())
-                result.append(cls.objects.get(**kwds))
-            except cls.DoesNotExist:
-                result.append(None)
+        # Fetch all instances with a single query, like a batch get.
+        kwds = {'gae_key__in': [str(key) for key in keys]}
+        if parent is not None:
+            kwds['gae_ancestry__icontains'] = str(parent.key())
+        found = dict((obj.gae_key, obj) for obj in cls.objects.filter(**kwds))
+        result = [found.get(str(key)) for key in keys]
         if single and len(result) != 0:
             return result[0]
         elif single:
@@ -418,16 +424,13 @@ class Model(models.Model):
     @classmethod
     def get_by_id(cls, id_, parent=None):
         # Ignore parent, we've got an ID
-        ret = []
         return_list = True
         if type(id_) not in (types.ListType, types.TupleType):
             id_ = [id_]
             return_list = False
-        for i in id_:
-            try:
-                ret.append(cls.objects.get(id=i))
-            except cls.DoesNotExist:
-                ret.append(None)
+        # Fetch all instances with a single query, like a batch get.
+        found = cls.objects.in_bulk([int(i) for i in id_])
+        ret = [found.get(int(i)) for i in id_]
         if len(id_) == 1 and not return_list:
             return ret[0]
         else:
@@ -880,6 +883,26 @@ def delete(models):
         model.delete()
 
 
+# Like on App Engine, a colliding transaction is retried this often.
+DEFAULT_TRANSACTION_RETRIES = 3
+
+
 @transaction.commit_on_success
-def run_in_transaction(func, *args, **kwds):
+def _run_in_transaction_once(func, *args, **kwds):
     return func(*args, **kwds)
+
+
+def run_in_transaction(func, *args, **kwds):
+    return run_in_transaction_custom_retries(DEFAULT_TRANSACTION_RETRIES,
+                                             func, *args, **kwds)
+
+
+def run_in_transaction_custom_retries(retries, func, *args, **kwds):
+    # The collision noticed here is inserting a key name that another
+    # transaction inserted since func looked it up; the retry finds it.
+    for i in range(retries + 1):
+        try:
+            return _run_in_transaction_once(func, *args, **kwds)
+        except IntegrityError:
+            pass
+    raise TransactionFailedError('The transaction could not be committed.')
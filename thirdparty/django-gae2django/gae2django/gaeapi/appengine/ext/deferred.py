@@ -0,0 +1,76 @@
+#
+# Copyright 2008 Andi Albrecht <albrecht.andi@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Implements the deferred library.
+
+http://code.google.com/appengine/articles/deferred.html
+
+Deferred calls are pickled into tasks posted to /_ah/queue/deferred.
+Route that URL to gae2django.views.deferred to run them:
+
+  (r'^_ah/queue/deferred$', 'gae2django.views.deferred'),
+"""
+
+import cPickle
+
+from gaeapi.appengine.api import taskqueue
+
+_DEFAULT_URL = '/_ah/queue/deferred'
+_TASKQUEUE_HEADERS = {'Content-Type': 'application/octet-stream'}
+
+
+class Error(Exception):
+    """Base class for exceptions in this module."""
+
+
+class PermanentTaskFailure(Error):
+    """Raised to indicate that a task should not be retried."""
+
+
+def serialize(obj, *args, **kwds):
+    """Serializes a callable and its arguments into a task payload."""
+    return cPickle.dumps((obj, args, kwds), cPickle.HIGHEST_PROTOCOL)
+
+
+def run(data):
+    """Unpickles and executes a deferred call.
+
+    Raises:
+      PermanentTaskFailure: If the payload can't be unpickled, or the call
+        itself raised it.
+    """
+    try:
+        func, args, kwds = cPickle.loads(data)
+    except Exception, err:
+        raise PermanentTaskFailure(err)
+    return func(*args, **kwds)
+
+
+def defer(obj, *args, **kwds):
+    """Defers a call to a module level function or other picklable callable.
+
+    Arguments starting with an underscore are passed on to the task:
+    _countdown, _eta, _name, _queue, _transactional and _url.  All other
+    arguments are passed to the callable.
+    """
+    taskargs = dict((name, kwds.pop('_%s' % name, None))
+                    for name in ('countdown', 'eta', 'name'))
+    taskargs['url'] = kwds.pop('_url', _DEFAULT_URL)
+    taskargs['headers'] = _TASKQUEUE_HEADERS
+    queue = kwds.pop('_queue', taskqueue.DEFAULT_QUEUE)
+    transactional = kwds.pop('_transactional', False)
+    payload = serialize(obj, *args, **kwds)
+    task = taskqueue.Task(payload=payload, **taskargs)
+    return task.add(queue, transactional=transactional)
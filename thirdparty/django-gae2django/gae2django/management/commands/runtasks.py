@@ -0,0 +1,45 @@
+#
+# Copyright 2008 Andi Albrecht <albrecht.andi@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from gae2django import taskrunner
+
+
+class Command(BaseCommand):
+    help = 'Executes tasks added to the task queue.'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of worker processes.'),
+        make_option('--queue', action='append', dest='queues', default=[],
+                    help='Only run tasks from this queue (repeatable).'),
+        make_option('--poll-interval', type='float', dest='poll_interval',
+                    default=1.0,
+                    help='Seconds to wait when no task is due.'),
+        make_option('--once', action='store_true', dest='once',
+                    default=False,
+                    help='Exit when no task is due.'),
+    )
+
+    def handle(self, *args, **options):
+        kwds = {'queue_names': options['queues'] or None,
+                'poll_interval': options['poll_interval'],
+                'once': options['once']}
+        if options['processes'] > 1:
+            taskrunner.run_pool(options['processes'], **kwds)
+        else:
+            taskrunner.run(**kwds)
@@ -51,3 +51,25 @@ class FixRequestUserMiddleware(object):
         else:
             request.user.email = CallableString()
             request.user.nickname = CallableString()
+
+
+# Set in the WSGI environ of requests made by gae2django.taskrunner.  It
+# can't be faked by clients since HTTP headers always end up with an
+# HTTP_ prefix.
+TASKQUEUE_ENVIRON_KEY = 'gae2django.taskqueue'
+
+
+class TaskQueueHeadersMiddleware(object):
+    """Removes X-AppEngine-* headers from requests not made by the queue.
+
+    App Engine strips these headers from external requests, so
+    applications rely on them to recognize requests made by the task
+    queue.
+    """
+
+    def process_request(self, request):
+        if request.META.get(TASKQUEUE_ENVIRON_KEY):
+            return
+        for key in request.META.keys():
+            if key.startswith('HTTP_X_APPENGINE_'):
+                del request.META[key]
@@ -3,6 +3,52 @@ from django.db import models
 from gaeapi.appengine.ext import db
 
 
+class Task(models.Model):
+    """A task waiting in a queue, see gaeapi.appengine.api.taskqueue.
+
+    Tasks are executed by the runtasks management command, which turns
+    each of them into a request to the task's URL.
+    """
+    queue_name = models.CharField(max_length=100, default='default',
+                                  db_index=True)
+    name = models.CharField(max_length=500, unique=True)
+    url = models.CharField(max_length=2000)
+    method = models.CharField(max_length=10, default='POST')
+    # Base64 encoded, like db.BlobProperty.
+    payload = models.TextField(blank=True, default='')
+    # Pickled and base64 encoded dict of additional headers.
+    headers = models.TextField(blank=True, default='')
+    # The task isn't run before this time.  It's moved forward while the
+    # task is leased by a worker and after a failed attempt.
+    eta = models.DateTimeField(db_index=True)
+    retry_count = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('eta',)
+
+    def __unicode__(self):
+        return u'%s/%s' % (self.queue_name, self.name)
+
+
+class OutgoingMail(models.Model):
+    """A mail waiting in the outbox, see gae2django.outbox."""
+    # Pickled and base64 encoded django.core.mail.EmailMessage.
+    message = models.TextField()
+    attempts = models.IntegerField(default=0)
+    # The mail isn't sent before this time.  Like Task.eta it's moved
+    # forward while the mail is leased and after a failed attempt.
+    next_attempt = models.DateTimeField(db_index=True)
+    last_error = models.TextField(blank=True, default='')
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('next_attempt',)
+
+    def __unicode__(self):
+        return u'OutgoingMail %s' % self.pk
+
+
 class RefTestModel(db.Model):
     value = db.StringProperty()
 
@@ -0,0 +1,234 @@
+#
+# Copyright 2008 Andi Albrecht <albrecht.andi@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Queues outgoing mail and delivers it in batches.
+
+When settings.MAIL_USE_OUTBOX is True, gaeapi.appengine.api.mail stores
+messages in the outbox instead of sending them.  A deferred flush() on
+the "mail" queue then delivers everything that is due over one SMTP
+session, which is kept open for the next flush.  Failed messages are
+retried with exponential backoff a limited number of times.
+
+Delivery counters are kept in the cache, see get_stats().
+"""
+
+import base64
+import cPickle
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import get_connection
+
+from gaeapi.appengine.api import taskqueue
+from gaeapi.appengine.ext import deferred
+from gae2django.models import OutgoingMail
+
+# Messages are collected for this long before a flush is run.
+FLUSH_DELAY_SECONDS = getattr(settings, 'MAIL_OUTBOX_FLUSH_DELAY', 2)
+BATCH_SIZE = 50
+MAX_ATTEMPTS = getattr(settings, 'MAIL_OUTBOX_MAX_ATTEMPTS', 5)
+MIN_BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 60 * 60
+# A leased message isn't picked up by other flushes for this long.
+LEASE_SECONDS = 5 * 60
+
+_STATS_PREFIX = 'gae2django.outbox.'
+_COUNTERS = ('queued', 'sent', 'retried', 'failed', 'sessions')
+
+
+class ConnectionPool(object):
+    """Keeps an SMTP connection open between messages and flushes.
+
+    Each worker process sends one message at a time, so it needs one
+    connection.  It's replaced after max_messages messages, since servers
+    limit the messages per session, and when it was idle for max_idle
+    seconds, since servers close idle sessions.
+    """
+
+    def __init__(self, max_messages=100, max_idle=30):
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self._connection = None
+        self._count = 0
+        self._last_used = 0
+
+    def get(self):
+        """Returns an open connection and whether it was used before."""
+        now = time.time()
+        if self._connection is not None and (
+                self._count >= self.max_messages or
+                now - self._last_used > self.max_idle):
+            self.close()
+        reused = self._connection is not None
+        if not reused:
+            self._connection = get_connection(fail_silently=False)
+            self._connection.open()
+            self._count = 0
+            _incr('sessions')
+        self._count += 1
+        self._last_used = now
+        return self._connection, reused
+
+    def close(self):
+        if self._connection is None:
+            return
+        try:
+            self._connection.close()
+        except Exception:
+            pass
+        self._connection = None
+
+
+_pool = ConnectionPool(
+    max_messages=getattr(settings, 'MAIL_MAX_MESSAGES_PER_CONNECTION', 100),
+    max_idle=getattr(settings, 'MAIL_MAX_CONNECTION_IDLE', 30))
+
+
+def _incr(name, delta=1):
+    key = _STATS_PREFIX + name
+    cache.add(key, 0)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # The key was evicted in between.
+        cache.set(key, delta)
+
+
+def enqueue(message):
+    """Adds a django.core.mail.EmailMessage to the outbox."""
+    now = datetime.datetime.now()
+    OutgoingMail.objects.create(
+        message=base64.encodestring(cPickle.dumps(message)),
+        next_attempt=now)
+    _incr('queued')
+    schedule_flush(now)
+
+
+def schedule_flush(when):
+    """Makes sure a flush runs soon after the given time.
+
+    There is at most one flush task per FLUSH_DELAY_SECONDS window, so
+    messages queued within it are sent together.
+    """
+    window = int(time.mktime(when.timetuple()) // FLUSH_DELAY_SECONDS)
+    eta = datetime.datetime.fromtimestamp((window + 1) * FLUSH_DELAY_SECONDS)
+    try:
+        deferred.defer(flush, _name='mail-flush-%d' % window, _eta=eta,
+                       _queue='mail')
+    except taskqueue.TaskAlreadyExistsError:
+        pass
+
+
+def _lease_batch():
+    now = datetime.datetime.now()
+    lease_until = now + datetime.timedelta(seconds=LEASE_SECONDS)
+    batch = []
+    for mail in OutgoingMail.objects.filter(
+            next_attempt__lte=now).order_by('next_attempt')[:BATCH_SIZE]:
+        updated = OutgoingMail.objects.filter(
+            pk=mail.pk, next_attempt=mail.next_attempt).update(
+            next_attempt=lease_until)
+        if updated:
+            batch.append(mail)
+    return batch
+
+
+def _send(message):
+    connection, reused = _pool.get()
+    try:
+        connection.send_messages([message])
+    except Exception:
+        _pool.close()
+        if not reused:
+            raise
+        # The server may have dropped the session; try a fresh one.
+        connection, reused = _pool.get()
+        try:
+            connection.send_messages([message])
+        except Exception:
+            _pool.close()
+            raise
+
+
+def _retry(mail, err):
+    mail.attempts += 1
+    mail.last_error = repr(err)
+    if mail.attempts >= MAX_ATTEMPTS:
+        logging.error('Giving up on %s after %d attempts: %s',
+                      mail, mail.attempts, mail.last_error)
+        mail.delete()
+        _incr('failed')
+        return
+    backoff = min(MIN_BACKOFF_SECONDS * 2 ** (mail.attempts - 1),
+                  MAX_BACKOFF_SECONDS)
+    mail.next_attempt = (datetime.datetime.now() +
+                         datetime.timedelta(seconds=backoff))
+    mail.save()
+    _incr('retried')
+    schedule_flush(mail.next_attempt)
+
+
+def flush():
+    """Sends all mail that is due.
+
+    Returns:
+      The number of messages sent.
+    """
+    start = time.time()
+    sent = failed = 0
+    while True:
+        batch = _lease_batch()
+        if not batch:
+            break
+        for mail in batch:
+            message = cPickle.loads(base64.decodestring(mail.message))
+            try:
+                _send(message)
+            except Exception, err:
+                logging.warning('Sending %s failed: %r', mail, err)
+                _retry(mail, err)
+                failed += 1
+            else:
+                mail.delete()
+                sent += 1
+    if sent:
+        _incr('sent', sent)
+    if sent or failed:
+        logging.info('Outbox: sent %d, failed %d in %.2fs',
+                     sent, failed, time.time() - start)
+    return sent
+
+
+def get_stats():
+    """Returns delivery counters and the state of the outbox.
+
+    The counters (queued, sent, retried, failed and SMTP sessions) are
+    cumulative since the cache was last cleared.
+    """
+    stats = dict((name, cache.get(_STATS_PREFIX + name) or 0)
+                 for name in _COUNTERS)
+    pending = OutgoingMail.objects.all()
+    stats['pending'] = pending.count()
+    stats['deferred'] = pending.filter(attempts__gt=0).count()
+    oldest = pending.order_by('created')[:1]
+    if oldest:
+        age = datetime.datetime.now() - oldest[0].created
+        stats['oldest_pending_seconds'] = age.days * 86400 + age.seconds
+    else:
+        stats['oldest_pending_seconds'] = 0
+    return stats
@@ -0,0 +1,204 @@
+#
+# Copyright 2008 Andi Albrecht <albrecht.andi@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Executes tasks added with gaeapi.appengine.api.taskqueue.
+
+Like on App Engine each task is turned into a request to the task's URL
+which is passed through Django's request handler.  A task is done when
+the handler responds with a 2xx status code, otherwise it's retried with
+exponential backoff.
+"""
+
+import base64
+import cPickle
+import datetime
+import logging
+import multiprocessing
+import sys
+import time
+from cStringIO import StringIO
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connections
+
+from gae2django.middleware import TASKQUEUE_ENVIRON_KEY
+from gae2django.models import Task
+
+# A leased task isn't picked up by other workers for this long.
+LEASE_SECONDS = 10 * 60
+MIN_BACKOFF_SECONDS = 1
+MAX_BACKOFF_SECONDS = 60 * 60
+# Tasks failing more often are dropped.
+MAX_RETRIES = getattr(settings, 'TASKQUEUE_MAX_RETRIES', 20)
+
+_handler = None
+
+
+def lease_task(queue_names=None):
+    """Leases the next task that is due.
+
+    Args:
+      queue_names: Optional list of queues to take tasks from.
+
+    Returns:
+      A gae2django.models.Task or None if no task is due.
+    """
+    now = datetime.datetime.now()
+    query = Task.objects.filter(eta__lte=now)
+    if queue_names:
+        query = query.filter(queue_name__in=queue_names)
+    lease_until = now + datetime.timedelta(seconds=LEASE_SECONDS)
+    for task in query.order_by('eta')[:10]:
+        # Only one worker succeeds in moving eta from the value it has
+        # seen, the others try the next task.
+        updated = Task.objects.filter(pk=task.pk, eta=task.eta).update(
+            eta=lease_until)
+        if updated:
+            task.eta = lease_until
+            return task
+    return None
+
+
+def _make_environ(task):
+    path, _, query = task.url.partition('?')
+    payload = base64.decodestring(task.payload or '')
+    environ = {
+        'REQUEST_METHOD': task.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'CONTENT_LENGTH': str(len(payload)),
+        'SERVER_NAME': getattr(settings, 'TASKQUEUE_HOST', 'localhost'),
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(payload),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'HTTP_X_APPENGINE_QUEUENAME': task.queue_name,
+        'HTTP_X_APPENGINE_TASKNAME': task.name,
+        'HTTP_X_APPENGINE_TASKRETRYCOUNT': str(task.retry_count),
+        TASKQUEUE_ENVIRON_KEY: True,
+    }
+    if task.headers:
+        headers = cPickle.loads(base64.decodestring(task.headers))
+    else:
+        headers = {}
+    for key, value in headers.iteritems():
+        key = key.upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_%s' % key
+        environ[key] = value
+    return environ
+
+
+def retry_task(task):
+    """Schedules the next attempt of a failed task.
+
+    Returns:
+      False if the task has failed too often and was deleted.
+    """
+    task.retry_count += 1
+    if MAX_RETRIES is not None and task.retry_count > MAX_RETRIES:
+        logging.error('Task %s failed %d times, giving up.',
+                      task, task.retry_count)
+        task.delete()
+        return False
+    backoff = min(MIN_BACKOFF_SECONDS * 2 ** (task.retry_count - 1),
+                  MAX_BACKOFF_SECONDS)
+    task.eta = datetime.datetime.now() + datetime.timedelta(seconds=backoff)
+    task.save()
+    return True
+
+
+def execute_task(task):
+    """Runs a leased task.
+
+    Returns:
+      True if the task succeeded and was deleted.
+    """
+    global _handler
+    if _handler is None:
+        _handler = WSGIHandler()
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):
+        status.append(status_line)
+        return lambda data: None
+
+    try:
+        result = _handler(_make_environ(task), start_response)
+        try:
+            for _ in result:
+                pass
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        code = int(status[-1].split(' ', 1)[0])
+    except Exception:
+        logging.exception('Task %s raised an exception.', task)
+        code = 500
+    if 200 <= code < 300:
+        task.delete()
+        return True
+    logging.warning('Task %s failed with status %d.', task, code)
+    retry_task(task)
+    return False
+
+
+def run(queue_names=None, poll_interval=1.0, once=False):
+    """Executes due tasks until interrupted.
+
+    Args:
+      queue_names: Optional list of queues to take tasks from.
+      poll_interval: Seconds to wait when no task is due.
+      once: If True, return as soon as no task is due.
+    """
+    while True:
+        task = lease_task(queue_names)
+        if task is not None:
+            execute_task(task)
+            continue
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+def run_pool(processes, queue_names=None, poll_interval=1.0, once=False):
+    """Executes due tasks in several worker processes.
+
+    Takes the same arguments as run() plus the number of processes.  Each
+    worker leases its own tasks, so slow tasks (e.g. sending mail) don't
+    hold up the others.
+    """
+    # The workers must not share the database connections of this process.
+    for connection in connections.all():
+        connection.close()
+    workers = [multiprocessing.Process(target=run,
+                                       args=(queue_names, poll_interval,
+                                             once))
+               for _ in xrange(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
@@ -78,6 +78,9 @@ class DatastoreModelTest(unittest.TestCase):
                          [item1, item2])
         self.assertEqual(TestModel.get_by_key_name(['test1']),
                          [item1])
+        self.assertEqual(TestModel.get_by_key_name(['test2', 'foo', 'test1',
+                                                    'test2']),
+                         [item2, None, item1, item2])
         item1.delete()
         item2.delete()
 
@@ -89,6 +92,25 @@ class DatastoreModelTest(unittest.TestCase):
         self.assertEqual(item1.xstring, 'foo')
         item1.delete()
 
+    def test_get_or_insert_race(self):
+        # The entity is inserted elsewhere between the lookup and the insert.
+        other = TestModel.get_or_insert('test1', xstring='foo')
+        real_get = TestModel.objects.get
+        calls = []
+        def get(**kwds):
+            calls.append(kwds)
+            if len(calls) == 1:
+                raise TestModel.DoesNotExist
+            return real_get(**kwds)
+        TestModel.objects.get = get
+        try:
+            item = TestModel.get_or_insert('test1', xstring='bar')
+        finally:
+            del TestModel.objects.get
+        self.assertEqual(item, other)
+        self.assertEqual(item.xstring, 'foo')
+        other.delete()
+
     def test_all(self):
         self.assertEqual(len(TestModel.all()), 1)
         item1 = TestModel.get_or_insert('test1')
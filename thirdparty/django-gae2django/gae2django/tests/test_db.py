@@ -15,6 +15,8 @@
 
 import unittest
 
+from django.db import IntegrityError
+
 from gae2django.gaeapi.appengine.ext import db
 from gae2django.models import RegressionTestModel as TestModel
 
@@ -172,3 +174,22 @@ class TestGqlQuery(unittest.TestCase):
         q = db.GqlQuery('SELECT * FROM RegressionTestModel ORDER BY xstring')
         items = q.fetch(2, 100)
         self.assertEqual(len(items), 0)
+
+
+class TestTransaction(unittest.TestCase):
+
+    def test_retry_after_collision(self):
+        calls = []
+        def txn():
+            calls.append(1)
+            if len(calls) == 1:
+                raise IntegrityError('duplicate key')
+            return 'done'
+        self.assertEqual(db.run_in_transaction(txn), 'done')
+        self.assertEqual(len(calls), 2)
+
+    def test_too_many_collisions(self):
+        def txn():
+            raise IntegrityError('duplicate key')
+        self.assertRaises(db.TransactionFailedError,
+                          db.run_in_transaction_custom_retries, 2, txn)
@@ -0,0 +1,61 @@
+#
+# Copyright 2008 Andi Albrecht <albrecht.andi@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from django.test import TestCase
+
+from gae2django import taskrunner
+from gae2django.models import Task
+# Same module as used by gae2django.views.deferred.
+from gaeapi.appengine.ext import deferred
+
+_calls = []
+
+
+def _record(*args, **kwds):
+    _calls.append((args, kwds))
+
+
+def _fail_permanently():
+    raise deferred.PermanentTaskFailure('gone')
+
+
+class DeferredTest(TestCase):
+
+    def setUp(self):
+        del _calls[:]
+
+    def test_defer(self):
+        task = deferred.defer(_record, 1, foo='bar', _queue='other')
+        self.assertEqual(task.queue_name, 'other')
+        self.assertEqual(task.url, '/_ah/queue/deferred')
+        self.assert_(taskrunner.execute_task(taskrunner.lease_task()))
+        self.assertEqual(_calls, [((1,), {'foo': 'bar'})])
+
+    def test_permanent_failure(self):
+        deferred.defer(_fail_permanently)
+        # The task is done, there's no point in retrying it.
+        self.assert_(taskrunner.execute_task(taskrunner.lease_task()))
+        self.assertEqual(Task.objects.count(), 0)
+
+    def test_run_bad_payload(self):
+        self.assertRaises(deferred.PermanentTaskFailure,
+                          deferred.run, 'not a pickle')
+
+    def test_external_request(self):
+        response = self.client.post('/_ah/queue/deferred',
+                                    deferred.serialize(_record),
+                                    content_type='application/octet-stream')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(_calls, [])
@@ -14,10 +14,14 @@
 # limitations under the License.
 
 
+import datetime
+
 from django.core import mail as _mail
 from django.test import TestCase
 
+from gae2django import outbox
 from gae2django.gaeapi.appengine.api import mail
+from gae2django.models import OutgoingMail
 
 class MailFunctionsTest(TestCase):
 
@@ -103,3 +107,51 @@ class MailFunctionsTest(TestCase):
         self.assert_('Reply-To' in msg.extra_headers)
         self.assertEqual(msg.extra_headers['Reply-To'],
                          'other1@example.com, other2@example.com')
+
+    def test_send_mail_attachments(self):
+        kw = {'attachments': [('foo.diff', 'data')]}
+        mail.send_mail('foo@example.com', 'bar@example.com',
+                       'Subject', 'Body', **kw)
+        self.assertEqual(len(_mail.outbox), 1)
+        msg = _mail.outbox[0]
+        self.assertEqual(msg.attachments, [('foo.diff', 'data', None)])
+
+
+class OutboxTest(TestCase):
+
+    def _message(self, subject='Subject'):
+        return _mail.EmailMessage(subject, 'Body', 'foo@example.com',
+                                  ['bar@example.com'])
+
+    def test_flush(self):
+        outbox.enqueue(self._message('First'))
+        outbox.enqueue(self._message('Second'))
+        self.assertEqual(len(_mail.outbox), 0)
+        self.assertEqual(outbox.flush(), 2)
+        self.assertEqual([msg.subject for msg in _mail.outbox],
+                         ['First', 'Second'])
+        self.assertEqual(OutgoingMail.objects.count(), 0)
+
+    def test_retry(self):
+        outbox.enqueue(self._message())
+        mail = OutgoingMail.objects.get()
+        outbox._retry(mail, IOError('down'))
+        mail = OutgoingMail.objects.get()
+        self.assertEqual(mail.attempts, 1)
+        self.assert_(mail.next_attempt > datetime.datetime.now())
+        # Not due yet.
+        self.assertEqual(outbox.flush(), 0)
+        mail.attempts = outbox.MAX_ATTEMPTS - 1
+        outbox._retry(mail, IOError('down'))
+        self.assertEqual(OutgoingMail.objects.count(), 0)
+
+    def test_stats(self):
+        before = outbox.get_stats()
+        outbox.enqueue(self._message())
+        stats = outbox.get_stats()
+        self.assertEqual(stats['queued'], before['queued'] + 1)
+        self.assertEqual(stats['pending'], 1)
+        outbox.flush()
+        stats = outbox.get_stats()
+        self.assertEqual(stats['sent'], before['sent'] + 1)
+        self.assertEqual(stats['pending'], 0)
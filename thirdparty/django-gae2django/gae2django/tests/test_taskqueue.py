@@ -0,0 +1,101 @@
+#
+# Copyright 2008 Andi Albrecht <albrecht.andi@gmail.com>
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import datetime
+
+from django.test import TestCase
+
+from gae2django import taskrunner
+from gae2django.gaeapi.appengine.api import taskqueue
+from gae2django.models import Task
+
+
+class TaskQueueTest(TestCase):
+
+    def test_add(self):
+        task = taskqueue.add(url='/foo', params={'a': '1'})
+        self.assert_(task.was_enqueued)
+        stored = Task.objects.get(name=task.name)
+        self.assertEqual(stored.queue_name, 'default')
+        self.assertEqual(stored.url, '/foo')
+        self.assertEqual(stored.method, 'POST')
+        self.assertEqual(base64.decodestring(stored.payload), 'a=1')
+
+    def test_add_get_params(self):
+        task = taskqueue.add(url='/foo', params={'a': '1'}, method='GET',
+                             queue_name='other')
+        stored = Task.objects.get(name=task.name)
+        self.assertEqual(stored.queue_name, 'other')
+        self.assertEqual(stored.url, '/foo?a=1')
+
+    def test_default_url(self):
+        task = taskqueue.Queue('bar').add(taskqueue.Task())
+        self.assertEqual(task.url, '/_ah/queue/bar')
+
+    def test_countdown(self):
+        before = datetime.datetime.now()
+        task = taskqueue.add(url='/foo', countdown=60)
+        stored = Task.objects.get(name=task.name)
+        self.assert_(stored.eta >= before + datetime.timedelta(seconds=60))
+
+    def test_duplicate_name(self):
+        taskqueue.add(url='/foo', name='dup')
+        self.assertRaises(taskqueue.TaskAlreadyExistsError,
+                          taskqueue.add, url='/foo', name='dup')
+
+    def test_invalid(self):
+        self.assertRaises(taskqueue.InvalidUrlError,
+                          taskqueue.Task, url='http://example.com/')
+        self.assertRaises(taskqueue.InvalidTaskNameError,
+                          taskqueue.Task, url='/foo', name='a b')
+        self.assertRaises(taskqueue.InvalidPayloadError,
+                          taskqueue.Task, 'data', url='/foo', method='GET')
+        self.assertRaises(taskqueue.InvalidQueueNameError,
+                          taskqueue.Queue, 'a/b')
+
+
+class TaskRunnerTest(TestCase):
+
+    def test_lease(self):
+        taskqueue.add(url='/foo', name='first')
+        taskqueue.add(url='/foo', name='later', countdown=60)
+        task = taskrunner.lease_task()
+        self.assertEqual(task.name, 'first')
+        self.assert_(task.eta > datetime.datetime.now())
+        # Leased tasks aren't handed out twice.
+        self.assertEqual(taskrunner.lease_task(), None)
+
+    def test_lease_queue_names(self):
+        taskqueue.add(url='/foo', queue_name='other')
+        self.assertEqual(taskrunner.lease_task(['default']), None)
+        self.assertNotEqual(taskrunner.lease_task(['other']), None)
+
+    def test_execute(self):
+        taskqueue.add(url='/foo', name='run')
+        task = taskrunner.lease_task()
+        self.assert_(taskrunner.execute_task(task))
+        self.assertEqual(Task.objects.filter(name='run').count(), 0)
+
+    def test_retry(self):
+        taskqueue.add(url='/foo', name='retry')
+        task = taskrunner.lease_task()
+        self.assert_(taskrunner.retry_task(task))
+        task = Task.objects.get(name='retry')
+        self.assertEqual(task.retry_count, 1)
+        self.assert_(task.eta > datetime.datetime.now())
+        task.retry_count = taskrunner.MAX_RETRIES
+        self.failIf(taskrunner.retry_task(task))
+        self.assertEqual(Task.objects.filter(name='retry').count(), 0)
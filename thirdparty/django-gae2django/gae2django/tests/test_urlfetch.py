@@ -13,12 +13,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import BaseHTTPServer
+import threading
 import unittest
 import types
 
 from gae2django.gaeapi.appengine.api import urlfetch
 
 
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.client_address))
+        if (self.path == '/etag' and
+            self.headers.get('If-None-Match') == '"v1"'):
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.path == '/big' and 'x' * 20 or 'content'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        if self.path == '/etag':
+            self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(BaseHTTPServer.HTTPServer):
+
+    def handle_error(self, request, client_address):
+        # Truncated responses make the client close the connection.
+        pass
+
+
 class URLFetchTest(unittest.TestCase):
     """Tests URL fetch API."""
 
@@ -37,3 +70,48 @@ class URLFetchTest(unittest.TestCase):
     def test_invalid_protocol(self):
         self.assertRaises(urlfetch.InvalidURLError,
                           urlfetch.fetch, 'ftp://example.com/README.txt')
+
+
+class LocalURLFetchTest(unittest.TestCase):
+    """Tests URL fetch API against a local server."""
+
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        del _Handler.requests[:]
+
+    def tearDown(self):
+        urlfetch._pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        urlfetch.fetch(self.url + '/a')
+        urlfetch.fetch(self.url + '/b')
+        ports = [address[1] for path, address in _Handler.requests]
+        self.assertEqual(len(ports), 2)
+        self.assertEqual(ports[0], ports[1])
+
+    def test_conditional(self):
+        response = urlfetch.fetch(self.url + '/etag', conditional=True)
+        self.assertEqual(response.content, 'content')
+        response = urlfetch.fetch(self.url + '/etag', conditional=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'content')
+        self.assertEqual(len(_Handler.requests), 2)
+
+    def test_response_too_large(self):
+        old_size = urlfetch.MAX_RESPONSE_SIZE
+        urlfetch.MAX_RESPONSE_SIZE = 10
+        try:
+            self.assertRaises(urlfetch.ResponseTooLargeError,
+                              urlfetch.fetch, self.url + '/big')
+            response = urlfetch.fetch(self.url + '/big',
+                                      allow_truncated=True)
+            self.assertEqual(response.content, 'x' * 10)
+            self.assert_(response.content_was_truncated)
+        finally:
+            urlfetch.MAX_RESPONSE_SIZE = old_size
@@ -1,10 +1,30 @@
-from django.http import HttpResponse
+import logging
+
+from django.http import HttpResponse, HttpResponseForbidden
 from django.template import Context, Template
 
 from gaeapi.appengine.api import users
+from gaeapi.appengine.ext import deferred as _deferred
 
 def test(request):
     t = Template('Test view')
     c = Context({'user': request.user,
                  'is_admin': users.is_current_user_admin()})
     return HttpResponse(t.render(c))
+
+def deferred(request):
+    """Runs a call added with google.appengine.ext.deferred.defer()."""
+    # Stripped from external requests by TaskQueueHeadersMiddleware.
+    if 'HTTP_X_APPENGINE_TASKNAME' not in request.META:
+        return HttpResponseForbidden('Only available to the task queue.')
+    try:
+        _deferred.run(request.raw_post_data)
+    except _deferred.PermanentTaskFailure:
+        logging.exception('Permanent failure running deferred task %s',
+                          request.META['HTTP_X_APPENGINE_TASKNAME'])
+    except Exception:
+        # Any other error makes the task queue try again later.
+        logging.exception('Deferred task %s failed',
+                          request.META['HTTP_X_APPENGINE_TASKNAME'])
+        return HttpResponse('Task failed.', status=500)
+    return HttpResponse('OK')
@@ -77,6 +77,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'gae2django.middleware.FixRequestUserMiddleware',
+    'gae2django.middleware.TaskQueueHeadersMiddleware',
     'django.middleware.doc.XViewMiddleware',
 )
 
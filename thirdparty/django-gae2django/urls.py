@@ -5,5 +5,6 @@ from django.conf.urls.defaults import *
 # admin.autodiscover()
 
 urlpatterns = patterns('',
+    (r'^_ah/queue/deferred$', 'gae2django.views.deferred'),
     (r'', 'gae2django.views.test'),
 )